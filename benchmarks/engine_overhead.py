@@ -0,0 +1,99 @@
+"""
+Compare the overhead of the ChatGPT engines (LangChain vs direct).
+
+The mock OpenAI backend runs in a separate process, so the CPU time measured
+here only includes the work done on the REPL side: building the request,
+parsing the stream and pushing the tokens to the client handler.
+
+Usage:
+
+    python benchmarks/engine_overhead.py --requests 200 --tokens 256
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+MOCK_PORT = 8181
+
+
+class CountingClientHandler:
+    """Client handler that only counts the tokens it receives"""
+
+    start_token = "[START]"
+    end_token = "[DONE]"
+
+    def __init__(self):
+        self.n_tokens = 0
+
+    async def add_token(self, token: str):
+        if token not in (self.start_token, self.end_token):
+            self.n_tokens += 1
+
+
+async def bench(engine: str, args):
+    # pylint: disable=import-outside-toplevel
+    from llm_repl.llms import LLMS
+
+    handler = CountingClientHandler()
+    llm = LLMS[args.llm].load(handler, engine=engine)
+    # Warm up the connections and the caches
+    await llm.process("Hello!")
+    handler.n_tokens = 0
+
+    latencies = []
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for i in range(args.requests):
+        # Start every request with an empty history
+        llm.session.trim(0)
+        start = time.perf_counter()
+        await llm.process(f"Message number {i}")
+        latencies.append(time.perf_counter() - start)
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+
+    latencies.sort()
+    print(
+        f"{engine:>10} | "
+        f"{cpu / args.requests * 1000:8.3f} ms CPU/request | "
+        f"{cpu / handler.n_tokens * 1e6:8.2f} us CPU/token | "
+        f"p50 {latencies[len(latencies) // 2] * 1000:7.2f} ms | "
+        f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:7.2f} ms | "
+        f"{handler.n_tokens / wall:10.1f} tokens/s"
+    )
+
+
+async def main(args):
+    for engine in ("langchain", "direct"):
+        await bench(engine, args)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+    parser = argparse.ArgumentParser(description="ChatGPT engines benchmark")
+    parser.add_argument("--llm", type=str, default="chatgpt")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--tokens", type=int, default=256)
+    args = parser.parse_args()
+
+    mock = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(__file__), "mock_openai.py"),
+            "--port",
+            str(MOCK_PORT),
+            "--tokens",
+            str(args.tokens),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{MOCK_PORT}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "sk-mock")
+    try:
+        time.sleep(1)
+        asyncio.run(main(args))
+    finally:
+        mock.terminate()
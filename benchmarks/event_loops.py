@@ -0,0 +1,138 @@
+"""
+Compare the event loop runtimes of the server REPLs.
+
+For each server REPL (http and websocket) and each runtime (stdlib asyncio
+loop or uvloop, with and without eager tasks where supported), it starts
+`llm-repl` in a subprocess against the mock OpenAI backend, runs concurrent
+clients and reports the time to first token, the throughput and the CPU
+time used by the server per 1000 streamed tokens.
+
+Usage:
+
+    python benchmarks/event_loops.py --clients 50 --messages 5 --tokens 256
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from replay_repls import http_client, websocket_client
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), "..", "src")
+MOCK_PORT = 8184
+SERVER_SCRIPT = "from llm_repl.__main__ import main; main()"
+
+
+def cpu_seconds(pid: int) -> float:
+    """Return the CPU time (user + system) used by the process"""
+    with open(f"/proc/{pid}/stat", "r") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def runtimes(loops):
+    # pylint: disable=import-outside-toplevel
+    from llm_repl.runtime import supports_eager_tasks
+
+    for loop in loops:
+        yield loop, False
+        if supports_eager_tasks():
+            yield loop, True
+
+
+async def bench(repl: str, loop: str, eager: bool, port: int, args):
+    cmd = [
+        sys.executable,
+        "-c",
+        SERVER_SCRIPT,
+        "--repl",
+        repl,
+        "--port",
+        str(port),
+        "--llm",
+        args.llm,
+        "--engine",
+        args.engine,
+        "--loop",
+        loop,
+    ]
+    if not eager:
+        cmd.append("--no-eager-tasks")
+    if args.executor_workers:
+        cmd += ["--executor-workers", str(args.executor_workers)]
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    server = subprocess.Popen(
+        cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        await asyncio.sleep(args.startup)
+        client = http_client if repl == "http" else websocket_client
+        cpu_start = cpu_seconds(server.pid)
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(client(port, args.messages) for _ in range(args.clients))
+        )
+        elapsed = time.perf_counter() - start
+        cpu = cpu_seconds(server.pid) - cpu_start
+    finally:
+        server.terminate()
+        server.wait()
+    ttfts = sorted(ttft for timings in results for ttft, _ in timings)
+    n_tokens = args.clients * args.messages * args.tokens
+    print(
+        f"{repl:>9} | {loop:>7} | eager {str(eager):>5} | "
+        f"ttft p50 {statistics.median(ttfts) * 1000:8.2f} ms | "
+        f"p99 {ttfts[int(len(ttfts) * 0.99)] * 1000:8.2f} ms | "
+        f"{n_tokens / elapsed:9.1f} tokens/s | "
+        f"{cpu / n_tokens * 1000 * 1000:7.2f} CPU ms/1k tokens"
+    )
+
+
+async def main(args):
+    port = args.port
+    for repl in args.repls:
+        for loop, eager in runtimes(args.loops):
+            # A different port for each server, the previous one may still
+            # be shutting down
+            port += 1
+            await bench(repl, loop, eager, port, args)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, SRC_DIR)
+    parser = argparse.ArgumentParser(description="Event loop runtimes benchmark")
+    parser.add_argument("--repls", type=str, nargs="+", default=["http", "websocket"])
+    parser.add_argument("--loops", type=str, nargs="+", default=["asyncio", "uvloop"])
+    parser.add_argument("--llm", type=str, default="chatgpt")
+    parser.add_argument("--engine", type=str, default="direct")
+    parser.add_argument("--executor-workers", type=int, default=None)
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--tokens", type=int, default=256)
+    parser.add_argument(
+        "--startup", type=float, default=3.0, help="Seconds to wait for the server"
+    )
+    args = parser.parse_args()
+
+    mock = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(__file__), "mock_openai.py"),
+            "--port",
+            str(MOCK_PORT),
+            "--tokens",
+            str(args.tokens),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{MOCK_PORT}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "sk-mock")
+    try:
+        time.sleep(1)
+        asyncio.run(main(args))
+    finally:
+        mock.terminate()
@@ -0,0 +1,75 @@
+"""
+Benchmark of the persistent prompt history.
+
+A temporary history is filled with --entries prompts, then the time needed to
+load the recent prompts at startup, to append a prompt and to search the
+whole history is measured.
+
+Usage:
+
+    python benchmarks/history_search.py --entries 100000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+WORDS = (
+    "python rust async await socket stream token model prompt history memory "
+    "docker server client error timeout retry cache index query table thread"
+).split()
+
+
+def random_prompt(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 30)))
+
+
+def main(args):
+    # pylint: disable=import-outside-toplevel
+    from llm_repl.history import SQLiteHistory
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "history.sqlite3")
+        history = SQLiteHistory(path)
+        start = time.perf_counter()
+        for _ in range(args.entries):
+            history.store_string(random_prompt(rng))
+        enqueue = time.perf_counter() - start
+        history.close()
+        print(
+            f"append   | {args.entries} prompts enqueued in {enqueue * 1000:.1f} ms "
+            f"({enqueue / args.entries * 1e6:.2f} us/prompt)"
+        )
+
+        start = time.perf_counter()
+        history = SQLiteHistory(path)
+        loaded = list(history.load_history_strings())
+        print(
+            f"startup  | {len(loaded)} recent prompts loaded in "
+            f"{(time.perf_counter() - start) * 1000:.2f} ms"
+        )
+
+        timings = []
+        for _ in range(args.searches):
+            query = " ".join(rng.choice(WORDS)[: rng.randint(2, 5)] for _ in range(2))
+            start = time.perf_counter()
+            history.search(query)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(
+            f"search   | p50 {statistics.median(timings) * 1000:.2f} ms | "
+            f"p99 {timings[int(len(timings) * 0.99)] * 1000:.2f} ms"
+        )
+        history.close()
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+    parser = argparse.ArgumentParser(description="Prompt history benchmark")
+    parser.add_argument("--entries", type=int, default=100_000)
+    parser.add_argument("--searches", type=int, default=200)
+    main(parser.parse_args())
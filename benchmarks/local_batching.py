@@ -0,0 +1,64 @@
+"""
+Benchmark the aggregate throughput of the local backend.
+
+It runs N concurrent sessions against the same local model and reports the
+aggregate tokens/s, which should grow with the number of sessions thanks to
+the continuous batching of the decode steps.
+
+Usage:
+
+    python benchmarks/local_batching.py --model distilgpt2 --clients 1 2 4 8
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+
+class CountingClientHandler:
+    """Client handler that only counts the tokens it receives"""
+
+    start_token = "[START]"
+    end_token = "[DONE]"
+
+    def __init__(self):
+        self.n_tokens = 0
+
+    async def add_token(self, token: str):
+        if token not in (self.start_token, self.end_token):
+            self.n_tokens += 1
+
+
+async def bench(model_path: str, n_clients: int):
+    # pylint: disable=import-outside-toplevel
+    from llm_repl.llms import LLMS
+
+    handlers = [CountingClientHandler() for _ in range(n_clients)]
+    llms = [LLMS["local"].load(handler, model_path=model_path) for handler in handlers]
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            llm.process(f"Tell me a story about the number {i}")
+            for i, llm in enumerate(llms)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    n_tokens = sum(handler.n_tokens for handler in handlers)
+    print(
+        f"{n_clients:>4} clients | {n_tokens:>6} tokens | "
+        f"{n_tokens / elapsed:8.2f} tokens/s aggregate"
+    )
+
+
+async def main(args):
+    for n_clients in args.clients:
+        await bench(args.model, n_clients)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+    parser = argparse.ArgumentParser(description="Local backend batching benchmark")
+    parser.add_argument("--model", type=str, default="distilgpt2")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 2, 4, 8])
+    asyncio.run(main(parser.parse_args()))
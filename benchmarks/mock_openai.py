@@ -0,0 +1,160 @@
+"""
+Minimal mock of the OpenAI chat completions API used by the benchmarks.
+
+It only speaks enough HTTP/1.1 to serve `POST /v1/chat/completions` (both
+streaming and non streaming) and `GET /v1/models`, answering every request
+with the same canned reply. Point the LLMs to it with `OPENAI_API_BASE`.
+
+Usage:
+
+    python benchmarks/mock_openai.py --port 8080 --tokens 64 --delay 0.01
+"""
+import argparse
+import asyncio
+import json
+import time
+
+REPLY_TOKENS = ["Lorem", " ipsum", " dolor", " sit", " amet", ",", " consectetur"]
+
+
+class MockOpenAI:
+    """
+    Mock OpenAI server
+
+    :param int n_tokens: Number of tokens of each reply
+    :param float delay: Seconds to wait between two streamed tokens
+    """
+
+    def __init__(self, n_tokens: int = 32, delay: float = 0.0):
+        self.n_tokens = n_tokens
+        self.delay = delay
+        self.requests = 0
+        self.server: asyncio.AbstractServer | None = None
+
+    @property
+    def reply_tokens(self):
+        return [REPLY_TOKENS[i % len(REPLY_TOKENS)] for i in range(self.n_tokens)]
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """
+        Start the server and return the port it is listening on
+        """
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None, None, None
+        method, path, _ = request_line.decode().split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, value = line.decode().split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+        body = b""
+        if "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        return method, path, body
+
+    @staticmethod
+    def _chunk(model: str, delta: dict, finish_reason: str | None = None) -> bytes:
+        chunk = {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(chunk)}\n\n".encode()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            method, path, body = await self._read_request(reader)
+            if method is None:
+                return
+            if method == "GET":
+                payload = json.dumps({"object": "list", "data": []}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n".encode()
+                    + b"Connection: close\r\n\r\n"
+                    + payload
+                )
+                return
+            self.requests += 1
+            params = json.loads(body or b"{}")
+            model = params.get("model", "mock")
+            if not params.get("stream", False):
+                payload = json.dumps(
+                    {
+                        "id": "chatcmpl-mock",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [
+                            {
+                                "index": 0,
+                                "message": {
+                                    "role": "assistant",
+                                    "content": "".join(self.reply_tokens),
+                                },
+                                "finish_reason": "stop",
+                            }
+                        ],
+                        "usage": {
+                            "prompt_tokens": 0,
+                            "completion_tokens": self.n_tokens,
+                            "total_tokens": self.n_tokens,
+                        },
+                    }
+                ).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n".encode()
+                    + b"Connection: close\r\n\r\n"
+                    + payload
+                )
+                return
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                b"Connection: close\r\n\r\n"
+            )
+            writer.write(self._chunk(model, {"role": "assistant", "content": ""}))
+            for token in self.reply_tokens:
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                writer.write(self._chunk(model, {"content": token}))
+                await writer.drain()
+            writer.write(self._chunk(model, {}, finish_reason="stop"))
+            writer.write(b"data: [DONE]\n\n")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            try:
+                await writer.drain()
+                writer.close()
+            except ConnectionError:
+                pass
+
+
+async def _main(args):
+    server = MockOpenAI(n_tokens=args.tokens, delay=args.delay)
+    port = await server.start(port=args.port)
+    print(f"Mock OpenAI listening on http://127.0.0.1:{port}/v1")
+    await asyncio.Future()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock OpenAI server")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--tokens", type=int, default=32)
+    parser.add_argument("--delay", type=float, default=0.0)
+    asyncio.run(_main(parser.parse_args()))
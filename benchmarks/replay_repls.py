@@ -0,0 +1,214 @@
+"""
+End to end benchmark (and regression test) of the REPLs, without network.
+
+The REPLs are run with the replay LLM, serving the cassettes recorded with
+`llm-repl --record <DIR>` with their original timing (scaled by --speed),
+and driven by concurrent clients measuring the time to first token and the
+total time of every answer.
+
+Usage:
+
+    # Record some cassettes with real traffic first
+    llm-repl --record cassettes/
+    # Benchmark the REPLs and save the results as the baseline
+    python benchmarks/replay_repls.py --cassettes cassettes/ --save baseline.json
+    # Fail if the REPLs got slower than the baseline
+    python benchmarks/replay_repls.py --cassettes cassettes/ --baseline baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from typing import Dict, List, Tuple
+
+import aiohttp
+import websockets
+
+# (time to first token, total time) of each answer, in seconds
+Timings = List[Tuple[float, float]]
+
+
+async def http_client(port: int, n_messages: int) -> Timings:
+    timings = []
+    async with aiohttp.ClientSession() as session:
+        for i in range(n_messages):
+            body = {
+                "model": "replay",
+                "messages": [{"role": "user", "content": f"Message number {i}"}],
+            }
+            start = time.perf_counter()
+            ttft = None
+            async with session.post(
+                f"http://127.0.0.1:{port}/v1/chat/completions", json=body
+            ) as resp:
+                async for line in resp.content:
+                    if not line.startswith(b"data:"):
+                        continue
+                    if line[5:].strip() == b"[DONE]":
+                        break
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+            total = time.perf_counter() - start
+            timings.append((ttft if ttft is not None else total, total))
+    return timings
+
+
+async def websocket_client(port: int, n_messages: int) -> Timings:
+    timings = []
+    async with websockets.connect(f"ws://localhost:{port}") as websocket:
+        for i in range(n_messages):
+            start = time.perf_counter()
+            ttft = None
+            await websocket.send(f"Message number {i}")
+            while True:
+                frame = await websocket.recv()
+                if frame == "EOF":
+                    break
+                if frame and ttft is None:
+                    ttft = time.perf_counter() - start
+            total = time.perf_counter() - start
+            timings.append((ttft if ttft is not None else total, total))
+    return timings
+
+
+class TimingFile:
+    """File recording the time of the first write after each reset"""
+
+    def __init__(self):
+        self.first_write: float | None = None
+
+    def write(self, text: str):
+        if text.strip() and self.first_write is None:
+            self.first_write = time.perf_counter()
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+async def bench_prompt_toolkit(args) -> Timings:
+    # pylint: disable=import-outside-toplevel
+    from prompt_toolkit.application import create_app_session
+    from prompt_toolkit.input import create_pipe_input
+    from prompt_toolkit.output import DummyOutput
+    from rich.console import Console
+
+    from llm_repl.repls.prompt_toolkit import PromptToolkitClientHandler
+
+    timings = []
+    with tempfile.TemporaryDirectory() as directory, create_pipe_input() as pipe_input:
+        with create_app_session(input=pipe_input, output=DummyOutput()):
+            # Keep the prompts of the benchmark out of the user's history
+            handler = PromptToolkitClientHandler(
+                history_path=os.path.join(directory, "history.sqlite3")
+            )
+            output = TimingFile()
+            handler.console = Console(file=output, width=120)  # type: ignore
+            handler.llm = await handler.load_llm_async(
+                "replay", cassettes=args.cassettes, replay_speed=args.speed
+            )
+            print_task = asyncio.create_task(handler.print_loop())
+            for i in range(args.clients * args.messages):
+                output.first_write = None
+                start = time.perf_counter()
+                await handler.llm.process(f"Message number {i}")
+                await handler.tokens.join()
+                total = time.perf_counter() - start
+                ttft = (output.first_write or time.perf_counter()) - start
+                timings.append((ttft, total))
+            print_task.cancel()
+            handler.history.close()
+    return timings
+
+
+async def bench_server(repl_name: str, port: int, args) -> Timings:
+    # pylint: disable=import-outside-toplevel
+    from llm_repl.repls import REPLS
+
+    repl = REPLS[repl_name](port=port)
+    server = asyncio.create_task(
+        repl.run("replay", cassettes=args.cassettes, replay_speed=args.speed)
+    )
+    await asyncio.sleep(1)
+    client = http_client if repl_name == "http" else websocket_client
+    results = await asyncio.gather(
+        *(client(port, args.messages) for _ in range(args.clients))
+    )
+    server.cancel()
+    await asyncio.sleep(0.5)
+    return [timing for timings in results for timing in timings]
+
+
+def summarize(timings: Timings) -> Dict[str, float]:
+    ttfts = sorted(ttft for ttft, _ in timings)
+    totals = sorted(total for _, total in timings)
+    return {
+        "ttft_p50_ms": statistics.median(ttfts) * 1000,
+        "ttft_p99_ms": ttfts[int(len(ttfts) * 0.99)] * 1000,
+        "total_p50_ms": statistics.median(totals) * 1000,
+        "total_p99_ms": totals[int(len(totals) * 0.99)] * 1000,
+    }
+
+
+async def main(args) -> int:
+    results = {}
+    for i, repl_name in enumerate(args.repls):
+        if repl_name == "prompt_toolkit":
+            timings = await bench_prompt_toolkit(args)
+        else:
+            # A different port for each server, the previous one may still
+            # be shutting down
+            timings = await bench_server(repl_name, args.port + i, args)
+        results[repl_name] = summarize(timings)
+        print(
+            f"{repl_name:>15} | "
+            + " | ".join(f"{k} {v:8.2f}" for k, v in results[repl_name].items())
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if not args.baseline:
+        return 0
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    regressions = [
+        f"{repl_name} {metric}: {baseline[repl_name][metric]:.2f} -> {value:.2f} ms"
+        for repl_name, metrics in results.items()
+        for metric, value in metrics.items()
+        if repl_name in baseline
+        and value > baseline[repl_name][metric] * (1 + args.tolerance)
+    ]
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+    parser = argparse.ArgumentParser(description="REPLs replay benchmark")
+    parser.add_argument("--cassettes", type=str, required=True)
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument(
+        "--repls",
+        type=str,
+        nargs="+",
+        default=["http", "websocket", "prompt_toolkit"],
+    )
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--save", type=str, default=None)
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative slowdown over the baseline reported as a regression",
+    )
+    sys.exit(asyncio.run(main(parser.parse_args())))
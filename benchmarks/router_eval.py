@@ -0,0 +1,98 @@
+"""
+Offline evaluation of the routing rules of the router LLM.
+
+The prompts of the routing decisions logged by `llm-repl --llm router` are
+routed again with the given rules, using the per-backend statistics observed
+in the log, to compare the rules before deploying them: backends picked,
+agreement with the logged decisions and expected time to first token.
+
+The prompts are only in the log with `--router-log-prompts`, otherwise the
+decisions are routed again from their logged features and the keywords of the
+rules never match.
+
+Usage:
+
+    python benchmarks/router_eval.py --rules my_rules.yml
+    python benchmarks/router_eval.py --rules my_rules.yml --log decisions.jsonl
+"""
+import argparse
+import collections
+import json
+import os
+import statistics
+import sys
+
+
+def main(args):
+    # pylint: disable=import-outside-toplevel
+    from llm_repl.llms.router import (
+        DECISIONS_LOG,
+        BackendStats,
+        extract_features,
+        load_rules,
+    )
+
+    with open(args.log or DECISIONS_LOG, "r") as f:
+        decisions = [json.loads(line) for line in f if line.strip()]
+    if not decisions:
+        print("No decision logged")
+        return
+
+    # Statistics of the backends as observed in the log
+    stats = collections.defaultdict(BackendStats)
+    ttfts = collections.defaultdict(list)
+    for decision in decisions:
+        stats[decision["backend"]].record(
+            decision["ttft"], decision["tokens_per_s"], decision["error"] is not None
+        )
+        if decision["ttft"] is not None:
+            ttfts[decision["backend"]].append(decision["ttft"])
+    median_ttft = {backend: statistics.median(v) for backend, v in ttfts.items()}
+
+    config = load_rules(args.rules)
+    rules = collections.Counter()
+    backends = collections.Counter()
+    agreements = 0
+    logged_ttft, routed_ttft = [], []
+    without_prompt = 0
+    for decision in decisions:
+        if "prompt" in decision:
+            features = extract_features(decision["prompt"])
+        else:
+            without_prompt += 1
+            features = {
+                "text": "",
+                "tokens": decision["tokens"],
+                "has_code": decision["has_code"],
+            }
+        # The hint was stripped from the logged prompt
+        features["hint"] = decision["hint"]
+        rule, candidates = config.route(features, stats)
+        backend = candidates[0]
+        rules[rule] += 1
+        backends[backend] += 1
+        agreements += backend == decision["backend"]
+        if decision["backend"] in median_ttft and backend in median_ttft:
+            logged_ttft.append(median_ttft[decision["backend"]])
+            routed_ttft.append(median_ttft[backend])
+
+    print(f"decisions | {len(decisions)} ({without_prompt} without prompt)")
+    print(f"agreement | {agreements / len(decisions) * 100:.1f}%")
+    for rule, count in rules.most_common():
+        print(f"rule      | {rule:>20} {count}")
+    for backend, count in backends.most_common():
+        print(f"backend   | {backend:>20} {count}")
+    if routed_ttft:
+        print(
+            f"ttft      | logged {statistics.mean(logged_ttft) * 1000:.1f} ms | "
+            f"rules {statistics.mean(routed_ttft) * 1000:.1f} ms (mean of the "
+            "median TTFT of the backends picked)"
+        )
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+    parser = argparse.ArgumentParser(description="Routing rules evaluation")
+    parser.add_argument("--rules", type=str, required=True)
+    parser.add_argument("--log", type=str, default=None)
+    main(parser.parse_args())
@@ -0,0 +1,125 @@
+"""
+Benchmark the memory footprint of the websocket sessions.
+
+For each number of sessions, it creates the websocket client handlers (each
+one with its own LLM session) and reports the RSS growth per idle session,
+then sends one message per session to the mock OpenAI backend and reports
+the RSS growth per active session.
+
+Usage:
+
+    python benchmarks/session_memory.py --sessions 1000 10000
+"""
+import argparse
+import asyncio
+import gc
+import os
+import subprocess
+import sys
+
+from typing import List
+
+from mock_openai import MockOpenAI
+
+
+def rss_bytes() -> int:
+    """Return the resident set size of the current process"""
+    with open("/proc/self/statm", "r") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class NullWebsocket:
+    """Websocket that drops every message"""
+
+    async def send(self, _msg):
+        pass
+
+
+async def bench(n_sessions: int, llm_name: str, concurrency: int):
+    # pylint: disable=import-outside-toplevel,unused-import
+    from llm_repl.repls.websocket import WebsocketClientHandler
+
+    # LangChain is imported by the first session using it, keep the import
+    # out of the per-session memory
+    import llm_repl.langchain_chain
+
+    tasks: List[asyncio.Task] = []
+
+    def spawn(coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        tasks.append(task)
+        return task
+
+    gc.collect()
+    baseline = rss_bytes()
+    handlers = []
+    for _ in range(n_sessions):
+        handler = WebsocketClientHandler(websocket=NullWebsocket(), spawn=spawn)
+        await handler.start(llm_name)
+        handlers.append(handler)
+    gc.collect()
+    idle = rss_bytes()
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _send(handler):
+        async with semaphore:
+            await handler.process("Hello, how are you?")
+
+    await asyncio.gather(*(_send(handler) for handler in handlers))
+    # Let the print loops drain the queues
+    await asyncio.gather(*(handler.tokens.join() for handler in handlers))
+    gc.collect()
+    active = rss_bytes()
+
+    print(
+        f"{n_sessions:>8} sessions | "
+        f"idle: {(idle - baseline) / n_sessions / 1024:8.2f} KiB/session | "
+        f"active: {(active - baseline) / n_sessions / 1024:8.2f} KiB/session"
+    )
+
+    # Stop the print loops and free the sessions
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.gather(*(handler.llm.close() for handler in handlers))
+
+
+async def main(args):
+    server = MockOpenAI(n_tokens=args.tokens)
+    port = await server.start()
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "sk-mock")
+    await bench(args.sessions[0], args.llm, args.concurrency)
+    await server.stop()
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+    parser = argparse.ArgumentParser(description="Session memory benchmark")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--llm", type=str, default="chatgpt")
+    parser.add_argument("--tokens", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=200)
+    args = parser.parse_args()
+    if len(args.sessions) == 1:
+        asyncio.run(main(args))
+    else:
+        # A new process for each measure, the memory freed by the previous
+        # one would be reused by the sessions instead of growing the RSS
+        for n_sessions in args.sessions:
+            subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--sessions",
+                    str(n_sessions),
+                    "--llm",
+                    args.llm,
+                    "--tokens",
+                    str(args.tokens),
+                    "--concurrency",
+                    str(args.concurrency),
+                ],
+                check=True,
+            )
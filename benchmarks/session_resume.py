@@ -0,0 +1,59 @@
+"""
+Benchmark of the resume of a journaled conversation.
+
+A conversation of --turns turns is journaled in a temporary directory (with
+the periodic snapshots), then the time needed to rebuild its memory is
+measured, as done by `llm-repl --resume <session>`.
+
+Usage:
+
+    python benchmarks/session_resume.py --turns 1000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+
+def main(args):
+    # pylint: disable=import-outside-toplevel
+    from llm_repl.journal import SessionJournal
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as directory:
+        session = SessionJournal("bench", directory).load()
+        for i in range(args.turns // 2):
+            session.add_exchange(
+                f"Question number {i}: " + "lorem ipsum " * rng.randint(5, 50),
+                f"Answer number {i}: " + "dolor sit amet " * rng.randint(20, 200),
+            )
+        session.journal.close()
+        size = sum(
+            os.path.getsize(os.path.join(directory, "bench", name))
+            for name in os.listdir(os.path.join(directory, "bench"))
+        )
+        print(f"journal  | {len(session)} turns, {size / 1e6:.2f} MB on disk")
+
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            journal = SessionJournal("bench", directory)
+            resumed = journal.load()
+            timings.append(time.perf_counter() - start)
+            journal.close()
+            assert resumed.turns() == session.turns()
+        print(
+            f"resume   | p50 {statistics.median(timings) * 1000:.2f} ms | "
+            f"max {max(timings) * 1000:.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+    parser = argparse.ArgumentParser(description="Conversation resume benchmark")
+    parser.add_argument("--turns", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    main(parser.parse_args())
@@ -0,0 +1,159 @@
+"""
+Startup benchmark of the prompt_toolkit REPL.
+
+Measures the time to import the REPL in a new process and, from the start
+of the REPL, the time until the prompt is shown
+(time to prompt) and until the LLM is loaded in background, then the time to
+answer a first message sent after a typing delay. The time the REPL used to
+wait before showing the prompt (loading the LLM in the foreground) is
+measured as well for comparison.
+
+The mock OpenAI backend is used, so that no network access is needed.
+
+Usage:
+
+    python benchmarks/startup.py --engine direct --runs 5
+"""
+import argparse
+import asyncio
+import io
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+MOCK_PORT = 8183
+SRC_DIR = os.path.join(os.path.dirname(__file__), "..", "src")
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import llm_repl.__main__
+print(time.perf_counter() - start)
+"""
+
+
+def measure_import() -> float:
+    """Return the time to import the REPL in a new process, in seconds"""
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    output = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT], env=env)
+    return float(output)
+
+
+async def wait_for(condition, timeout: float = 30.0):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError()
+        await asyncio.sleep(0.001)
+    return time.perf_counter()
+
+
+async def run_once(args):
+    # pylint: disable=import-outside-toplevel
+    from prompt_toolkit.application import create_app_session
+    from prompt_toolkit.input import create_pipe_input
+    from prompt_toolkit.output import DummyOutput
+    from rich.console import Console
+
+    from llm_repl.llms import load_personality
+    from llm_repl.openai_client import get_shared_client
+    from llm_repl.repls.prompt_toolkit import PromptToolkitClientHandler
+
+    def clear_caches():
+        # Start every measure cold, as a new process would
+        load_personality.cache_clear()
+        # LangChain is only imported by the first LLM using it
+        if "llm_repl.langchain_chain" in sys.modules:
+            sys.modules["llm_repl.langchain_chain"].get_shared_chain.cache_clear()
+        get_shared_client.cache_clear()
+
+    # Keep the prompts of the runs out of the user's history
+    directory = tempfile.mkdtemp()
+    history_path = os.path.join(directory, "history.sqlite3")
+    with create_pipe_input() as pipe_input:
+        with create_app_session(input=pipe_input, output=DummyOutput()):
+            # Foreground loading, as the REPL used to do before the prompt
+            handler = PromptToolkitClientHandler(history_path=history_path)
+            handler.console = Console(file=io.StringIO())
+            clear_caches()
+            start = time.perf_counter()
+            llm = await handler.load_llm_async(args.llm, engine=args.engine)
+            await llm.warmup()
+            foreground = time.perf_counter() - start
+            handler.history.close()
+
+            handler = PromptToolkitClientHandler(history_path=history_path)
+            handler.console = Console(file=io.StringIO())
+            clear_caches()
+            start = time.perf_counter()
+            repl = asyncio.create_task(handler.start(args.llm, engine=args.engine))
+            prompt_at = await wait_for(lambda: handler.session.app.is_running)
+            loaded = asyncio.create_task(wait_for(lambda: handler.llm is not None))
+            # The user takes some time to type the first message, the answer
+            # is only faster if the LLM is loaded and warmed up meanwhile
+            await asyncio.sleep(args.typing_delay)
+            sent_at = time.perf_counter()
+            pipe_input.send_text("Hello!\r\r")
+            loaded_at = await loaded
+            answered_at = await wait_for(
+                lambda: len(getattr(handler.llm, "session", ())) >= 2
+            )
+            for task in asyncio.all_tasks():
+                if task is not asyncio.current_task():
+                    task.cancel()
+            handler.history.close()
+    shutil.rmtree(directory, ignore_errors=True)
+    return {
+        "import_ms": measure_import() * 1000,
+        "foreground_load_ms": foreground * 1000,
+        "time_to_prompt_ms": (prompt_at - start) * 1000,
+        "llm_loaded_ms": (loaded_at - start) * 1000,
+        "first_answer_ms": (answered_at - sent_at) * 1000,
+    }
+
+
+async def main(args):
+    results = [await run_once(args) for _ in range(args.runs)]
+    for metric in results[0]:
+        values = [result[metric] for result in results]
+        print(
+            f"{metric:>20} | p50 {statistics.median(values):8.2f} ms | "
+            f"max {max(values):8.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="REPL startup benchmark")
+    parser.add_argument("--llm", type=str, default="chatgpt")
+    parser.add_argument("--engine", type=str, default="direct")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--typing-delay",
+        type=float,
+        default=1.0,
+        help="Seconds between the prompt and the first message sent",
+    )
+    args = parser.parse_args()
+
+    mock = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(__file__), "mock_openai.py"),
+            "--port",
+            str(MOCK_PORT),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{MOCK_PORT}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "sk-mock")
+    # Keep the histories and the journals of the runs out of the user's ones
+    os.environ["LLM_REPL_HOME"] = tempfile.mkdtemp()
+    sys.path.insert(0, SRC_DIR)
+    try:
+        time.sleep(1)
+        asyncio.run(main(args))
+    finally:
+        mock.terminate()
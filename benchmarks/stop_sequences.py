@@ -0,0 +1,95 @@
+"""
+Measure the upstream time saved by the client-side stop sequences.
+
+The mock OpenAI backend streams --tokens tokens with --delay seconds between
+them. The same requests are sent with and without a stop sequence matching
+early in the answer: with the stop sequence the upstream stream is closed as
+soon as it matches, instead of being read until its end.
+
+Usage:
+
+    python benchmarks/stop_sequences.py --requests 20 --tokens 256 --delay 0.005
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+MOCK_PORT = 8182
+# Matches the 7th token of the answers of the mock backend
+STOP = " consectetur"
+
+
+async def bench(engine: str, stop: bool, args):
+    # pylint: disable=import-outside-toplevel
+    from llm_repl.llms import LLMS
+    from llm_repl.repls import BaseClientHandler
+
+    class CountingClientHandler(BaseClientHandler):
+        """Client handler that only collects the tokens it receives"""
+
+        start_token = "[START]"
+        end_token = "[DONE]"
+
+        async def start(self, llm_name, **llm_kwargs):
+            pass
+
+        async def print_loop(self):
+            pass
+
+    handler = CountingClientHandler()
+    if stop:
+        handler.setup_pipeline([STOP])
+    llm = LLMS[args.llm].load(handler, engine=engine)
+    latencies = []
+    for i in range(args.requests):
+        llm.session.trim(0)
+        start = time.perf_counter()
+        await llm.process(f"Message number {i}")
+        latencies.append(time.perf_counter() - start)
+    n_tokens = handler.tokens.qsize()
+    latencies.sort()
+    print(
+        f"{engine:>10} | stop {'yes' if stop else 'no ':>3} | "
+        f"p50 {latencies[len(latencies) // 2] * 1000:8.2f} ms | "
+        f"{n_tokens / args.requests:6.1f} chunks/answer"
+    )
+
+
+async def main(args):
+    for engine in ("langchain", "direct"):
+        for stop in (False, True):
+            await bench(engine, stop, args)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+    parser = argparse.ArgumentParser(description="Stop sequences benchmark")
+    parser.add_argument("--llm", type=str, default="chatgpt")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--tokens", type=int, default=256)
+    parser.add_argument("--delay", type=float, default=0.005)
+    args = parser.parse_args()
+
+    mock = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(__file__), "mock_openai.py"),
+            "--port",
+            str(MOCK_PORT),
+            "--tokens",
+            str(args.tokens),
+            "--delay",
+            str(args.delay),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{MOCK_PORT}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "sk-mock")
+    try:
+        time.sleep(1)
+        asyncio.run(main(args))
+    finally:
+        mock.terminate()
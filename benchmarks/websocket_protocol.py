@@ -0,0 +1,133 @@
+"""
+Compare the throughput of the websocket protocols.
+
+It starts the websocket REPL against the mock OpenAI backend and, for each
+protocol (legacy plain text and the framed JSON/msgpack subprotocols, with
+and without permessage-deflate), runs concurrent clients sending messages
+and reports the tokens and frames received per second and the bytes
+received on the wire (after compression) per token.
+
+Usage:
+
+    python benchmarks/websocket_protocol.py --clients 50 --messages 10 --tokens 256
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import websockets
+
+from websockets.asyncio.client import ClientConnection
+
+from mock_openai import MockOpenAI
+
+try:
+    import msgpack  # type: ignore
+except ImportError:
+    msgpack = None
+
+# Type code of the end messages of the framed protocol
+FRAME_END = 2
+
+
+class MeteredConnection(ClientConnection):
+    """
+    Client connection counting the bytes received on the wire
+    """
+
+    wire_bytes = 0
+
+    def data_received(self, data: bytes):
+        self.wire_bytes += len(data)
+        super().data_received(data)
+
+
+async def client(uri: str, subprotocol: str | None, compression: bool, n_messages: int):
+    """
+    Send the messages and return the number of frames and of bytes received
+    on the wire
+    """
+    n_frames = 0
+    async with websockets.connect(
+        uri,
+        subprotocols=[subprotocol] if subprotocol else None,
+        compression="deflate" if compression else None,
+        max_size=None,
+        create_connection=MeteredConnection,
+    ) as websocket:
+        # Leave the handshake out
+        handshake_bytes = websocket.wire_bytes
+        for i in range(n_messages):
+            await websocket.send(f"Message number {i}")
+            while True:
+                frame = await websocket.recv()
+                n_frames += 1
+                if subprotocol is None:
+                    if frame == "EOF":
+                        break
+                    continue
+                message = (
+                    msgpack.unpackb(frame)
+                    if isinstance(frame, bytes)
+                    else json.loads(frame)
+                )
+                # The end message follows the errors too
+                if message[0] == FRAME_END:
+                    break
+        n_bytes = websocket.wire_bytes - handshake_bytes
+    return n_frames, n_bytes
+
+
+async def bench(port: int, subprotocol: str | None, compression: bool, args):
+    uri = f"ws://localhost:{port}"
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(
+            client(uri, subprotocol, compression, args.messages)
+            for _ in range(args.clients)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    n_frames = sum(frames for frames, _ in results)
+    n_bytes = sum(n for _, n in results)
+    n_tokens = args.clients * args.messages * args.tokens
+    print(
+        f"{subprotocol or 'legacy':>20} | deflate: {str(compression):>5} | "
+        f"{n_tokens / elapsed:10.1f} tokens/s | {n_frames / elapsed:10.1f} frames/s | "
+        f"{n_frames and n_tokens / n_frames:6.2f} tokens/frame | "
+        f"{n_bytes / n_tokens:6.2f} wire bytes/token"
+    )
+
+
+async def main(args):
+    # pylint: disable=import-outside-toplevel
+    mock = MockOpenAI(n_tokens=args.tokens)
+    mock_port = await mock.start()
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{mock_port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "sk-mock")
+
+    from llm_repl.repls.websocket import WebsocketREPL, SUBPROTOCOLS
+
+    for compression in (False, True):
+        repl = WebsocketREPL(port=args.port, compression=compression)
+        server = asyncio.create_task(repl.run(args.llm))
+        await asyncio.sleep(0.5)
+        for subprotocol in [None] + SUBPROTOCOLS:
+            await bench(args.port, subprotocol, compression, args)
+        server.cancel()
+        await asyncio.sleep(0.5)
+    await mock.stop()
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+    parser = argparse.ArgumentParser(description="Websocket protocol benchmark")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--llm", type=str, default="chatgpt")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--tokens", type=int, default=256)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,145 @@
+"""
+Check that the websocket REPL frees the clients that go away.
+
+It starts the websocket REPL against the mock OpenAI backend (streaming
+slowly, so that the clients disconnect in the middle of the answers) and:
+
+- runs waves of clients that send a message and disconnect after the first
+  frame, reporting the live sessions, tasks, client handlers and RSS after
+  each wave, which must not grow;
+- connects more clients than `--max-clients` and reports how many were
+  rejected with the 1013 (try again later) close code;
+- leaves clients idle and reports how many were disconnected by the reaper.
+
+Usage:
+
+    python benchmarks/websocket_supervisor.py --waves 5 --clients 200
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import time
+import urllib.request
+
+import websockets
+
+from mock_openai import MockOpenAI
+from session_memory import rss_bytes
+
+
+async def disconnecting_client(uri: str):
+    """Send a message and disconnect after the first frame of the answer"""
+    async with websockets.connect(uri) as websocket:
+        await websocket.send("Hello!")
+        await websocket.recv()
+
+
+async def holding_client(uri: str, ready: list, total: int, release: asyncio.Event):
+    """
+    Stay connected until all the clients are either connected or rejected and
+    return the close code of the connection, if closed
+    """
+    async with websockets.connect(uri) as websocket:
+        try:
+            await asyncio.wait_for(websocket.wait_closed(), 0.2)
+        except asyncio.TimeoutError:
+            pass
+        ready.append(websocket)
+        if len(ready) == total:
+            release.set()
+        await release.wait()
+        return websocket.close_code
+
+
+async def idle_client(uri: str, timeout: float) -> int | None:
+    """Stay idle and return the close code of the connection, if closed"""
+    try:
+        async with websockets.connect(uri) as websocket:
+            await asyncio.wait_for(websocket.wait_closed(), timeout)
+            return websocket.close_code
+    except asyncio.TimeoutError:
+        return None
+
+
+def live_handlers() -> int:
+    # pylint: disable=import-outside-toplevel
+    from llm_repl.repls.websocket import WebsocketClientHandler
+
+    gc.collect()
+    return sum(isinstance(obj, WebsocketClientHandler) for obj in gc.get_objects())
+
+
+def get_stats(port: int):
+    with urllib.request.urlopen(f"http://localhost:{port}/stats") as resp:
+        return json.loads(resp.read())
+
+
+async def main(args):
+    # pylint: disable=import-outside-toplevel
+    mock = MockOpenAI(n_tokens=256, delay=0.01)
+    mock_port = await mock.start()
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{mock_port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "sk-mock")
+
+    from llm_repl.repls.websocket import WebsocketREPL
+
+    uri = f"ws://localhost:{args.port}"
+    repl = WebsocketREPL(
+        port=args.port, max_clients=args.max_clients, idle_ttl=args.idle_ttl
+    )
+    server = asyncio.create_task(repl.run(args.llm, engine=args.engine))
+    await asyncio.sleep(0.5)
+
+    baseline = rss_bytes()
+    for wave in range(args.waves):
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(disconnecting_client(uri) for _ in range(args.clients)),
+            return_exceptions=True,
+        )
+        # Let the server notice the closed connections
+        await asyncio.sleep(0.5)
+        stats = await asyncio.to_thread(get_stats, args.port)
+        print(
+            f"wave {wave} | {time.perf_counter() - start:6.2f} s | "
+            f"sessions {stats['sessions']:4d} | tasks {stats['tasks']:4d} | "
+            f"loop tasks {stats['loop_tasks']:4d} | handlers {live_handlers():4d} | "
+            f"RSS +{(rss_bytes() - baseline) / 2**20:7.2f} MiB"
+        )
+
+    total = args.max_clients + 10
+    release = asyncio.Event()
+    ready: list = []
+    codes = await asyncio.gather(
+        *(holding_client(uri, ready, total, release) for _ in range(total))
+    )
+    print(f"cap: {codes.count(1013)} rejected of {len(codes)} clients")
+
+    # Let the server release the clients of the cap test
+    await asyncio.sleep(0.5)
+    codes = await asyncio.gather(
+        *(idle_client(uri, args.idle_ttl * 3) for _ in range(10))
+    )
+    print(f"reaper: {codes.count(1001)} idle clients disconnected of {len(codes)}")
+    stats = await asyncio.to_thread(get_stats, args.port)
+    print(json.dumps({k: v for k, v in stats.items() if k != "per_session"}))
+
+    server.cancel()
+    await asyncio.sleep(0.5)
+    await mock.stop()
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+    parser = argparse.ArgumentParser(description="Websocket supervisor benchmark")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--llm", type=str, default="chatgpt")
+    parser.add_argument("--engine", type=str, default="direct")
+    parser.add_argument("--waves", type=int, default=5)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--max-clients", type=int, default=250)
+    parser.add_argument("--idle-ttl", type=float, default=1.0)
+    asyncio.run(main(parser.parse_args()))
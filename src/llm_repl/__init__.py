@@ -1,21 +1,26 @@
 import os
-import importlib.util
+import importlib
 
 LLMS_DIR = os.path.join(os.path.dirname(__file__), "llms")
 REPLS_DIR = os.path.join(os.path.dirname(__file__), "repls")
+# Where the REPL persists its state (memories, histories, ...)
+STATE_DIR = os.getenv(
+    "LLM_REPL_HOME", os.path.join(os.path.expanduser("~"), ".llm_repl")
+)
 
 
 def load_modules_from_directory(path):
     for root, _, files in os.walk(path):
         for file in files:
             if file.endswith(".py") and not file.startswith("__init__"):
-                module_name = file[:-3]
                 module_path = os.path.join(root, file)
+                # Import the module with its qualified name, so that modules
+                # importing each other share the same instance
+                relative_path = os.path.relpath(module_path, os.path.dirname(__file__))
+                module_name = ".".join([__name__] + relative_path[:-3].split(os.sep))
 
                 # Load the module
-                spec = importlib.util.spec_from_file_location(module_name, module_path)  # type: ignore
-                module = importlib.util.module_from_spec(spec)  # type: ignore
-                spec.loader.exec_module(module)
+                importlib.import_module(module_name)
 
 
 load_modules_from_directory(LLMS_DIR)
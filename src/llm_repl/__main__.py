@@ -1,8 +1,29 @@
-import asyncio
 import argparse
+import logging
 
-from llm_repl.repls import REPLS
-from llm_repl.llms import LLMS
+from llm_repl import exceptions, runtime
+from llm_repl.openai_client import close_shared_clients
+from llm_repl.repls import REPLS, BaseREPL
+from llm_repl.llms import LLMS, ENGINES, MEMORY_MODES
+from llm_repl.watchdog import LoopWatchdog
+
+
+async def run(repl: BaseREPL, args: argparse.Namespace, **llm_kwargs):
+    """
+    Run the REPL, under the event loop watchdog if requested, and close the
+    connections to the upstream APIs when it stops
+    """
+    watchdog = None
+    if args.watchdog:
+        logging.basicConfig(level=logging.INFO)
+        watchdog = LoopWatchdog(threshold=args.watchdog_threshold / 1000)
+        watchdog.start()
+    try:
+        await repl.run(args.llm, **llm_kwargs)
+    finally:
+        await close_shared_clients()
+        if watchdog is not None:
+            watchdog.stop()
 
 
 def main():
@@ -25,7 +46,162 @@ def main():
         "--port", type=int, help="The port to connect to the LLM server", default=8000
     )
 
+    parser.add_argument(
+        "--memory",
+        type=str,
+        default="buffer",
+        help="How the LLM remembers the conversation: the whole history (buffer) "
+        "or the relevant past exchanges retrieved from a local vector index "
+        "(vector) (DEFAULT: buffer)",
+        choices=MEMORY_MODES,
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="langchain",
+        help="How the LLM talks to the upstream API: through LangChain (langchain) "
+        "or with a lean streaming client (direct) (DEFAULT: langchain)",
+        choices=ENGINES,
+    )
+    parser.add_argument(
+        "--record",
+        type=str,
+        default=None,
+        help="Record the upstream streams as cassettes in the given directory",
+    )
+    parser.add_argument(
+        "--cassettes",
+        type=str,
+        default=None,
+        help="Directory of the cassettes replayed by the replay LLM",
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1.0,
+        help="Speed factor of the replayed streams, 0 to replay them without "
+        "delays (DEFAULT: 1.0)",
+    )
+    parser.add_argument(
+        "--stop",
+        type=str,
+        action="append",
+        default=None,
+        help="Stop the answers as soon as they contain the sequence, can be "
+        "repeated",
+    )
+    parser.add_argument(
+        "--redact",
+        type=str,
+        action="append",
+        default=None,
+        metavar="REGEX",
+        help="Redact the matches of the regular expression from the answers, "
+        "can be repeated",
+    )
+    parser.add_argument(
+        "--router-rules",
+        type=str,
+        default=None,
+        help="Path to the yaml file of the routing rules of the router LLM",
+    )
+    parser.add_argument(
+        "--router-log-prompts",
+        action="store_true",
+        help="Log the prompts with the decisions of the router LLM, instead of "
+        "their hash and length (or set LLM_REPL_ROUTER_LOG_PROMPTS=1)",
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        default=None,
+        metavar="SESSION",
+        help="Resume a conversation of the terminal REPL, with the ID printed "
+        "when it was closed",
+    )
+    parser.add_argument(
+        "--history",
+        type=str,
+        default=None,
+        metavar="FILE",
+        help="Database of the prompt history of the terminal REPL "
+        "(DEFAULT: $LLM_REPL_HISTORY or ~/.llm_repl/history.sqlite3)",
+    )
+    parser.add_argument(
+        "--max-clients",
+        type=int,
+        default=None,
+        help="Maximum number of clients served at once by the websocket REPL, "
+        "the others are rejected, 0 for no limit (DEFAULT: no limit, the "
+        "clients are only bounded by the open files limit of the process)",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=None,
+        help="Seconds of inactivity after which the websocket REPL disconnects "
+        "a client, 0 to never disconnect them (DEFAULT: 600)",
+    )
+    parser.add_argument(
+        "--loop",
+        type=str,
+        default="asyncio",
+        help="The event loop implementation: the stdlib one (asyncio) or uvloop, "
+        "faster for the server REPLs (DEFAULT: asyncio)",
+        choices=runtime.LOOPS,
+    )
+    parser.add_argument(
+        "--no-eager-tasks",
+        action="store_true",
+        help="Don't start the tasks eagerly (only done on Python 3.12+)",
+    )
+    parser.add_argument(
+        "--executor-workers",
+        type=int,
+        default=None,
+        help="Number of threads running the blocking work offloaded by the "
+        "REPLs, like loading the LLMs (DEFAULT: CPUs + 4, at most 32)",
+    )
+    parser.add_argument(
+        "--watchdog",
+        action="store_true",
+        help="Log the event loop stalls and the code causing them",
+    )
+    parser.add_argument(
+        "--watchdog-threshold",
+        type=float,
+        default=100,
+        help="Event loop lag (in ms) reported as a stall (DEFAULT: 100)",
+    )
+
     args = parser.parse_args()
+    try:
+        runtime.loop_factory(args.loop)
+    except exceptions.MissingDependency as e:
+        parser.error(e.msg)
 
-    repl = REPLS[args.repl](port=args.port)
-    asyncio.get_event_loop().run_until_complete(repl.run(args.llm))
+    llm_kwargs = {
+        "memory": args.memory,
+        "engine": args.engine,
+        "record": args.record,
+        "cassettes": args.cassettes,
+        "replay_speed": args.replay_speed,
+        "resume": args.resume,
+        "router_rules": args.router_rules,
+        "router_log_prompts": args.router_log_prompts,
+        "stop": args.stop,
+        "redact": args.redact,
+    }
+
+    repl = REPLS[args.repl](
+        port=args.port,
+        max_clients=args.max_clients,
+        idle_ttl=args.idle_timeout,
+        history_path=args.history,
+    )
+    runtime.run(
+        run(repl, args, **llm_kwargs),
+        loop=args.loop,
+        eager_tasks=not args.no_eager_tasks,
+        executor_workers=args.executor_workers,
+    )
@@ -0,0 +1,165 @@
+"""
+Cassettes of upstream chat streams.
+
+A cassette records the tokens streamed by the upstream API for a request,
+with the delay before each token, so that the stream can be replayed later
+with the same (or scaled) timing and without any network access.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import time
+
+from typing import Dict, List
+
+
+def request_hash(model: str, messages: List[Dict[str, str]]) -> str:
+    """
+    Return the hash identifying a chat completion request
+
+    :param str model: The name of the model
+    :param list messages: The messages of the request
+    """
+    payload = json.dumps({"model": model, "messages": messages}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class Cassette:
+    """
+    The recording of a single upstream stream
+
+    :param str request_hash: The hash of the request
+    :param str model: The name of the model
+    :param list tokens: The tokens of the stream
+    :param list delays: The seconds elapsed before each token (since the
+                        request for the first one, since the previous token
+                        for the others)
+    """
+
+    def __init__(
+        self,
+        request_hash: str,  # pylint: disable=redefined-outer-name
+        model: str,
+        tokens: List[str] | None = None,
+        delays: List[float] | None = None,
+    ):
+        self.request_hash = request_hash
+        self.model = model
+        self.tokens = tokens if tokens is not None else []
+        self.delays = delays if delays is not None else []
+
+    @classmethod
+    def load(cls, path: str) -> Cassette:
+        with open(path, "r") as f:
+            content = json.load(f)
+        return cls(
+            content["request_hash"],
+            content["model"],
+            content["tokens"],
+            content["delays"],
+        )
+
+    def save(self, directory: str):
+        """
+        Save the cassette in the given directory
+
+        :param str directory: The directory of the cassettes
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.request_hash}.json")
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "request_hash": self.request_hash,
+                    "model": self.model,
+                    "tokens": self.tokens,
+                    "delays": [round(delay, 6) for delay in self.delays],
+                },
+                f,
+            )
+
+
+class CassetteRecorder:
+    """
+    Records a stream into a cassette
+
+    :param str directory: The directory where the cassette is saved
+    :param str model: The name of the model
+    :param list messages: The messages of the request
+    """
+
+    def __init__(self, directory: str, model: str, messages: List[Dict[str, str]]):
+        self.directory = directory
+        self.cassette = Cassette(request_hash(model, messages), model)
+        self.last_event = time.perf_counter()
+
+    def record(self, token: str):
+        """
+        Record a token of the stream
+
+        :param str token: The token
+        """
+        now = time.perf_counter()
+        self.cassette.tokens.append(token)
+        self.cassette.delays.append(now - self.last_event)
+        self.last_event = now
+
+    def finish(self):
+        """
+        Save the recorded cassette
+        """
+        self.cassette.save(self.directory)
+
+
+class CassetteLibrary:
+    """
+    The cassettes stored in a directory
+
+    :param str directory: The directory of the cassettes
+    :param bool strict: If False, requests without a cassette are served
+                        with the other cassettes, in turn
+    """
+
+    def __init__(self, directory: str, strict: bool = False):
+        self.directory = directory
+        self.strict = strict
+        self.hashes = sorted(
+            name[: -len(".json")]
+            for name in os.listdir(directory)
+            if name.endswith(".json")
+        )
+        self.cache: Dict[str, Cassette] = {}
+        self._next = 0
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    @property
+    def model(self) -> str | None:
+        """Return the model of the cassettes (of the first one), if any"""
+        return self._load(self.hashes[0]).model if self.hashes else None
+
+    def _load(self, hash_: str) -> Cassette:
+        if hash_ not in self.cache:
+            self.cache[hash_] = Cassette.load(
+                os.path.join(self.directory, f"{hash_}.json")
+            )
+        return self.cache[hash_]
+
+    def find(self, model: str, messages: List[Dict[str, str]]) -> Cassette | None:
+        """
+        Return the cassette of the request
+
+        :param str model: The name of the model
+        :param list messages: The messages of the request
+        """
+        hash_ = request_hash(model, messages)
+        if hash_ in self.hashes:
+            return self._load(hash_)
+        if self.strict or not self.hashes:
+            return None
+        hash_ = self.hashes[self._next % len(self.hashes)]
+        self._next += 1
+        return self._load(hash_)
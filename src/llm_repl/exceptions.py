@@ -23,3 +23,35 @@ class MissingAPIKey(LLMException):
         super().__init__(
             f"{msg} not found, please set it in your environment variables."
         )
+
+
+class MissingDependency(LLMException):
+    """Exception raised when an optional dependency of an LLM is missing."""
+
+    def __init__(self, package: str, extra: str):
+        super().__init__(
+            f"{package} not installed, please install it with 'pip install llm-repl[{extra}]'."
+        )
+
+
+class StreamStopped(LLMException):
+    """
+    Exception raised by the client handler when its pipeline stopped the
+    stream (e.g. a stop sequence was generated), so that the LLM closes the
+    upstream stream.
+    """
+
+    def __init__(self, output: str):
+        self.output = output
+        super().__init__("The stream was stopped by the client handler.")
+
+
+# -------------------- REPLS EXCEPTIONS --------------------
+
+
+class TooManyClients(Exception):
+    """Exception raised when a REPL already serves the maximum number of clients."""
+
+    def __init__(self, max_clients: int):
+        self.msg = f"Too many clients (max {max_clients}), try again later."
+        super().__init__(self.msg)
@@ -0,0 +1,177 @@
+"""
+Persistent prompt history of the prompt_toolkit REPL.
+
+The prompts are stored in a SQLite database with a full text search index,
+so that the whole history can be searched in milliseconds while only the
+most recent prompts are loaded when the REPL starts.
+"""
+from __future__ import annotations
+
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+from typing import Iterable, List
+
+from prompt_toolkit.completion import Completer, Completion
+from prompt_toolkit.document import Document
+from prompt_toolkit.history import History
+
+from llm_repl import STATE_DIR
+
+DEFAULT_HISTORY_PATH = os.getenv(
+    "LLM_REPL_HISTORY", os.path.join(STATE_DIR, "history.sqlite3")
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+    text, content='history', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS history_insert AFTER INSERT ON history BEGIN
+    INSERT INTO history_fts(rowid, text) VALUES (new.id, new.text);
+END;
+"""
+
+
+class SQLiteHistory(History):
+    """
+    prompt_toolkit history stored in SQLite.
+
+    Only the RECENT_ENTRIES most recent prompts are loaded for the up/down
+    navigation, the older ones are reachable through `search`. New prompts
+    are written by a background thread so that the prompt never waits for
+    the disk.
+
+    :param str path: Path of the database
+    """
+
+    RECENT_ENTRIES = 1000
+    # Sentinel asking the writer thread to stop
+    _STOP = object()
+
+    def __init__(self, path: str = DEFAULT_HISTORY_PATH):
+        super().__init__()
+        self.path = path
+        directory = os.path.dirname(path)
+        # A bare file name is relative to the current directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The connection is shared by the prompt and the completion threads
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(SCHEMA)
+        self._writes: queue.SimpleQueue = queue.SimpleQueue()
+        self._writer = threading.Thread(
+            target=self._write_loop, name="llm-repl-history", daemon=True
+        )
+        self._writer.start()
+
+    def load_history_strings(self) -> Iterable[str]:
+        """
+        Return the most recent prompts, most recent first
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT text FROM history ORDER BY id DESC LIMIT ?",
+                (self.RECENT_ENTRIES,),
+            ).fetchall()
+        return [text for (text,) in rows]
+
+    def store_string(self, string: str):
+        """
+        Queue the prompt to be appended to the database
+
+        :param str string: The prompt
+        """
+        self._writes.put(string)
+
+    def _write_loop(self):
+        while True:
+            # Write all the pending prompts in a single transaction
+            strings = [self._writes.get()]
+            while not self._writes.empty():
+                strings.append(self._writes.get())
+            stop = self._STOP in strings
+            now = time.time()
+            with self._lock:
+                with self._conn:
+                    self._conn.executemany(
+                        "INSERT INTO history (text, created_at) VALUES (?, ?)",
+                        [
+                            (string, now)
+                            for string in strings
+                            if string is not self._STOP
+                        ],
+                    )
+            if stop:
+                return
+
+    def close(self):
+        """
+        Wait for the pending prompts to be written and close the database
+        """
+        self._writes.put(self._STOP)
+        self._writer.join()
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _fts_query(query: str) -> str:
+        """
+        Build the full text search query matching all the words of the query
+        as prefixes
+        """
+        words = re.findall(r"\w+", query)
+        return " ".join(f'"{word}"*' for word in words)
+
+    def search(self, query: str, limit: int = 20) -> List[str]:
+        """
+        Return the distinct prompts matching all the words of the query, most
+        recent first
+
+        :param str query: The words to search
+        :param int limit: The maximum number of prompts to return
+        """
+        fts_query = self._fts_query(query)
+        with self._lock:
+            if fts_query:
+                rows = self._conn.execute(
+                    "SELECT text FROM history_fts WHERE history_fts MATCH ? "
+                    "ORDER BY rowid DESC LIMIT ?",
+                    (fts_query, limit * 4),
+                ).fetchall()
+            else:
+                rows = self._conn.execute(
+                    "SELECT text FROM history ORDER BY id DESC LIMIT ?",
+                    (limit * 4,),
+                ).fetchall()
+        return list(dict.fromkeys(text for (text,) in rows))[:limit]
+
+
+class HistorySearchCompleter(Completer):
+    """
+    Completer suggesting the prompts of the history matching the text typed
+    so far. Selecting a suggestion replaces the whole prompt.
+
+    :param SQLiteHistory history: The history to search
+    """
+
+    def __init__(self, history: SQLiteHistory):
+        self.history = history
+
+    def get_completions(self, document: Document, complete_event):
+        for text in self.history.search(document.text):
+            yield Completion(
+                text,
+                start_position=-len(document.text_before_cursor),
+                display=text.replace("\n", " ")[:80],
+            )
@@ -0,0 +1,274 @@
+"""
+Persistent conversation journal, to resume the sessions later.
+
+Every turn of a session is appended to a compact binary journal as soon as
+it completes, by a writer thread so that the event loop never waits for the
+disk. Every SNAPSHOT_EVERY turns the journal is compacted into a snapshot and
+truncated, so that resuming a session only has to map the snapshot in memory
+and replay the few turns appended after it.
+"""
+from __future__ import annotations
+
+import mmap
+import os
+import queue
+import re
+import struct
+import threading
+
+from array import array
+from typing import BinaryIO, List, Tuple
+
+from llm_repl import STATE_DIR
+from llm_repl.llms import ChatSession
+
+SESSIONS_DIR = os.path.join(STATE_DIR, "sessions")
+
+# Journal record: role, length of the content, then the UTF-8 content
+RECORD_HEADER = struct.Struct("<BI")
+# Snapshot: magic, number of turns, journal offset covered by the snapshot,
+# then the roles, the offsets of the contents and the UTF-8 contents
+SNAPSHOT_HEADER = struct.Struct("<8sQQ")
+SNAPSHOT_MAGIC = b"LLMSNAP1"
+
+
+def valid_session_id(session_id: str) -> bool:
+    """
+    Return whether the session ID can be safely used as a directory name
+
+    :param str session_id: The ID of the session
+    """
+    return re.fullmatch(r"[\w-]+", session_id) is not None
+
+
+class SessionJournal:
+    """
+    The journal and the snapshot of a session
+
+    :param str session_id: The ID of the session
+    :param str directory: The directory of the sessions
+    """
+
+    SNAPSHOT_EVERY = 100
+
+    def __init__(self, session_id: str, directory: str = SESSIONS_DIR):
+        if not valid_session_id(session_id):
+            raise ValueError(f"Invalid session ID '{session_id}'")
+        self.session_id = session_id
+        self.path = os.path.join(directory, session_id)
+        self.journal_path = os.path.join(self.path, "journal.bin")
+        self.snapshot_path = os.path.join(self.path, "snapshot.bin")
+        self._file: BinaryIO | None = None
+        # Turns appended since the last snapshot
+        self._pending = 0
+        # Records waiting for the writer thread, None stops the thread
+        self._records: queue.SimpleQueue[bytes | None] = queue.SimpleQueue()
+        self._writer: threading.Thread | None = None
+
+    @classmethod
+    def exists(cls, session_id: str, directory: str = SESSIONS_DIR) -> bool:
+        """
+        Return whether a journal was recorded for the session
+
+        :param str session_id: The ID of the session
+        :param str directory: The directory of the sessions
+        """
+        return valid_session_id(session_id) and os.path.isfile(
+            os.path.join(directory, session_id, "journal.bin")
+        )
+
+    def _read_snapshot(self) -> Tuple[bytearray, List[str], int]:
+        """
+        Map the snapshot in memory and return its roles, its contents and the
+        journal offset it covers
+        """
+        if not os.path.isfile(self.snapshot_path):
+            return bytearray(), [], 0
+        with open(self.snapshot_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+                magic, turns, journal_offset = SNAPSHOT_HEADER.unpack_from(snapshot)
+                if magic != SNAPSHOT_MAGIC:
+                    return bytearray(), [], 0
+                start = SNAPSHOT_HEADER.size
+                roles = bytearray(snapshot[start : start + turns])
+                start += turns
+                offsets = array("Q")
+                offsets.frombytes(snapshot[start : start + (turns + 1) * 8])
+                start += (turns + 1) * 8
+                contents = [
+                    snapshot[start + offsets[i] : start + offsets[i + 1]].decode()
+                    for i in range(turns)
+                ]
+        return roles, contents, journal_offset
+
+    def _replay(
+        self, roles: bytearray, contents: List[str], offset: int
+    ) -> Tuple[bytearray, List[str], int]:
+        """
+        Append the turns of the journal following the offset, and return the
+        end of the last complete record
+        """
+        if not os.path.isfile(self.journal_path):
+            return roles, contents, 0
+        with open(self.journal_path, "rb") as f:
+            f.seek(offset)
+            tail = f.read()
+        position = 0
+        while position + RECORD_HEADER.size <= len(tail):
+            role, length = RECORD_HEADER.unpack_from(tail, position)
+            end = position + RECORD_HEADER.size + length
+            # The last record was not written completely
+            if end > len(tail):
+                break
+            roles.append(role)
+            contents.append(tail[position + RECORD_HEADER.size : end].decode())
+            position = end
+        return roles, contents, offset + position
+
+    def read(self) -> List[Tuple[int, str]]:
+        """
+        Return all the turns of the session as (role, content) tuples
+        """
+        roles, contents, _ = self._replay(*self._read_snapshot())
+        return list(zip(roles, contents))
+
+    def load(self) -> ChatSession:
+        """
+        Rebuild the session from the snapshot and the journal, and open the
+        journal to record the new turns
+        """
+        roles, contents, offset = self._read_snapshot()
+        journal_size = (
+            os.path.getsize(self.journal_path)
+            if os.path.isfile(self.journal_path)
+            else 0
+        )
+        if offset > journal_size:
+            # The journal was truncated after the snapshot but the snapshot
+            # was not updated yet: it covers the whole journal
+            self._set_snapshot_offset(0)
+            offset = 0
+        roles, contents, end = self._replay(roles, contents, offset)
+        session = ChatSession()
+        for role, content in zip(roles, contents):
+            session.append(role, content)
+        os.makedirs(self.path, exist_ok=True)
+        self._file = open(self.journal_path, "ab")
+        # Drop the record that was not written completely, if any
+        self._file.truncate(end)
+        self._writer = threading.Thread(
+            target=self._write_records, name="llm-repl-journal", daemon=True
+        )
+        self._writer.start()
+        session.journal = self
+        return session
+
+    def record(self, role: int, content: str):
+        """
+        Queue a turn to be appended to the journal
+
+        :param int role: The role of the turn
+        :param str content: The content of the turn
+        """
+        if self._file is None:
+            return
+        data = content.encode()
+        self._records.put(RECORD_HEADER.pack(role, len(data)) + data)
+
+    def _write_records(self):
+        """
+        Append the queued records to the journal, and take a snapshot every
+        SNAPSHOT_EVERY turns
+        """
+        while True:
+            records = [self._records.get()]
+            # Write all the records queued meanwhile at once
+            while True:
+                try:
+                    records.append(self._records.get_nowait())
+                except queue.Empty:
+                    break
+            data = [record for record in records if record is not None]
+            self._file.writelines(data)  # type: ignore
+            self._file.flush()  # type: ignore
+            self._pending += len(data)
+            if self._pending >= self.SNAPSHOT_EVERY:
+                self._pending = 0
+                try:
+                    self.snapshot()
+                except OSError:
+                    # Keep recording, the journal is compacted at the next
+                    # snapshot
+                    pass
+            if len(data) < len(records):
+                return
+
+    def snapshot(self):
+        """
+        Compact the snapshot and the journal into a new snapshot, then
+        truncate the journal.
+
+        Called by the writer thread, so that no record is appended meanwhile.
+        """
+        roles, contents, journal_offset = self._replay(*self._read_snapshot())
+        blobs = [content.encode() for content in contents]
+        offsets = array("Q", [0])
+        for blob in blobs:
+            offsets.append(offsets[-1] + len(blob))
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(roles), journal_offset))
+            f.write(roles)
+            f.write(offsets.tobytes())
+            f.writelines(blobs)
+            f.flush()
+            os.fsync(f.fileno())
+        # Atomically replace the previous snapshot
+        os.replace(tmp_path, self.snapshot_path)
+        self._fsync_dir()
+        # The snapshot covers the whole journal: truncate it, then point the
+        # snapshot to its beginning. If interrupted in between, the snapshot
+        # points past the end of the journal, which load() detects.
+        if self._file is not None:
+            self._file.truncate(0)
+            os.fsync(self._file.fileno())
+        elif os.path.isfile(self.journal_path):
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(0)
+                os.fsync(f.fileno())
+        self._set_snapshot_offset(0)
+
+    def _set_snapshot_offset(self, journal_offset: int):
+        """
+        Overwrite the journal offset covered by the snapshot
+        """
+        with open(self.snapshot_path, "r+b") as f:
+            f.seek(SNAPSHOT_HEADER.size - 8)
+            f.write(struct.pack("<Q", journal_offset))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _fsync_dir(self):
+        """
+        Make the renames in the directory of the session durable
+        """
+        if not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(self.path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        """
+        Write the queued records, wait for the snapshot in progress, if any,
+        and close the journal
+        """
+        if self._writer is not None:
+            self._records.put(None)
+            self._writer.join()
+            self._writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file: BinaryIO | None = None
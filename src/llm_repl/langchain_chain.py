@@ -0,0 +1,136 @@
+"""
+The LangChain engine of ChatGPT.
+
+Importing LangChain takes most of the startup time of the REPL, this module
+is only imported when the LangChain engine is used, so that the cost is paid
+while the LLM loads instead of before the prompt is shown.
+"""
+from __future__ import annotations
+
+import logging
+from functools import lru_cache
+from uuid import UUID
+
+from typing import Callable, Dict, Any, List, Tuple
+
+from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.chat_models import ChatOpenAI
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.prompts import (
+    ChatPromptTemplate,
+    MessagesPlaceholder,
+    SystemMessagePromptTemplate,
+    HumanMessagePromptTemplate,
+)
+from langchain.chains import LLMChain
+from langchain.schema.messages import AIMessage, BaseMessage, HumanMessage
+
+from llm_repl.repls import BaseClientHandler
+
+
+class StreamStoppedFilter(logging.Filter):
+    """Hide the LangChain warnings about the streams stopped on purpose"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return "The stream was stopped by the client handler" not in record.getMessage()
+
+
+logging.getLogger("langchain.callbacks.manager").addFilter(StreamStoppedFilter())
+
+
+class AsyncChatGPTStreamingCallbackHandler(AsyncCallbackHandler):
+    """Callback handler for streaming. Only works with LLMs that support streaming."""
+
+    # Let the exceptions.StreamStopped raised by the client handler abort
+    # the generation
+    raise_error = True
+
+    def __init__(
+        self,
+        client_handler: BaseClientHandler,
+        is_in_streaming_mode: bool,
+        on_token: Callable[[str], None] | None = None,
+    ) -> None:
+        super().__init__()
+        self.is_in_streaming_mode = is_in_streaming_mode
+        self.client_handler = client_handler
+        self.on_token = on_token
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any):
+        """Run on new LLM token. Only available when streaming is enabled."""
+        if self.on_token is not None:
+            self.on_token(token)
+        await self.client_handler.add_token(token)
+
+    async def on_llm_end(self, response, **kwargs: Any) -> None:
+        if self.is_in_streaming_mode:
+            await self.client_handler.add_token(self.client_handler.end_token)
+
+    async def on_chat_model_start(
+        self,
+        serialized: Dict[str, Any],
+        messages: List[List[BaseMessage]],
+        *,
+        run_id: UUID,
+        parent_run_id: UUID | None = None,
+        tags: List[str] | None = None,
+        metadata: Dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> Any:
+        if self.is_in_streaming_mode:
+            await self.client_handler.add_token(self.client_handler.start_token)
+
+
+@lru_cache(maxsize=None)
+def get_shared_chain(
+    api_key: str, model_name: str, system_prompt: str, streaming: bool
+) -> LLMChain:
+    """
+    Return the chain shared by all the sessions using the same configuration.
+
+    The chain only holds immutable state (model configuration, compiled prompt
+    and HTTP client), the conversation history and the callbacks are passed
+    on every call by the sessions.
+
+    :param str api_key: The OpenAI API key
+    :param str model_name: The name of the OpenAI model
+    :param str system_prompt: The system prompt of the personality
+    :param bool streaming: Whether to stream the tokens
+    """
+    # TODO: Make it customizable
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            SystemMessagePromptTemplate.from_template(system_prompt),
+            MessagesPlaceholder(variable_name="history"),
+            HumanMessagePromptTemplate.from_template("{input}"),
+        ]
+    )
+    llm = ChatOpenAI(
+        openai_api_key=api_key,
+        streaming=streaming,
+        verbose=True,
+        model_name=model_name,
+    )  # type: ignore
+    return LLMChain(prompt=prompt, llm=llm)
+
+
+@lru_cache(maxsize=None)
+def get_shared_embeddings(api_key: str) -> OpenAIEmbeddings:
+    """
+    Return the embeddings client shared by all the sessions
+
+    :param str api_key: The OpenAI API key
+    """
+    return OpenAIEmbeddings(openai_api_key=api_key)  # type: ignore
+
+
+def langchain_history(turns: List[Tuple[str, str]]) -> List[BaseMessage]:
+    """
+    Build the LangChain messages of the conversation history
+
+    :param list turns: The conversation history
+    """
+    return [
+        HumanMessage(content=content) if role == "user" else AIMessage(content=content)
+        for role, content in turns
+    ]
@@ -1,10 +1,22 @@
 from __future__ import annotations
 
+import os
+import sys
+
 from abc import ABC, abstractmethod
-from typing import Dict, Any, List, Type
+from array import array
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Any, List, Tuple, Type
+
+import pkg_resources  # type: ignore
+import pydantic
+import yaml
 
 from llm_repl.repls import BaseClientHandler
 
+if TYPE_CHECKING:
+    from llm_repl.journal import SessionJournal
+
 
 class BaseLLM(ABC):
     @property
@@ -31,6 +43,18 @@ class BaseLLM(ABC):
     async def process(self, msg) -> str:
         """Process the user message and return the response."""
 
+    async def warmup(self):
+        """
+        Prepare the LLM to answer its first message faster, e.g. by opening
+        the connections to the upstream API. Nothing to do by default.
+        """
+
+    async def close(self):
+        """
+        Release the resources held by the session of the LLM, when its
+        client is gone. Nothing to do by default.
+        """
+
     # FIXME: Define a proper type for the custom command
     @property
     def custom_commands(self) -> List[Any]:
@@ -38,4 +62,157 @@ class BaseLLM(ABC):
         return []
 
 
+# How the LLMs remember the conversation: the whole history ("buffer") or
+# the relevant past exchanges retrieved from a vector index ("vector")
+MEMORY_MODES = ("buffer", "vector")
+# How the LLMs talk to their upstream API: through LangChain ("langchain") or
+# with a lean streaming client ("direct")
+ENGINES = ("langchain", "direct")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap estimation of the number of tokens in a text (~4 characters per
+    token for the OpenAI tokenizers). Good enough for budgeting the history.
+
+    :param str text: The text to measure
+    """
+    return max(1, len(text) // 4)
+
+
+DATA_FOLDER = pkg_resources.resource_filename("llm_repl", "data")
+PERSONALITIES_FOLDER = os.path.join(DATA_FOLDER, "chatgpt", "personalities")
+DEFAULT_PERSONALITY = os.path.join(PERSONALITIES_FOLDER, "default.yml")
+
+
+class ChatGPTPersonality(pydantic.BaseModel):
+    """ChatGPT personality."""
+
+    description: str
+    personality: str
+    memories: List[str] | None
+
+
+@lru_cache(maxsize=None)
+def load_personality(personality_filepath: str) -> ChatGPTPersonality:
+    """
+    Load (and cache) the personality stored in the given yaml file
+
+    :param str personality_filepath: Path to the yaml file of the personality
+    """
+    with open(personality_filepath, "r") as f:
+        personality_content = yaml.safe_load(f)
+    try:
+        return ChatGPTPersonality(**personality_content)
+    except pydantic.ValidationError:
+        return ChatGPTPersonality(
+            description="Default personality", personality="", memories=None
+        )
+
+
+def load_llm_personality(llm_kwargs: Dict[str, Any]) -> ChatGPTPersonality:
+    """
+    Load the personality selected with the `personality` kwarg of an LLM, the
+    default one if it is not set or its file doesn't exist
+
+    :param dict llm_kwargs: The kwargs of the LLM
+    """
+    # Path to the yaml file containing the personality
+    personality_filepath = llm_kwargs.get("personality", None)
+    if personality_filepath is None or not os.path.isfile(personality_filepath):
+        personality_filepath = DEFAULT_PERSONALITY
+    return load_personality(personality_filepath)
+
+
+class ChatSession:
+    """
+    Compact per-session conversation state.
+
+    Only the raw text of the turns is kept, together with their role and
+    estimated token count. The framework specific message objects are built
+    on demand when the prompt is rendered, so an idle session costs little
+    more than the strings it holds.
+
+    If the session has a journal, every turn is also appended to it so that
+    the session can be resumed later.
+    """
+
+    __slots__ = ("roles", "contents", "token_counts", "journal")
+
+    HUMAN = 0
+    AI = 1
+    ROLE_NAMES = ("user", "assistant")
+
+    def __init__(self):
+        self.roles = bytearray()
+        self.contents: List[str] = []
+        self.token_counts = array("I")
+        self.journal: SessionJournal | None = None
+
+    def __len__(self) -> int:
+        return len(self.contents)
+
+    @property
+    def nbytes(self) -> int:
+        """Return the approximate memory held by the history, in bytes"""
+        return (
+            sys.getsizeof(self.roles)
+            + sys.getsizeof(self.contents)
+            + sys.getsizeof(self.token_counts)
+            + sum(sys.getsizeof(content) for content in self.contents)
+        )
+
+    @property
+    def total_tokens(self) -> int:
+        """Return the estimated number of tokens of the whole history"""
+        return sum(self.token_counts)
+
+    def append(self, role: int, content: str):
+        """
+        Append a turn to the history
+
+        :param int role: The role of the turn (ChatSession.HUMAN or ChatSession.AI)
+        :param str content: The content of the turn
+        """
+        self.roles.append(role)
+        self.contents.append(content)
+        self.token_counts.append(estimate_tokens(content))
+        if self.journal is not None:
+            self.journal.record(role, content)
+
+    def add_exchange(self, user_msg: str, ai_msg: str):
+        """
+        Append a complete exchange (user message and LLM answer) to the history
+
+        :param str user_msg: The message of the user
+        :param str ai_msg: The answer of the LLM
+        """
+        self.append(self.HUMAN, user_msg)
+        self.append(self.AI, ai_msg)
+
+    def trim(self, keep: int):
+        """
+        Drop the oldest turns of the history, keeping only the last `keep` ones
+
+        :param int keep: The number of turns to keep
+        """
+        drop = max(0, len(self.contents) - keep)
+        if drop:
+            del self.roles[:drop]
+            del self.contents[:drop]
+            del self.token_counts[:drop]
+
+    def turns(self, last: int | None = None) -> List[Tuple[str, str]]:
+        """
+        Return the turns of the history as (role name, content) tuples
+
+        :param int last: If set, only return the last `last` turns
+        """
+        start = 0 if last is None else max(0, len(self.contents) - last)
+        return [
+            (self.ROLE_NAMES[self.roles[i]], self.contents[i])
+            for i in range(start, len(self.contents))
+        ]
+
+
 LLMS: Dict[str, Type[BaseLLM]] = {}
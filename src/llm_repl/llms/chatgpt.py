@@ -1,111 +1,95 @@
 from __future__ import annotations
 
 import os
-from uuid import UUID
-from langchain.schema.messages import BaseMessage
-import pkg_resources  # type: ignore
-import yaml
-import pydantic
-
-from typing import Dict, Any, List
-
-from langchain.callbacks.base import AsyncCallbackHandler
-from langchain.chat_models import ChatOpenAI
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import (
-    ChatPromptTemplate,
-    MessagesPlaceholder,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-)
-from langchain.chains import ConversationChain
+from uuid import uuid4
+
+from typing import AsyncIterator, Dict, Any, List, Tuple
 
 from llm_repl.repls import BaseClientHandler
-from llm_repl.llms import BaseLLM, LLMS
+from llm_repl.llms import (
+    BaseLLM,
+    ChatGPTPersonality,
+    ChatSession,
+    ENGINES,
+    LLMS,
+    MEMORY_MODES,
+    load_llm_personality,
+)
+from llm_repl.openai_client import get_shared_client
+from llm_repl.cassettes import CassetteRecorder
+from llm_repl.journal import SessionJournal
 from llm_repl import exceptions
 
-DATA_FOLDER = pkg_resources.resource_filename("llm_repl", "data")
-PERSONALITIES_FOLDER = os.path.join(DATA_FOLDER, "chatgpt", "personalities")
-DEFAULT_PERSONALITY = os.path.join(PERSONALITIES_FOLDER, "default.yml")
-
-
-class ChatGPTPersonality(pydantic.BaseModel):
-    """ChatGPT personality."""
-
-    description: str
-    personality: str
-    memories: List[str] | None
-
-
-class AsyncChatGPTStreamingCallbackHandler(AsyncCallbackHandler):
-    """Callback handler for streaming. Only works with LLMs that support streaming."""
-
-    def __init__(
-        self, client_handler: BaseClientHandler, is_in_streaming_mode: bool
-    ) -> None:
-        super().__init__()
-        self.is_in_streaming_mode = is_in_streaming_mode
-        self.client_handler = client_handler
-
-    async def on_llm_new_token(self, token: str, **kwargs: Any):
-        """Run on new LLM token. Only available when streaming is enabled."""
-        await self.client_handler.add_token(token)
-
-    async def on_llm_end(self, response, **kwargs: Any) -> None:
-        if self.is_in_streaming_mode:
-            await self.client_handler.add_token(self.client_handler.end_token)
-
-    async def on_chat_model_start(
-        self,
-        serialized: Dict[str, Any],
-        messages: List[List[BaseMessage]],
-        *,
-        run_id: UUID,
-        parent_run_id: UUID | None = None,
-        tags: List[str] | None = None,
-        metadata: Dict[str, Any] | None = None,
-        **kwargs: Any,
-    ) -> Any:
-        if self.is_in_streaming_mode:
-            await self.client_handler.add_token(self.client_handler.start_token)
-
 
 class ChatGPT(BaseLLM):
+    MODEL_NAME = "gpt-3.5-turbo"
+    # Number of most recent turns always sent when using the vector memory
+    RECENT_TURNS = 4
+
     def __init__(
         self,
         api_key: str,
         client_handler: BaseClientHandler,
         model_name: str = "gpt-3.5-turbo",
         personality: ChatGPTPersonality | None = None,
+        memory: str = "buffer",
+        session_id: str | None = None,
+        engine: str = "langchain",
+        record_dir: str | None = None,
+        journal: bool = False,
     ):
         self.api_key = api_key
         # TODO: Make options configurable
         self.streaming_mode = True
         self.client_handler = client_handler
+        self.model_name = model_name
+        self.system_prompt = personality.personality if personality is not None else ""
+        # Per-session state, everything else is shared between the sessions
+        self.session_id = session_id if session_id is not None else uuid4().hex
+        self.session = (
+            SessionJournal(self.session_id).load() if journal else ChatSession()
+        )
+        if memory not in MEMORY_MODES:
+            raise exceptions.LLMException(f"Unknown memory mode '{memory}'.")
+        self.vector_memory = None
+        if memory == "vector":
+            try:
+                # pylint: disable=import-outside-toplevel
+                from llm_repl.vector_memory import VectorMemory
+            except ImportError as e:
+                raise exceptions.MissingDependency(e.name or "numpy", "MEMORY") from e
+            # pylint: disable=import-outside-toplevel
+            from llm_repl.langchain_chain import get_shared_embeddings
 
-        # TODO: Make it customizable
-        prompt = ChatPromptTemplate.from_messages(
-            [
-                SystemMessagePromptTemplate.from_template(
-                    personality.personality if personality is not None else ""
-                ),
-                MessagesPlaceholder(variable_name="history"),
-                HumanMessagePromptTemplate.from_template("{input}"),
-            ]
+            self.vector_memory = VectorMemory(
+                self.session_id,
+                get_shared_embeddings(self.api_key),
+                recent_exchanges=self.RECENT_TURNS // 2,
+            )
+            self.session.trim(self.RECENT_TURNS)
+        # Directory where the upstream streams are recorded, if any
+        self.record_dir = record_dir
+        self.recorder: CassetteRecorder | None = None
+        if engine not in ENGINES:
+            raise exceptions.LLMException(f"Unknown engine '{engine}'.")
+        self.engine = engine
+        if self.engine == "direct":
+            # Talk to the chat completions API directly, without LangChain
+            self.client = get_shared_client(self.api_key)
+            return
+        # LangChain is slow to import, it is only imported when used
+        # pylint: disable=import-outside-toplevel
+        from llm_repl.langchain_chain import (
+            AsyncChatGPTStreamingCallbackHandler,
+            get_shared_chain,
+        )
+
+        self.callback_handler = AsyncChatGPTStreamingCallbackHandler(
+            self.client_handler, self.is_in_streaming_mode, self._record_token
+        )
+        self.model = get_shared_chain(
+            self.api_key, self.model_name, self.system_prompt, self.streaming_mode
         )
-        llm = ChatOpenAI(
-            openai_api_key=self.api_key,
-            streaming=self.streaming_mode,
-            callbacks=[
-                AsyncChatGPTStreamingCallbackHandler(
-                    self.client_handler, self.is_in_streaming_mode
-                )
-            ],
-            verbose=True,
-            model_name=model_name,
-        )  # type: ignore
-        memory = ConversationBufferMemory(return_messages=True)
-        self.model = ConversationChain(memory=memory, prompt=prompt, llm=llm)
 
     @property
     def name(self) -> str:
@@ -119,6 +103,17 @@ class ChatGPT(BaseLLM):
     def is_in_streaming_mode(self) -> bool:
         return self.streaming_mode
 
+    async def warmup(self):
+        # LangChain opens a new connection for every request, only the
+        # direct engine keeps a pool of connections that can be warmed up
+        if self.engine == "direct":
+            await self.client.warmup()
+
+    async def close(self):
+        if self.vector_memory is not None:
+            # The index of a journaled session is kept to resume it
+            await self.vector_memory.close(remove=self.session.journal is None)
+
     def _say_hi(self) -> None:
         pass
 
@@ -133,27 +128,132 @@ class ChatGPT(BaseLLM):
         if api_key is None:
             raise exceptions.MissingAPIKey("OPENAI_API_KEY")
 
-        # Path to the yaml file containing the personality
-        personality_filepath = llm_kwargs.get("personality", None)
-
-        if personality_filepath is None or not os.path.isfile(personality_filepath):
-            personality_filepath = DEFAULT_PERSONALITY
-
-        with open(personality_filepath, "r") as f:
-            personality_content = yaml.safe_load(f)
-        try:
-            personality = ChatGPTPersonality(**personality_content)
-        except pydantic.ValidationError:
-            personality = ChatGPTPersonality(
-                description="Default personality", personality="", memories=None
-            )
+        personality = load_llm_personality(llm_kwargs)
 
         # TODO: Add autocomplete in repl
-        model = cls(api_key, client_handler, personality=personality)
+        model = cls(
+            api_key,
+            client_handler,
+            model_name=cls.MODEL_NAME,
+            personality=personality,
+            memory=llm_kwargs.get("memory") or "buffer",
+            session_id=llm_kwargs.get("session_id", None),
+            engine=llm_kwargs.get("engine") or "langchain",
+            record_dir=llm_kwargs.get("record", None),
+            journal=llm_kwargs.get("journal", False),
+        )
         return model
 
+    async def _history(self, msg: str) -> List[Tuple[str, str]]:
+        """
+        Build the conversation history as (role, content) tuples.
+
+        With the vector memory, the history is made of the past exchanges
+        relevant to the message followed by the most recent turns.
+
+        :param str msg: The new message of the user
+        """
+        turns = []
+        if self.vector_memory is not None:
+            for user_msg, ai_msg in await self.vector_memory.retrieve(msg):
+                turns += [("user", user_msg), ("assistant", ai_msg)]
+        turns += self.session.turns()
+        return turns
+
+    def _messages(self, msg: str, turns: List[Tuple[str, str]]) -> List[Dict[str, str]]:
+        """
+        Build the messages of the chat completions request
+
+        :param str msg: The new message of the user
+        :param list turns: The conversation history
+        """
+        messages = []
+        if self.system_prompt:
+            messages.append({"role": "system", "content": self.system_prompt})
+        for role, content in turns:
+            messages.append({"role": role, "content": content})
+        messages.append({"role": "user", "content": msg})
+        return messages
+
+    def _record_token(self, token: str):
+        """
+        Record the token in the cassette of the current request, if recording
+        """
+        if self.recorder is not None:
+            self.recorder.record(token)
+
+    def _save_exchange(self, msg: str, resp: str):
+        """
+        Save the completed exchange in the memory of the session
+
+        :param str msg: The message of the user
+        :param str resp: The answer of the LLM
+        """
+        self.session.add_exchange(msg, resp)
+        if self.vector_memory is not None:
+            # Embedding and indexing happen in background
+            self.vector_memory.add_exchange(msg, resp)
+            self.session.trim(self.RECENT_TURNS)
+
+    def _stream(self, messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+        """
+        Request the completion of the messages and return the stream of deltas
+
+        :param list messages: The messages of the request
+        """
+        return self.client.stream(self.model_name, messages)
+
+    async def _process_direct(self, messages: List[Dict[str, str]]) -> str:
+        """
+        Stream the answer from the chat completions API straight to the client
+
+        :param list messages: The messages of the request
+        """
+        deltas = []
+        await self.client_handler.add_token(self.client_handler.start_token)
+        stream = self._stream(messages)
+        try:
+            async for delta in stream:
+                self._record_token(delta)
+                deltas.append(delta)
+                await self.client_handler.add_token(delta)
+        finally:
+            # Close the upstream stream right away if the client handler
+            # stopped it
+            await stream.aclose()  # type: ignore
+        await self.client_handler.add_token(self.client_handler.end_token)
+        return "".join(deltas)
+
     async def process(self, msg: str):
-        resp = await self.model.apredict(input=msg)
+        turns = await self._history(msg)
+        messages = self._messages(msg, turns)
+        if self.record_dir is not None:
+            self.recorder = CassetteRecorder(self.record_dir, self.model_name, messages)
+        try:
+            if self.engine == "direct":
+                resp = await self._process_direct(messages)
+            else:
+                # pylint: disable=import-outside-toplevel
+                from llm_repl.langchain_chain import langchain_history
+
+                resp = await self.model.apredict(
+                    input=msg,
+                    history=langchain_history(turns),
+                    callbacks=[self.callback_handler],
+                )
+        except exceptions.StreamStopped as e:
+            # Remember the answer as the client got it
+            resp = e.output
+            await self.client_handler.add_token(self.client_handler.end_token)
+        except BaseException:
+            # Discard the partial recording of the failed request
+            self.recorder = None
+            raise
+        finally:
+            if self.recorder is not None:
+                self.recorder.finish()
+                self.recorder = None
+        self._save_exchange(msg, resp)
         if not self.is_in_streaming_mode:
             await self.client_handler.add_token(self.client_handler.start_token)
             await self.client_handler.add_token(resp)
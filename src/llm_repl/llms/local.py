@@ -0,0 +1,492 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import queue
+import threading
+
+from functools import lru_cache
+from typing import Any, List, Tuple
+from uuid import uuid4
+
+from llm_repl.repls import BaseClientHandler
+from llm_repl.llms import BaseLLM, ChatSession, LLMS, load_llm_personality
+from llm_repl.journal import SessionJournal
+from llm_repl.pipeline import StopSequences
+from llm_repl import exceptions
+
+DEFAULT_LOCAL_MODEL = "distilgpt2"
+# Prefixes of the turns used when the model has no chat template
+USER_PREFIX = "User:"
+ASSISTANT_PREFIX = "Assistant:"
+
+
+class LocalSequence:
+    """
+    A single generation request handled by the batcher
+    """
+
+    __slots__ = (
+        "input_ids",
+        "n_prompt_tokens",
+        "max_new_tokens",
+        "stop",
+        "loop",
+        "deltas",
+        "text",
+        "finished",
+        "cancelled",
+        "length",
+        "prefix_offset",
+        "read_offset",
+        "stopper",
+        "error",
+    )
+
+    def __init__(
+        self,
+        input_ids: List[int],
+        max_new_tokens: int,
+        stop: List[str],
+        loop: asyncio.AbstractEventLoop,
+    ):
+        self.input_ids = input_ids
+        self.n_prompt_tokens = len(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.stop = stop
+        self.loop = loop
+        # Text deltas produced by the worker, None marks the end of the stream
+        self.deltas: asyncio.Queue[str | None] = asyncio.Queue()
+        self.text = ""
+        self.finished = False
+        self.cancelled = False
+        # Number of tokens of the sequence in the KV cache of the batch
+        self.length = 0
+        # The generated tokens in [prefix_offset, read_offset) were already
+        # decoded and emitted, they are decoded again with the new tokens
+        # only to get the spacing right
+        self.prefix_offset = self.read_offset = self.n_prompt_tokens
+        self.stopper = StopSequences(stop)
+        # The exception that failed the generation, if any
+        self.error: Exception | None = None
+
+    @property
+    def n_generated(self) -> int:
+        return len(self.input_ids) - self.n_prompt_tokens
+
+    def emit(self, delta: str | None):
+        """
+        Send a delta to the asyncio side (thread safe)
+
+        :param str delta: The text delta, None to signal the end of the stream
+        """
+        try:
+            self.loop.call_soon_threadsafe(self.deltas.put_nowait, delta)
+        except RuntimeError:
+            # The loop of the client is closed, nobody is left to read the
+            # stream: drop the sequence from the batch
+            self.cancelled = True
+
+
+class ContinuousBatcher:
+    """
+    Runs the inference of a local model in a worker thread.
+
+    New sequences are admitted between decode steps and every step decodes
+    one token for all the active sequences in a single batched forward pass,
+    so the aggregate throughput grows with the number of concurrent sessions
+    instead of serializing them.
+
+    The prompt of a new sequence is prefilled on its own, then its KV cache
+    joins the (left padded) cache of the batch, so that a decode step only
+    runs the model on the last token of every sequence. A sequence ends when
+    it fills the context of the model.
+
+    :param str model_path: Local path (or hub name) of the model
+    :param int max_batch_size: Maximum number of sequences decoded together
+    """
+
+    def __init__(self, model_path: str, max_batch_size: int = 8):
+        try:
+            import torch  # pylint: disable=import-outside-toplevel
+
+            # pylint: disable-next=import-outside-toplevel
+            import transformers  # type: ignore[import-untyped]
+        except ImportError as e:
+            raise exceptions.MissingDependency(e.name or "torch", "LOCAL") from e
+
+        self.torch = torch
+        self.transformers = transformers
+        self.model_path = model_path
+        self.max_batch_size = max_batch_size
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(model_path)
+        self.model = transformers.AutoModelForCausalLM.from_pretrained(model_path)
+        self.model.eval()
+        self.max_context = getattr(self.model.config, "max_position_embeddings", 1024)
+        self.pad_token_id = (
+            self.tokenizer.pad_token_id
+            if self.tokenizer.pad_token_id is not None
+            else self.tokenizer.eos_token_id
+        )
+        self.requests: queue.SimpleQueue[LocalSequence] = queue.SimpleQueue()
+        # The sequences being decoded, their KV cache (a (key, value) pair
+        # of [batch, heads, positions, head_dim] tensors per layer) and the
+        # attention mask of the cache, rows in the order of the sequences.
+        # Only the worker thread touches them.
+        self.active: List[LocalSequence] = []
+        self.past: Tuple[Tuple[Any, Any], ...] | None = None
+        self.mask: Any = None
+        self.worker = threading.Thread(
+            target=self._run, name=f"llm-repl-local-{model_path}", daemon=True
+        )
+        self.worker.start()
+
+    @property
+    def has_chat_template(self) -> bool:
+        return getattr(self.tokenizer, "chat_template", None) is not None
+
+    def encode(self, messages: List[dict]) -> List[int]:
+        """
+        Encode the conversation into the prompt token ids
+
+        :param list messages: The conversation as a list of role/content dicts
+        """
+        if self.has_chat_template:
+            return self.tokenizer.apply_chat_template(
+                messages, add_generation_prompt=True
+            )
+        prompt = ""
+        for message in messages:
+            if message["role"] == "system":
+                prompt += f"{message['content']}\n"
+            elif message["role"] == "user":
+                prompt += f"{USER_PREFIX} {message['content']}\n"
+            else:
+                prompt += f"{ASSISTANT_PREFIX} {message['content']}\n"
+        prompt += ASSISTANT_PREFIX
+        return self.tokenizer.encode(prompt)
+
+    def submit(self, sequence: LocalSequence):
+        """
+        Queue a new sequence, it will join the batch at the next decode step
+
+        :param LocalSequence sequence: The sequence to generate
+        """
+        self.requests.put(sequence)
+
+    def _run(self):
+        while True:
+            self._admit()
+            if self.active:
+                try:
+                    self._step()
+                except Exception as e:  # pylint: disable=broad-except
+                    for seq in self.active:
+                        seq.error = e
+                        seq.finished = True
+            self._evict()
+
+    def _admit(self):
+        """
+        Prefill the sequences that arrived during the last step and add them
+        to the batch
+        """
+        new: List[LocalSequence] = []
+        # Sleep until there is some work to do
+        if not self.active:
+            new.append(self.requests.get())
+        while len(self.active) + len(new) < self.max_batch_size:
+            try:
+                new.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        for seq in new:
+            if seq.cancelled:
+                continue
+            try:
+                past, token = self._prefill(seq)
+            except Exception as e:  # pylint: disable=broad-except
+                seq.error = e
+                self._finish(seq)
+                continue
+            self._push_token(seq, token)
+            if seq.finished or seq.cancelled:
+                self._finish(seq)
+            else:
+                self._join(seq, past)
+
+    def _forward(self, input_ids: Any, attention_mask: Any, position_ids: Any, past):
+        """
+        Run the model and return the logits of the last position and the
+        updated KV cache
+        """
+        if past is not None and getattr(self.model, "_supports_cache_class", False):
+            past = self.transformers.DynamicCache.from_legacy_cache(past)
+        with self.torch.no_grad():
+            output = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past,
+                use_cache=True,
+            )
+        past = output.past_key_values
+        if hasattr(past, "to_legacy_cache"):
+            past = past.to_legacy_cache()
+        return output.logits[:, -1, :], past
+
+    def _prefill(self, seq: LocalSequence):
+        """
+        Compute the KV cache of the prompt of the sequence and return it with
+        the first generated token
+        """
+        torch = self.torch
+        ids = seq.input_ids[-(self.max_context - 1) :]
+        seq.length = len(ids)
+        input_ids = torch.tensor([ids])
+        logits, past = self._forward(
+            input_ids,
+            torch.ones_like(input_ids),
+            torch.arange(len(ids)).unsqueeze(0),
+            None,
+        )
+        return past, int(logits.argmax(dim=-1)[0])
+
+    def _join(self, seq: LocalSequence, past):
+        """
+        Add the prefilled sequence to the batch, left padding either its cache
+        or the cache of the batch to the same number of positions
+        """
+        torch = self.torch
+        pad = torch.nn.functional.pad
+        mask = torch.ones((1, seq.length), dtype=torch.long)
+        if self.past is None:
+            self.active, self.past, self.mask = [seq], past, mask
+            return
+        n_batch, n_seq = self.mask.shape[1], seq.length
+        if n_seq < n_batch:
+            past = tuple(
+                (pad(k, (0, 0, n_batch - n_seq, 0)), pad(v, (0, 0, n_batch - n_seq, 0)))
+                for k, v in past
+            )
+            mask = pad(mask, (n_batch - n_seq, 0))
+        elif n_seq > n_batch:
+            self.past = tuple(
+                (pad(k, (0, 0, n_seq - n_batch, 0)), pad(v, (0, 0, n_seq - n_batch, 0)))
+                for k, v in self.past
+            )
+            self.mask = pad(self.mask, (n_seq - n_batch, 0))
+        self.past = tuple(
+            (torch.cat([k, new_k]), torch.cat([v, new_v]))
+            for (k, v), (new_k, new_v) in zip(self.past, past)
+        )
+        self.mask = torch.cat([self.mask, mask])
+        self.active.append(seq)
+
+    def _step(self):
+        """
+        Decode one token for every active sequence
+        """
+        torch = self.torch
+        active = self.active
+        input_ids = torch.tensor([[seq.input_ids[-1]] for seq in active])
+        self.mask = torch.cat(
+            [self.mask, torch.ones((len(active), 1), dtype=torch.long)], dim=1
+        )
+        position_ids = torch.tensor([[seq.length] for seq in active])
+        logits, self.past = self._forward(input_ids, self.mask, position_ids, self.past)
+        for seq, token in zip(active, logits.argmax(dim=-1).tolist()):
+            seq.length += 1
+            self._push_token(seq, token)
+
+    def _push_token(self, seq: LocalSequence, token: int):
+        """
+        Append the generated token to the sequence and emit its text
+        """
+        if token == self.tokenizer.eos_token_id:
+            seq.finished = True
+            return
+        seq.input_ids.append(token)
+        delta = seq.stopper.feed(self._decode_delta(seq))
+        if seq.stopper.stopped:
+            seq.finished = True
+        if delta:
+            seq.emit(delta)
+            seq.text += delta
+        if seq.n_generated >= seq.max_new_tokens or seq.length >= self.max_context:
+            seq.finished = True
+
+    def _decode_delta(self, seq: LocalSequence) -> str:
+        """
+        Return the text of the tokens generated since the last delta, empty
+        while they are only a part of a multi-byte character
+        """
+        decode = self.tokenizer.decode
+        prefix = decode(
+            seq.input_ids[seq.prefix_offset : seq.read_offset],
+            skip_special_tokens=True,
+        )
+        text = decode(seq.input_ids[seq.prefix_offset :], skip_special_tokens=True)
+        if len(text) <= len(prefix) or text.endswith("�"):
+            return ""
+        seq.prefix_offset, seq.read_offset = seq.read_offset, len(seq.input_ids)
+        return text[len(prefix) :]
+
+    def _finish(self, seq: LocalSequence):
+        """
+        Emit the text held back by the stop sequences and end the stream
+        """
+        if not seq.stopper.stopped and not seq.cancelled and seq.error is None:
+            delta = seq.stopper.flush()
+            if delta:
+                seq.emit(delta)
+                seq.text += delta
+        seq.emit(None)
+
+    def _evict(self):
+        """
+        Remove the finished and the cancelled sequences from the batch
+        """
+        keep = []
+        for i, seq in enumerate(self.active):
+            if seq.finished or seq.cancelled:
+                self._finish(seq)
+            else:
+                keep.append(i)
+        if len(keep) == len(self.active):
+            return
+        if not keep:
+            self.active, self.past, self.mask = [], None, None
+            return
+        torch = self.torch
+        rows = torch.tensor(keep)
+        self.active = [self.active[i] for i in keep]
+        mask = self.mask.index_select(0, rows)
+        # Drop the positions that are padding for all the remaining sequences
+        first = int((mask.sum(dim=0) > 0).nonzero()[0])
+        self.mask = mask[:, first:]
+        self.past = tuple(
+            (
+                k.index_select(0, rows)[:, :, first:],
+                v.index_select(0, rows)[:, :, first:],
+            )
+            for k, v in self.past  # type: ignore
+        )
+
+
+_batchers_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _shared_batcher(model_path: str) -> ContinuousBatcher:
+    return ContinuousBatcher(model_path)
+
+
+def get_batcher(model_path: str) -> ContinuousBatcher:
+    """
+    Return the batcher of the model, shared by all the sessions.
+
+    The LLMs are loaded in worker threads, the lock makes sure that the
+    model is loaded (and its worker thread started) only once.
+
+    :param str model_path: Local path (or hub name) of the model
+    """
+    with _batchers_lock:
+        return _shared_batcher(model_path)
+
+
+class LocalLLM(BaseLLM):
+    """
+    LLM running locally on the CPU
+    """
+
+    MAX_NEW_TOKENS = 256
+
+    def __init__(
+        self,
+        client_handler: BaseClientHandler,
+        batcher: ContinuousBatcher,
+        system_prompt: str = "",
+        session_id: str | None = None,
+        journal: bool = False,
+    ):
+        self.client_handler = client_handler
+        self.batcher = batcher
+        self.system_prompt = system_prompt
+        self.session_id = session_id if session_id is not None else uuid4().hex
+        self.session = (
+            SessionJournal(self.session_id).load() if journal else ChatSession()
+        )
+
+    @property
+    def name(self) -> str:
+        return "Local"
+
+    @property
+    def info(self) -> str:
+        return f"Local model '{self.batcher.model_path}' running on CPU."
+
+    @property
+    def is_in_streaming_mode(self) -> bool:
+        return True
+
+    @classmethod
+    def load(cls, client_handler: BaseClientHandler, **llm_kwargs) -> BaseLLM:
+        model_path = llm_kwargs.get("model_path") or os.getenv(
+            "LLM_REPL_LOCAL_MODEL", DEFAULT_LOCAL_MODEL
+        )
+        if not isinstance(model_path, str):
+            raise exceptions.LLMException(f"Invalid model path '{model_path}'.")
+        return cls(
+            client_handler,
+            get_batcher(model_path),
+            system_prompt=load_llm_personality(llm_kwargs).personality,
+            session_id=llm_kwargs.get("session_id", None),
+            journal=llm_kwargs.get("journal", False),
+        )
+
+    def _messages(self, msg: str) -> List[Any]:
+        """
+        Build the conversation to send to the model
+        """
+        messages = []
+        if self.system_prompt:
+            messages.append({"role": "system", "content": self.system_prompt})
+        for role, content in self.session.turns():
+            messages.append({"role": role, "content": content})
+        messages.append({"role": "user", "content": msg})
+        return messages
+
+    async def process(self, msg: str):
+        input_ids = await asyncio.to_thread(self.batcher.encode, self._messages(msg))
+        stop = [] if self.batcher.has_chat_template else [f"\n{USER_PREFIX}"]
+        sequence = LocalSequence(
+            list(input_ids), self.MAX_NEW_TOKENS, stop, asyncio.get_running_loop()
+        )
+        self.batcher.submit(sequence)
+
+        await self.client_handler.add_token(self.client_handler.start_token)
+        try:
+            while True:
+                delta = await sequence.deltas.get()
+                if delta is None:
+                    break
+                await self.client_handler.add_token(delta)
+            if sequence.error is not None:
+                # Fail like the other LLMs, and keep the failed exchange out
+                # of the session
+                raise exceptions.LLMException(
+                    f"Local model error: {sequence.error}"
+                ) from sequence.error
+            text = sequence.text
+        except exceptions.StreamStopped as e:
+            text = e.output
+        finally:
+            # Free the slot in the batch if the client went away or stopped
+            # the stream
+            sequence.cancelled = True
+        await self.client_handler.add_token(self.client_handler.end_token)
+        self.session.add_exchange(msg, text.strip())
+
+
+LLMS["local"] = LocalLLM
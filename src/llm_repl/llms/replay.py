@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import asyncio
+import os
+
+from functools import lru_cache
+from typing import AsyncIterator, Dict, List
+
+from llm_repl.repls import BaseClientHandler
+from llm_repl.llms import BaseLLM, LLMS, load_llm_personality
+from llm_repl.llms.chatgpt import ChatGPT
+from llm_repl.cassettes import Cassette, CassetteLibrary
+from llm_repl import exceptions
+
+
+@lru_cache(maxsize=None)
+def get_library(directory: str) -> CassetteLibrary:
+    """
+    Return the library of the cassettes in the directory, shared by all the
+    sessions so that the cassettes are loaded only once
+
+    :param str directory: The directory of the cassettes
+    """
+    return CassetteLibrary(directory)
+
+
+class ReplayChatGPT(ChatGPT):
+    """
+    ChatGPT replaying the upstream streams recorded with `--record`, with
+    their original timing (scaled by `speed`) and without any network access.
+
+    Requests without a recorded cassette are served with the other cassettes
+    of the library in turn, so that any workload can be replayed with
+    realistic token sizes and timings.
+    """
+
+    def __init__(
+        self,
+        client_handler: BaseClientHandler,
+        library: CassetteLibrary,
+        speed: float = 1.0,
+        **kwargs,
+    ):
+        super().__init__("", client_handler, engine="direct", **kwargs)
+        self.library = library
+        self.speed = speed
+
+    @property
+    def name(self) -> str:
+        return "Replay"
+
+    @property
+    def info(self) -> str:
+        return f"Replay of the {len(self.library)} cassettes in '{self.library.directory}'."
+
+    @classmethod
+    def load(cls, client_handler: BaseClientHandler, **llm_kwargs) -> BaseLLM:
+        directory = llm_kwargs.get("cassettes") or os.getenv("LLM_REPL_CASSETTES")
+        if directory is None or not os.path.isdir(directory):
+            raise exceptions.LLMException(
+                "Cassettes directory not found, please set it with --cassettes."
+            )
+        library = get_library(directory)
+        speed = llm_kwargs.get("replay_speed")
+        # The personality and the model are part of the recorded requests,
+        # they must be the ones of the recording to find its cassettes
+        return cls(
+            client_handler,
+            library,
+            speed=1.0 if speed is None else speed,
+            model_name=llm_kwargs.get("model") or library.model or cls.MODEL_NAME,
+            personality=load_llm_personality(llm_kwargs),
+            session_id=llm_kwargs.get("session_id", None),
+            journal=llm_kwargs.get("journal", False),
+        )
+
+    async def warmup(self):
+        # No upstream to connect to
+        pass
+
+    def _stream(self, messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+        cassette = self.library.find(self.model_name, messages)
+        if cassette is None:
+            raise exceptions.LLMException("No cassette recorded for this request.")
+        return self._replay(cassette)
+
+    async def _replay(self, cassette: Cassette) -> AsyncIterator[str]:
+        """
+        Yield the tokens of the cassette with their recorded timing
+
+        :param Cassette cassette: The cassette to replay
+        """
+        for token, delay in zip(cassette.tokens, cassette.delays):
+            if self.speed:
+                await asyncio.sleep(delay / self.speed)
+            yield token
+
+
+LLMS["replay"] = ReplayChatGPT
@@ -0,0 +1,472 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple
+from uuid import uuid4
+
+import pkg_resources  # type: ignore
+import pydantic
+import yaml
+
+from llm_repl import STATE_DIR
+from llm_repl.repls import BaseClientHandler
+from llm_repl.llms import BaseLLM, ChatSession, LLMS, estimate_tokens
+from llm_repl.journal import SessionJournal
+from llm_repl import exceptions
+
+logger = logging.getLogger("llm_repl.router")
+
+DEFAULT_RULES = pkg_resources.resource_filename("llm_repl", "data/router/default.yml")
+DECISIONS_LOG = os.path.join(STATE_DIR, "router", "decisions.jsonl")
+
+CODE_PATTERN = re.compile(
+    r"```|^\s*(def|class|import|from|function|const|let|var|public|#include)\b"
+    r"|[;{}]\s*$",
+    re.MULTILINE,
+)
+HINT_PATTERN = re.compile(r"^@(\w+)\s+")
+
+
+class RouterRule(pydantic.BaseModel):
+    """A routing rule, matching when all its conditions match"""
+
+    name: str
+    backends: List[str]
+    min_tokens: int | None = None
+    max_tokens: int | None = None
+    has_code: bool | None = None
+    keywords: List[str] | None = None
+
+    def matches(self, features: Dict[str, Any]) -> bool:
+        """
+        Return whether the rule matches the features of a message
+
+        :param dict features: The features of the message
+        """
+        if self.min_tokens is not None and features["tokens"] < self.min_tokens:
+            return False
+        if self.max_tokens is not None and features["tokens"] > self.max_tokens:
+            return False
+        if self.has_code is not None and features["has_code"] != self.has_code:
+            return False
+        keywords: List[str] = self.keywords or []
+        if keywords and not any(keyword in features["text"] for keyword in keywords):
+            return False
+        return True
+
+
+class RouterConfig(pydantic.BaseModel):
+    """The routing rules"""
+
+    default: str
+    max_error_rate: float = 0.5
+    max_ttft: float = 10.0
+    # Seconds after which a degraded backend is tried again first
+    retry_after: float = 30.0
+    rules: List[RouterRule] = []
+
+    def candidates(self, features: Dict[str, Any]) -> Tuple[str, List[str]]:
+        """
+        Return the name of the rule matching the features of a message and
+        the backends it selects, in order of preference
+
+        :param dict features: The features of the message
+        """
+        if features["hint"] is not None:
+            return "hint", [features["hint"]]
+        for rule in self.rules:
+            if rule.matches(features):
+                return rule.name, rule.backends
+        return "default", [self.default]
+
+    def route(
+        self,
+        features: Dict[str, Any],
+        stats: Dict[str, BackendStats],
+        now: float | None = None,
+    ) -> Tuple[str, List[str]]:
+        """
+        Return the name of the rule matching the features of a message and
+        the backends to try, the healthy ones first.
+
+        A degraded backend that wasn't sent any request for `retry_after`
+        seconds is tried again in its place, so that it can recover.
+
+        :param dict features: The features of the message
+        :param dict stats: The live statistics of the backends
+        :param float now: The current time, from time.monotonic()
+        """
+        if now is None:
+            now = time.monotonic()
+        rule, backends = self.candidates(features)
+        healthy = [
+            backend
+            for backend in backends
+            if backend not in stats
+            or stats[backend].is_healthy(self)
+            or now - stats[backend].last_request >= self.retry_after
+        ]
+        # Degraded backends are still tried, the fastest first
+        degraded = sorted(
+            (backend for backend in backends if backend not in healthy),
+            key=lambda backend: stats[backend].ttft,
+        )
+        return rule, healthy + degraded
+
+
+@lru_cache(maxsize=None)
+def load_rules(rules_filepath: str) -> RouterConfig:
+    """
+    Load (and cache) the routing rules stored in the given yaml file
+
+    :param str rules_filepath: Path to the yaml file of the rules
+    """
+    with open(rules_filepath, "r") as f:
+        content = yaml.safe_load(f)
+    try:
+        return RouterConfig(**content)
+    except pydantic.ValidationError as e:
+        raise exceptions.LLMException(f"Invalid routing rules: {e}") from e
+
+
+def extract_features(msg: str) -> Dict[str, Any]:
+    """
+    Compute the cheap features of a message the routing rules are based on
+
+    :param str msg: The message of the user
+    """
+    hint = HINT_PATTERN.match(msg)
+    if hint is not None and not (
+        hint.group(1) in LLMS and not issubclass(LLMS[hint.group(1)], RouterLLM)
+    ):
+        hint = None
+    return {
+        "text": msg.lower(),
+        "tokens": estimate_tokens(msg),
+        "has_code": CODE_PATTERN.search(msg) is not None,
+        "hint": hint.group(1) if hint is not None else None,
+    }
+
+
+class BackendStats:
+    """
+    Live statistics of a backend, as exponentially weighted moving averages
+    """
+
+    __slots__ = ("ttft", "tokens_per_s", "error_rate", "requests", "last_request")
+
+    ALPHA = 0.2
+
+    def __init__(self):
+        self.ttft = 0.0
+        self.tokens_per_s = 0.0
+        self.error_rate = 0.0
+        self.requests = 0
+        # When the last request was sent to the backend, from time.monotonic()
+        self.last_request = time.monotonic()
+
+    def _update(self, attr: str, value: float):
+        if self.requests == 0:
+            setattr(self, attr, value)
+        else:
+            setattr(
+                self,
+                attr,
+                (1 - self.ALPHA) * getattr(self, attr) + self.ALPHA * value,
+            )
+
+    def record(self, ttft: float | None, tokens_per_s: float | None, error: bool):
+        """
+        Record the outcome of a request
+
+        :param float ttft: The time to first token, in seconds
+        :param float tokens_per_s: The streaming throughput
+        :param bool error: Whether the request failed
+        """
+        if ttft is not None:
+            self._update("ttft", ttft)
+        if tokens_per_s is not None:
+            self._update("tokens_per_s", tokens_per_s)
+        self._update("error_rate", 1.0 if error else 0.0)
+        self.requests += 1
+
+    def is_healthy(self, config: RouterConfig) -> bool:
+        """
+        Return whether the backend is within the thresholds of the config
+
+        :param RouterConfig config: The routing rules
+        """
+        return self.error_rate <= config.max_error_rate and self.ttft <= config.max_ttft
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "ttft": round(self.ttft, 4),
+            "tokens_per_s": round(self.tokens_per_s, 2),
+            "error_rate": round(self.error_rate, 4),
+            "requests": self.requests,
+        }
+
+
+# The statistics are shared by all the sessions of the process
+STATS: Dict[str, BackendStats] = {}
+
+
+class MeteredClientHandler(BaseClientHandler):
+    """
+    Proxy of the client handler measuring the time to first token and the
+    number of tokens streamed by a backend.
+
+    The start token is only forwarded once per message, so that the client
+    doesn't see a new answer start when the router falls back to another
+    backend.
+    """
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, client_handler: BaseClientHandler):
+        self.client_handler = client_handler
+        self.started = False
+        self.reset()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.client_handler, name)
+
+    @property
+    def start_token(self) -> str:
+        return self.client_handler.start_token
+
+    @property
+    def end_token(self) -> str:
+        return self.client_handler.end_token
+
+    async def start(self, llm_name, **llm_kwargs):
+        await self.client_handler.start(llm_name, **llm_kwargs)
+
+    async def print_loop(self):
+        await self.client_handler.print_loop()
+
+    def reset(self):
+        """
+        Reset the measures, before sending the message to a backend
+        """
+        self.start_time = time.perf_counter()
+        self.first_token: float | None = None
+        self.n_tokens = 0
+
+    async def add_token(self, token: str):
+        if token == self.start_token:
+            if self.started:
+                return
+            self.started = True
+        # LangChain streams an empty token first, only the text counts
+        elif token and token != self.end_token:
+            if self.first_token is None:
+                self.first_token = time.perf_counter()
+            self.n_tokens += 1
+        await self.client_handler.add_token(token)
+
+
+@lru_cache(maxsize=None)
+def get_decisions_log(path: str):
+    """
+    Return the file where the routing decisions are appended, shared by all
+    the sessions
+
+    :param str path: Path of the log
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return open(path, "a", buffering=1)
+
+
+class RouterLLM(BaseLLM):
+    """
+    LLM sending each message to one of the registered backends, picked by
+    the routing rules from the features of the message and the live latency
+    and error statistics of the backends.
+
+    The backends share the same conversation, so that switching backend in
+    the middle of a conversation doesn't lose its context. A backend failing
+    before streaming any token falls back to the next candidate.
+
+    The decisions log stores the hash and the length of the prompts, the
+    prompts themselves only if `log_prompts` is set.
+    """
+
+    def __init__(
+        self,
+        client_handler: BaseClientHandler,
+        config: RouterConfig,
+        session_id: str | None = None,
+        journal: bool = False,
+        decisions_log: str | None = DECISIONS_LOG,
+        log_prompts: bool = False,
+        **backend_kwargs,
+    ):
+        self.client_handler = client_handler
+        self.config = config
+        self.session_id = session_id if session_id is not None else uuid4().hex
+        self.session = (
+            SessionJournal(self.session_id).load() if journal else ChatSession()
+        )
+        self.decisions_log = decisions_log
+        self.log_prompts = log_prompts
+        self.backend_kwargs = backend_kwargs
+        self.metered_handler = MeteredClientHandler(client_handler)
+        self.backends: Dict[str, BaseLLM] = {}
+        self.current: BaseLLM | None = None
+        # The long-term memory of the conversation, shared by the backends
+        self.vector_memory: Any = None
+
+    @property
+    def name(self) -> str:
+        return "Router"
+
+    @property
+    def info(self) -> str:
+        stats = "\n".join(
+            f"- {name}: {json.dumps(backend_stats.as_dict())}"
+            for name, backend_stats in STATS.items()
+        )
+        return f"Router across the backends of the rules.\n\n{stats}"
+
+    @property
+    def is_in_streaming_mode(self) -> bool:
+        if self.current is None:
+            return True
+        return self.current.is_in_streaming_mode
+
+    @classmethod
+    def load(cls, client_handler: BaseClientHandler, **llm_kwargs) -> BaseLLM:
+        rules_filepath = llm_kwargs.pop("router_rules", None) or DEFAULT_RULES
+        log_prompts = llm_kwargs.pop("router_log_prompts", None) or os.getenv(
+            "LLM_REPL_ROUTER_LOG_PROMPTS", ""
+        ).lower() in ("1", "true", "yes")
+        config = load_rules(rules_filepath)
+        backends = {config.default} | {
+            backend for rule in config.rules for backend in rule.backends
+        }
+        for backend in backends:
+            if backend not in LLMS or LLMS[backend] is cls:
+                raise exceptions.LLMException(
+                    f"Invalid backend '{backend}' in the routing rules."
+                )
+        return cls(client_handler, config, log_prompts=log_prompts, **llm_kwargs)
+
+    async def _backend(self, name: str) -> BaseLLM:
+        """
+        Return the backend, loading it the first time it is used
+
+        :param str name: The name of the backend
+        """
+        if name not in self.backends:
+            backend = await asyncio.to_thread(
+                LLMS[name].load,
+                self.metered_handler,
+                session_id=self.session_id,
+                **self.backend_kwargs,
+            )
+            # All the backends remember the same conversation
+            backend.session = self.session  # type: ignore
+            if getattr(backend, "vector_memory", None) is not None:
+                if self.vector_memory is None:
+                    self.vector_memory = backend.vector_memory  # type: ignore
+                else:
+                    backend.vector_memory = self.vector_memory  # type: ignore
+            self.backends[name] = backend
+        return self.backends[name]
+
+    async def warmup(self):
+        # Load and warm up the default backend, the others are loaded the
+        # first time a message is routed to them
+        try:
+            backend = await self._backend(self.config.default)
+        except exceptions.LLMException:
+            return
+        await backend.warmup()
+
+    async def close(self):
+        for backend in self.backends.values():
+            # The memory shared by the backends is closed once, by the router
+            if getattr(backend, "vector_memory", None) is not None:
+                backend.vector_memory = None  # type: ignore
+        await asyncio.gather(*(backend.close() for backend in self.backends.values()))
+        if self.vector_memory is not None:
+            # The index of a journaled session is kept to resume it
+            await self.vector_memory.close(remove=self.session.journal is None)
+
+    def _log_decision(self, msg: str, **fields: Any):
+        if self.log_prompts:
+            fields["prompt"] = msg
+        else:
+            fields["prompt_sha256"] = hashlib.sha256(msg.encode()).hexdigest()
+            fields["prompt_chars"] = len(msg)
+        logger.info(json.dumps({"event": "route", **fields}))
+        if self.decisions_log is not None:
+            get_decisions_log(self.decisions_log).write(json.dumps(fields) + "\n")
+
+    async def process(self, msg: str):
+        features = extract_features(msg)
+        if features["hint"] is not None:
+            msg = msg[HINT_PATTERN.match(msg).end() :]  # type: ignore
+        rule, candidates = self.config.route(features, STATS)
+        last_error: Exception | None = None
+        self.metered_handler.started = False
+        for name in candidates:
+            stats = STATS.setdefault(name, BackendStats())
+            stats.last_request = time.monotonic()
+            try:
+                backend = await self._backend(name)
+            except exceptions.LLMException as e:
+                # Not available (missing API key, dependency, ...), try the next
+                stats.record(None, None, True)
+                last_error = e
+                continue
+            self.current = backend
+            self.metered_handler.reset()
+            error = None
+            try:
+                await backend.process(msg)
+            except Exception as e:  # pylint: disable=broad-except
+                error = e
+            end = time.perf_counter()
+            first_token = self.metered_handler.first_token
+            ttft = None
+            tokens_per_s = None
+            if first_token is not None:
+                ttft = first_token - self.metered_handler.start_time
+                if end > first_token:
+                    tokens_per_s = self.metered_handler.n_tokens / (end - first_token)
+            stats.record(ttft, tokens_per_s, error is not None)
+            self._log_decision(
+                msg,
+                time=time.time(),
+                session_id=self.session_id,
+                tokens=features["tokens"],
+                has_code=features["has_code"],
+                hint=features["hint"],
+                rule=rule,
+                backend=name,
+                ttft=ttft,
+                tokens_per_s=tokens_per_s,
+                output_tokens=self.metered_handler.n_tokens,
+                error=None if error is None else str(error),
+            )
+            if error is None:
+                return
+            if first_token is not None:
+                # Part of the answer already reached the client
+                raise error
+            last_error = error
+        raise exceptions.LLMException(
+            f"No backend available for the rule '{rule}': {last_error}"
+        )
+
+
+LLMS["router"] = RouterLLM
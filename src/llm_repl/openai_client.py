@@ -0,0 +1,136 @@
+"""
+Minimal async client of the OpenAI chat completions streaming API.
+
+It is used by the LLMs that talk to OpenAI directly instead of going through
+LangChain: the request is built from the messages, and the deltas are
+yielded as soon as their Server Sent Event is parsed.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+
+from functools import lru_cache
+from typing import Any, AsyncIterator, Dict, List, Set
+
+import aiohttp
+
+from llm_repl import exceptions
+
+DEFAULT_API_BASE = "https://api.openai.com/v1"
+# Seconds after which the warm up request is abandoned
+WARMUP_TIMEOUT = 10
+
+
+class OpenAIChatClient:
+    """
+    Async client of the chat completions API.
+
+    The underlying HTTP session (and so its pool of connections) is shared by
+    all the sessions using the client.
+
+    :param str api_key: The OpenAI API key
+    :param str api_base: The base URL of the API
+    """
+
+    def __init__(self, api_key: str, api_base: str = DEFAULT_API_BASE):
+        self.api_key = api_key
+        self.api_base = api_base.rstrip("/")
+        self._http: aiohttp.ClientSession | None = None
+        self._http_loop: asyncio.AbstractEventLoop | None = None
+
+    @property
+    def http(self) -> aiohttp.ClientSession:
+        """
+        Return the HTTP session of the running event loop
+        """
+        loop = asyncio.get_running_loop()
+        if self._http is None or self._http.closed or self._http_loop is not loop:
+            self._http = aiohttp.ClientSession(
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=aiohttp.ClientTimeout(total=None, sock_read=600),
+            )
+            self._http_loop = loop
+        return self._http
+
+    async def warmup(self):
+        """
+        Open a connection to the API, so that the first request doesn't pay
+        for the DNS resolution and the TLS handshake
+        """
+        try:
+            async with self.http.get(
+                f"{self.api_base}/models",
+                timeout=aiohttp.ClientTimeout(total=WARMUP_TIMEOUT),
+            ) as resp:
+                await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+
+    async def close(self):
+        """
+        Close the HTTP session, if opened by the running event loop
+        """
+        if self._http is not None and self._http_loop is asyncio.get_running_loop():
+            await self._http.close()
+            self._http = None
+            self._http_loop = None
+
+    async def stream(
+        self, model: str, messages: List[Dict[str, str]], **params: Any
+    ) -> AsyncIterator[str]:
+        """
+        Request a chat completion and yield the content deltas as they arrive
+
+        :param str model: The name of the model
+        :param list messages: The messages of the conversation
+
+        :raises exceptions.LLMException: if the API returns an error
+        """
+        payload = {"model": model, "messages": messages, "stream": True, **params}
+        async with self.http.post(
+            f"{self.api_base}/chat/completions", json=payload
+        ) as resp:
+            if resp.status >= 400:
+                raise exceptions.LLMException(
+                    f"OpenAI API error {resp.status}: {await resp.text()}"
+                )
+            async for line in resp.content:
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                choices = json.loads(data).get("choices")
+                if not choices:
+                    continue
+                content = choices[0].get("delta", {}).get("content")
+                if content:
+                    yield content
+
+
+# The clients returned by get_shared_client
+SHARED_CLIENTS: Set[OpenAIChatClient] = set()
+
+
+@lru_cache(maxsize=None)
+def get_shared_client(api_key: str, api_base: str | None = None) -> OpenAIChatClient:
+    """
+    Return the client shared by all the sessions using the same API key
+
+    :param str api_key: The OpenAI API key
+    :param str api_base: The base URL of the API (DEFAULT: $OPENAI_API_BASE)
+    """
+    if api_base is None:
+        api_base = os.getenv("OPENAI_API_BASE", DEFAULT_API_BASE)
+    client = OpenAIChatClient(api_key, api_base)
+    SHARED_CLIENTS.add(client)
+    return client
+
+
+async def close_shared_clients():
+    """
+    Close the HTTP sessions of the shared clients, when the REPL shuts down
+    """
+    await asyncio.gather(*(client.close() for client in SHARED_CLIENTS))
@@ -0,0 +1,303 @@
+"""
+Streaming post-processing of the tokens generated by the LLMs.
+
+The tokens go through a pipeline of stages before reaching the client. Each
+stage works on a small rolling buffer: it emits the text that can no longer
+be affected by the tokens still to come and holds back the rest, so the
+whole output is never scanned again.
+"""
+from __future__ import annotations
+
+import re
+
+from typing import Iterable, List
+
+try:
+    from re import _parser as sre_parse  # type: ignore
+except ImportError:  # Python 3.10
+    import sre_parse  # pylint: disable=deprecated-module
+
+FENCE = "```"
+# A fence (with its info string) in the middle of a complete line
+MID_LINE_FENCE = re.compile(r"```\w*\n")
+# The end of an incomplete line that may become a fence
+PARTIAL_FENCE = re.compile(r"(```\w*|`{1,2})$")
+
+
+class TokenStage:
+    """
+    Stage of the pipeline, passing the text through unchanged
+    """
+
+    def __init__(self):
+        self.stopped = False
+
+    def feed(self, text: str) -> str:
+        """
+        Process the new text and return the text ready to be emitted
+
+        :param str text: The new text
+        """
+        return text
+
+    def flush(self) -> str:
+        """
+        Return the text held back, at the end of the stream
+        """
+        return ""
+
+    def reset(self):
+        """
+        Reset the state of the stage, before a new stream
+        """
+        self.stopped = False
+
+
+class StopSequences(TokenStage):
+    """
+    Stop the stream as soon as one of the stop sequences is generated, the
+    stop sequence and what follows it are never emitted.
+
+    Only the end of the text that may be the beginning of a stop sequence is
+    held back.
+
+    :param list stops: The stop sequences
+    """
+
+    def __init__(self, stops: Iterable[str]):
+        super().__init__()
+        self.stops = [stop for stop in stops if stop]
+        self.max_hold = max((len(stop) for stop in self.stops), default=1) - 1
+        self.buffer = ""
+
+    def _held_back(self) -> int:
+        """
+        Return the length of the longest end of the buffer that is the
+        beginning of a stop sequence
+        """
+        for length in range(min(self.max_hold, len(self.buffer)), 0, -1):
+            tail = self.buffer[-length:]
+            if any(stop.startswith(tail) for stop in self.stops):
+                return length
+        return 0
+
+    def feed(self, text: str) -> str:
+        if self.stopped:
+            return ""
+        self.buffer += text
+        matches = [i for i in (self.buffer.find(stop) for stop in self.stops) if i >= 0]
+        if matches:
+            self.stopped = True
+            text, self.buffer = self.buffer[: min(matches)], ""
+            return text
+        cut = len(self.buffer) - self._held_back()
+        text, self.buffer = self.buffer[:cut], self.buffer[cut:]
+        return text
+
+    def flush(self) -> str:
+        text, self.buffer = self.buffer, ""
+        return text
+
+    def reset(self):
+        super().reset()
+        self.buffer = ""
+
+
+class Redaction(TokenStage):
+    """
+    Replace the matches of the regular expressions in the stream.
+
+    The last `window` characters are held back, as they may be the beginning
+    of a match. By default the window is just shorter than the longest
+    possible match, or MAX_WINDOW characters if the matches are unbounded
+    (with `+` or `*`), then they are expected to be shorter than that.
+
+    :param list patterns: The regular expressions to redact
+    :param str replacement: The replacement of the matches
+    :param int window: The number of characters held back
+                       (DEFAULT: computed from the patterns)
+    """
+
+    MAX_WINDOW = 64
+
+    def __init__(
+        self,
+        patterns: Iterable[str],
+        replacement: str = "[REDACTED]",
+        window: int | None = None,
+    ):
+        super().__init__()
+        self.pattern = re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
+        self.replacement = replacement
+        self.window = window if window is not None else self._max_window()
+        self.buffer = ""
+
+    def _max_window(self) -> int:
+        """
+        Return the number of characters that may be the beginning of a match
+        """
+        _, max_length = sre_parse.parse(self.pattern.pattern).getwidth()
+        return max(0, min(max_length - 1, self.MAX_WINDOW))
+
+    def feed(self, text: str) -> str:
+        self.buffer += text
+        cut = len(self.buffer) - self.window
+        if cut <= 0:
+            return ""
+        # Never cut through a match, it may still grow
+        for match in self.pattern.finditer(self.buffer):
+            if match.start() < cut <= match.end():
+                cut = match.start()
+                break
+        text, self.buffer = self.buffer[:cut], self.buffer[cut:]
+        return self.pattern.sub(self.replacement, text)
+
+    def flush(self) -> str:
+        text, self.buffer = self.buffer, ""
+        return self.pattern.sub(self.replacement, text)
+
+    def reset(self):
+        super().reset()
+        self.buffer = ""
+
+
+class FenceNormalizer(TokenStage):
+    """
+    Normalize the markdown code fences: every fence is emitted as a whole
+    line of its own, at the beginning of the emitted text, and the code
+    block left open at the end of the stream is closed.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.buffer = ""
+        self.at_line_start = True
+        self.in_code = False
+
+    def feed(self, text: str) -> str:
+        self.buffer += text
+        out: List[str] = []
+        while self.buffer:
+            if self.at_line_start:
+                stripped = self.buffer.lstrip(" \t")
+                if stripped.startswith(FENCE):
+                    end = stripped.find("\n")
+                    # Wait for the whole fence line
+                    if end < 0:
+                        break
+                    out.append(stripped[: end + 1].rstrip() + "\n")
+                    self.buffer = stripped[end + 1 :]
+                    self.in_code = not self.in_code
+                    continue
+                # Wait for the text to tell if the line is a fence
+                if FENCE.startswith(stripped):
+                    break
+            end = self.buffer.find("\n")
+            line = self.buffer if end < 0 else self.buffer[: end + 1]
+            fence = MID_LINE_FENCE.search(line)
+            if fence is not None and (fence.start() > 0 or not self.at_line_start):
+                # A fence in the middle of a line is moved to its own line
+                out.append(line[: fence.start()] + "\n")
+                self.buffer = self.buffer[fence.start() :]
+                self.at_line_start = True
+                continue
+            partial = PARTIAL_FENCE.search(line) if end < 0 else None
+            if partial is not None:
+                out.append(line[: partial.start()])
+                self.buffer = line[partial.start() :]
+                self.at_line_start = self.at_line_start and partial.start() == 0
+                break
+            out.append(line)
+            self.buffer = self.buffer[len(line) :]
+            self.at_line_start = end >= 0
+        return "".join(out)
+
+    def flush(self) -> str:
+        text, self.buffer = self.buffer, ""
+        stripped = text.lstrip(" \t")
+        if stripped.startswith(FENCE):
+            # The stream ends with a fence
+            text = ("" if self.at_line_start else "\n") + stripped.rstrip() + "\n"
+            self.in_code = not self.in_code
+        if self.in_code:
+            if (text and not text.endswith("\n")) or (
+                not text and not self.at_line_start
+            ):
+                text += "\n"
+            text += FENCE + "\n"
+        return text
+
+    def reset(self):
+        super().reset()
+        self.buffer = ""
+        self.at_line_start = True
+        self.in_code = False
+
+
+class TokenPipeline:
+    """
+    The stages the tokens go through, in order
+
+    :param list stages: The stages of the pipeline
+    """
+
+    def __init__(self, stages: Iterable[TokenStage] | None = None):
+        self.stages = list(stages) if stages is not None else []
+        # The text emitted for the current stream
+        self.output: List[str] = []
+
+    @property
+    def stopped(self) -> bool:
+        """Return whether a stage stopped the current stream"""
+        return any(stage.stopped for stage in self.stages)
+
+    def _run(self, text: str, flush: bool) -> str:
+        stopped = False
+        for stage in self.stages:
+            text = stage.feed(text) if text else ""
+            stopped = stopped or stage.stopped
+            # Nothing more will come after a stop
+            if flush or stopped:
+                text += stage.flush()
+        if text:
+            self.output.append(text)
+        return text
+
+    def feed(self, text: str) -> str:
+        """
+        Process a new token and return the text ready to be emitted
+
+        :param str text: The token
+        """
+        return self._run(text, flush=False)
+
+    def flush(self) -> str:
+        """
+        Return the text held back by the stages, at the end of the stream
+        """
+        return self._run("", flush=True)
+
+    def reset(self):
+        """
+        Reset the stages, before a new stream
+        """
+        for stage in self.stages:
+            stage.reset()
+        self.output = []
+
+
+def build_stages(
+    stop: Iterable[str] | None = None, redact: Iterable[str] | None = None
+) -> List[TokenStage]:
+    """
+    Build the stages stopping and redacting the stream
+
+    :param list stop: The stop sequences
+    :param list redact: The regular expressions to redact
+    """
+    stages: List[TokenStage] = []
+    if stop:
+        stages.append(StopSequences(stop))
+    if redact:
+        stages.append(Redaction(redact))
+    return stages
@@ -2,7 +2,10 @@ import asyncio
 
 from abc import ABC, abstractmethod
 from functools import lru_cache
-from typing import Dict, Type
+from typing import Dict, Iterable, Type
+
+from llm_repl import exceptions
+from llm_repl.pipeline import TokenPipeline, build_stages
 
 
 class BaseClientHandler(ABC):
@@ -12,6 +15,8 @@ class BaseClientHandler(ABC):
         # Queue to hold the tokens generated by the LLM.
         # These tokens are then consumed by the client
         self.tokens: asyncio.Queue[str] = asyncio.Queue()
+        # Post-processing of the tokens before they reach the queue
+        self.pipeline = TokenPipeline()
 
     @property
     def start_token(self) -> str:
@@ -23,13 +28,54 @@ class BaseClientHandler(ABC):
         """Return the marker that act as end token"""
         return ""
 
+    def setup_pipeline(
+        self, stop: Iterable[str] | None = None, redact: Iterable[str] | None = None
+    ):
+        """
+        Add the stages stopping and redacting the stream in front of the
+        pipeline
+
+        :param list stop: The stop sequences
+        :param list redact: The regular expressions to redact
+        """
+        self.pipeline.stages[:0] = build_stages(stop, redact)
+
     async def add_token(self, token: str):
         """
-        Add a token to the queue to be consumed by the client
+        Add a token to the queue to be consumed by the client, after it went
+        through the pipeline
 
         :param str token: The token to be added to the queue
+
+        :raises exceptions.StreamStopped: if the pipeline stopped the stream,
+                                          the LLM must close the upstream
+                                          stream and end the answer
         """
-        await self.tokens.put(token)
+        if not self.pipeline.stages:
+            await self.tokens.put(token)
+            return
+        if token == self.start_token:
+            # A stopped pipeline holds nothing back, it can be reset even if
+            # the LLM didn't end the previous answer
+            if self.pipeline.stopped:
+                self.pipeline.reset()
+            await self.tokens.put(token)
+            return
+        if token == self.end_token:
+            # Release the text held back and get ready for the next answer
+            text = self.pipeline.flush()
+            if text:
+                await self.tokens.put(text)
+            self.pipeline.reset()
+            await self.tokens.put(token)
+            return
+        if self.pipeline.stopped:
+            return
+        text = self.pipeline.feed(token)
+        if text:
+            await self.tokens.put(text)
+        if self.pipeline.stopped:
+            raise exceptions.StreamStopped("".join(self.pipeline.output))
 
     @abstractmethod
     async def start(self, llm_name, **llm_kwargs):
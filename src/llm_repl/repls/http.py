@@ -1,12 +1,16 @@
 import uvicorn
 import asyncio
 import json
+import time
 import uuid
 
+from collections import deque
+from itertools import islice
+
 from fastapi import FastAPI, Request
 from pydantic import BaseModel, BaseSettings  # pylint: disable=no-name-in-module
 
-from typing import List, Dict
+from typing import Any, AsyncIterator, Deque, List, Dict, Tuple
 
 from llm_repl import exceptions
 from llm_repl.repls import BaseREPL, BaseClientHandler, REPLS
@@ -16,10 +20,15 @@ from sse_starlette.sse import EventSourceResponse
 
 # FIXME: Make this configurable
 SSE_PING_INTERVAL = 600  # minutes
+# Number of events of each stream kept to be replayed on reconnection
+STREAM_BUFFER_SIZE = 4096
+# Seconds a stream is kept after its last event
+STREAM_TTL = 300
 
 
 class Settings(BaseSettings):
     llm_name: str = "chatgpt"
+    llm_kwargs: Dict[str, Any] = {}
 
 
 settings = Settings()
@@ -29,23 +38,173 @@ app = FastAPI()
 class Params(BaseModel):
     model: str
     messages: List[Dict[str, str]]
+    stop: str | List[str] | None = None
+
+
+class SSEStream:
+    """
+    Bounded replay buffer of the events of a single SSE stream.
+
+    Each event gets a monotonically increasing sequence number, so a client
+    reconnecting with the id of the last event it received can be sent only
+    the events it missed, and then follow the generation if still running.
+    A follower falling behind the evicted events gets a "gap" event instead
+    of the events it can no longer receive.
+
+    :param str stream_id: The unique identifier of the stream
+    :param int maxlen: The maximum number of events kept in the buffer
+    """
+
+    def __init__(self, stream_id: str, maxlen: int = STREAM_BUFFER_SIZE):
+        self.stream_id = stream_id
+        self.events: Deque[Tuple[int, str, str]] = deque(maxlen=maxlen)
+        self.next_seq = 0
+        self.done = False
+        self.updated_at = time.monotonic()
+        self.updated = asyncio.Condition()
+
+    @property
+    def first_seq(self) -> int:
+        """Return the sequence number of the oldest event still in the buffer"""
+        return self.events[0][0] if self.events else self.next_seq
+
+    def is_expired(self, now: float) -> bool:
+        return now - self.updated_at > STREAM_TTL
+
+    def can_resume(self, last_seq: int) -> bool:
+        """
+        Return whether all the events after the given one are still available
+
+        :param int last_seq: The sequence number of the last event received
+        """
+        return self.first_seq <= last_seq + 1 <= self.next_seq
+
+    async def append(self, data: str, done: bool = False, event: str = "new_message"):
+        """
+        Append a new event to the stream
+
+        :param str data: The data of the event
+        :param bool done: Whether this is the last event of the stream
+        :param str event: The type of the event
+        """
+        async with self.updated:
+            self.events.append((self.next_seq, event, data))
+            self.next_seq += 1
+            self.done = done
+            self.updated_at = time.monotonic()
+            self.updated.notify_all()
+
+    async def follow(self, last_seq: int = -1) -> AsyncIterator[Tuple[int, str, str]]:
+        """
+        Yield the sequence number, the type and the data of the events after
+        the given one, waiting for the new ones until the stream is done.
+
+        If some of these events were already evicted from the buffer, a "gap"
+        event with the number of missed events is yielded first, its sequence
+        number is the one of the last evicted event.
+
+        :param int last_seq: The sequence number of the last event received
+        """
+        while True:
+            async with self.updated:
+                if last_seq + 1 >= self.next_seq:
+                    if self.done:
+                        return
+                    await self.updated.wait()
+                    continue
+                first_seq = self.first_seq
+                start = max(0, last_seq + 1 - first_seq)
+                pending = list(islice(self.events, start, None))
+            if last_seq + 1 < first_seq:
+                yield first_seq - 1, "gap", json.dumps(
+                    {"missed": first_seq - last_seq - 1}
+                )
+            for seq, event, data in pending:
+                yield seq, event, data
+                last_seq = seq
+
+
+# Live and recently completed streams, by stream id
+STREAMS: Dict[str, SSEStream] = {}
+
+
+def open_stream() -> SSEStream:
+    """
+    Create and register a new stream, dropping the expired ones
+    """
+    now = time.monotonic()
+    for stream_id in [sid for sid, s in STREAMS.items() if s.is_expired(now)]:
+        del STREAMS[stream_id]
+    stream = SSEStream(uuid.uuid4().hex)
+    STREAMS[stream.stream_id] = stream
+    return stream
+
+
+def find_resumable_stream(last_event_id: str | None) -> Tuple[SSEStream | None, int]:
+    """
+    Return the stream, and the sequence number, identified by the id of the
+    last event received by a client if the stream can be resumed from there
+
+    :param str last_event_id: The value of the Last-Event-ID header
+    """
+    if not last_event_id or ":" not in last_event_id:
+        return None, -1
+    stream_id, seq = last_event_id.rsplit(":", 1)
+    stream = STREAMS.get(stream_id)
+    if stream is None or not seq.isdigit() or not stream.can_resume(int(seq)):
+        return None, -1
+    return stream, int(seq)
+
+
+async def sse_events(request: Request, stream: SSEStream, last_seq: int = -1):
+    """
+    Send the events of the stream to the client as Server Sent Events (SSE)
+
+    :param Request request: The request of the client
+    :param SSEStream stream: The stream to send
+    :param int last_seq: The sequence number of the last event already received
+    """
+    async for seq, event, data in stream.follow(last_seq):
+        # If client closes connection, stop sending events
+        if await request.is_disconnected():
+            break
+        yield {
+            "event": event,
+            "id": f"{stream.stream_id}:{seq}",
+            "retry": HttpClientHandler.RETRY_TIMEOUT,
+            "data": data,
+        }
+
+
+def sse_response(events) -> EventSourceResponse:
+    event_source = EventSourceResponse(events)
+    event_source.ping_interval = SSE_PING_INTERVAL
+    return event_source
 
 
 @app.post("/v1/chat/completions")
 async def message_stream(request: Request, params: Params):
+    # Reattach to the stream of a client that reconnected after a network
+    # error, without asking the LLM to generate the answer again
+    stream, last_seq = find_resumable_stream(request.headers.get("last-event-id"))
+    if stream is not None:
+        return sse_response(sse_events(request, stream, last_seq))
     # FIXME: Handle memory
     message = params.messages[-1]["content"]
     # TODO: Manage reproducible client id
     client_id = uuid.uuid4().hex
     client_handler = HttpREPL.get_client_handler(client_id, request=request)
+    # Stop sequences of the request, on top of the configured ones
+    llm_kwargs = dict(settings.llm_kwargs)
+    if params.stop:
+        stop = [params.stop] if isinstance(params.stop, str) else params.stop
+        llm_kwargs["stop"] = list(llm_kwargs.get("stop") or []) + stop
     # Setup the LLM
-    await client_handler.start(settings.llm_name)  # TODO: Handle error
+    await client_handler.start(settings.llm_name, **llm_kwargs)  # TODO: Handle error
     # In the meantime let the LLM process the message
     asyncio.create_task(client_handler.process(message=message))  # type: ignore
     # Setup the SSE response
-    event_source = EventSourceResponse(client_handler.print_loop())
-    event_source.ping_interval = SSE_PING_INTERVAL
-    return event_source
+    return sse_response(sse_events(request, client_handler.stream))  # type: ignore
 
 
 class HttpClientHandler(BaseClientHandler):
@@ -59,6 +218,10 @@ class HttpClientHandler(BaseClientHandler):
         super().__init__()
         self.request = request
         self.llm: BaseLLM | None = None
+        self.stream = open_stream()
+        self.print_task: asyncio.Task | None = None
+        # Prefix of the queued errors, followed by the message of the error
+        self._error_token = f"\0error-{uuid.uuid4().hex}:"
 
     @property
     def start_token(self) -> str:
@@ -70,14 +233,14 @@ class HttpClientHandler(BaseClientHandler):
         """Return the marker that act as end token"""
         return "[DONE]"
 
-    def _load_llm(self, llm_name: str, **_llm_kwargs) -> BaseLLM:
+    def _load_llm(self, llm_name: str, **llm_kwargs) -> BaseLLM:
         """
         Load the selected LLM
         """
         if llm_name not in LLMS:
             raise exceptions.LLMNotFound(llm_name)
         llm_class = LLMS[llm_name]
-        return llm_class.load(self)
+        return llm_class.load(self, **llm_kwargs)
 
     async def start(self, llm_name, **llm_kwargs):
         """
@@ -85,33 +248,45 @@ class HttpClientHandler(BaseClientHandler):
 
         :param str llm_name: The name of the LLM to load
         """
-        self.llm = self._load_llm(llm_name, **llm_kwargs)
+        self.setup_pipeline(
+            llm_kwargs.pop("stop", None), llm_kwargs.pop("redact", None)
+        )
+        # Reading the configuration and building the LLM is blocking
+        self.llm = await asyncio.to_thread(self._load_llm, llm_name, **llm_kwargs)
+        self.print_task = asyncio.create_task(self.print_loop())
 
     async def print_loop(self):
         """
-        Process the tokens in the queue and send them to the client as
-        Server Sent Events (SSE)
+        Process the tokens in the queue and append them, as Server Sent Events
+        (SSE) data, to the stream of the client.
+
+        The stream is consumed independently by the SSE responses, so the
+        generation goes on (and can be resumed) if the client disconnects.
         """
-        while True:
-            # If client closes connection, stop sending events
-            if await self.request.is_disconnected():
-                break
-            # Checks for new messages and return them to client if any
-            token = await self.tokens.get()
-            if token:
-                response = {
-                    "event": "new_message",
-                    "id": "message_id",
-                    "retry": self.RETRY_TIMEOUT,
-                }
+        try:
+            while True:
+                token = await self.tokens.get()
                 if token == self.end_token:
-                    response["data"] = "[DONE]"
-                else:
-                    response["data"] = json.dumps(
-                        {"choices": [{"delta": {"content": token}}]}
+                    await self.stream.append("[DONE]", done=True)
+                    self.tokens.task_done()
+                    break
+                if token.startswith(self._error_token):
+                    await self._append_error(token[len(self._error_token) :])
+                elif token:
+                    await self.stream.append(
+                        json.dumps({"choices": [{"delta": {"content": token}}]})
                     )
                 self.tokens.task_done()
-                yield response
+        finally:
+            # Never leave the followers of the stream waiting forever
+            if not self.stream.done:
+                await self._append_error("The stream was interrupted")
+                await self.stream.append("[DONE]", done=True)
+
+    async def _append_error(self, message: str):
+        await self.stream.append(
+            json.dumps({"error": {"message": message}}), event="error"
+        )
 
     async def process(self, message: str):
         """
@@ -119,7 +294,16 @@ class HttpClientHandler(BaseClientHandler):
 
         :param str message: The message to process
         """
-        await self.llm.process(message)  # type: ignore
+        try:
+            await self.llm.process(message)  # type: ignore
+        except Exception as e:  # pylint: disable=broad-except
+            # Queued after the tokens already generated, the print loop ends
+            # the stream with the error and then the end event
+            await self.tokens.put(f"{self._error_token}{e}")
+            await self.tokens.put(self.end_token)
+        finally:
+            # Every request has its own session
+            await self.llm.close()  # type: ignore
 
 
 class HttpREPL(BaseREPL):
@@ -134,7 +318,7 @@ class HttpREPL(BaseREPL):
     def create_client_handler(**kwargs) -> BaseClientHandler:
         return HttpClientHandler(**kwargs)
 
-    async def run(self, llm_name: str, **_llm_kwargs):
+    async def run(self, llm_name: str, **llm_kwargs):
         """
         Starts the REPL
 
@@ -142,6 +326,7 @@ class HttpREPL(BaseREPL):
         """
         print(f"Starting HTTP REPL with LLM {llm_name} on port {self.port}")
         settings.llm_name = llm_name
+        settings.llm_kwargs = llm_kwargs
         config = uvicorn.Config(app, host="0.0.0.0", port=self.port, reload=True)
         server = uvicorn.Server(config=config)
         await server.serve()
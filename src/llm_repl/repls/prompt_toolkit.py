@@ -1,19 +1,34 @@
+import re
 import sys
 import asyncio
 
+from typing import Any, Dict, List, Tuple
+from uuid import uuid4
+
 from pydantic import BaseModel  # pylint: disable=no-name-in-module
 
 from prompt_toolkit import PromptSession
-from prompt_toolkit.completion import NestedCompleter
+from prompt_toolkit.application import run_in_terminal
+from prompt_toolkit.completion import DynamicCompleter, NestedCompleter
 from prompt_toolkit.key_binding import KeyBindings
 
 from rich.console import Console
 from rich.markdown import Markdown
 
 from llm_repl import exceptions
-from llm_repl.llms import BaseLLM, LLMS
+from llm_repl.history import (
+    DEFAULT_HISTORY_PATH,
+    HistorySearchCompleter,
+    SQLiteHistory,
+)
+from llm_repl.journal import SessionJournal
+from llm_repl.llms import BaseLLM, ChatSession, LLMS
+from llm_repl.pipeline import FenceNormalizer
 from llm_repl.repls import BaseREPL, REPLS, BaseClientHandler
 
+# The code fences, normalized as whole lines by the pipeline
+FENCE_LINE = re.compile(r"^(```[^\n]*\n)", re.MULTILINE)
+
 # FIXME: This is temporary for test. This will be passed in the configuration file
 
 
@@ -42,13 +57,35 @@ class PromptToolkitClientHandler(BaseClientHandler):
         misc_msg_color="gray",
     )
 
-    def __init__(self, style: None | REPLStyle = None):
+    def __init__(
+        self,
+        style: None | REPLStyle = None,
+        history_path: str = DEFAULT_HISTORY_PATH,
+    ):
+        """
+        Constructor
+
+        :param REPLStyle style: The colors of the messages
+        :param str history_path: Path of the database of the prompt history
+        """
         super().__init__()
         self.console = Console()
         self.completer_function_table = self._basic_completer_function_table
+        self.commands_completer = self._commands_completer()
+        # Ctrl+R switches the completer to the search in the history
+        self.history = SQLiteHistory(history_path)
+        self.history_completer = HistorySearchCompleter(self.history)
+        self.history_search = False
         self.kb = KeyBindings()
         self.session: PromptSession = PromptSession(
             key_bindings=self.kb,
+            history=self.history,
+            completer=DynamicCompleter(
+                lambda: self.history_completer
+                if self.history_search
+                else self.commands_completer
+            ),
+            bottom_toolbar=self._toolbar,
             vi_mode=True,
             complete_while_typing=True,
             complete_in_thread=True,
@@ -56,10 +93,23 @@ class PromptToolkitClientHandler(BaseClientHandler):
         self._style = style if style is not None else self.DEFAULT_STYLE
         # This will hold the reference to the model currently loaded
         self.llm: BaseLLM | None = None
+        # The LLM being loaded in background, it replaces the current one
+        # as soon as it is loaded
+        self.llm_task: asyncio.Task | None = None
+        self.loading_llm_name = ""
+        self.llm_kwargs: Dict[str, Any] = {}
+        self._warmup_task: asyncio.Task | None = None
+        # Closing the LLM replaced by the last one loaded
+        self._close_task: asyncio.Task | None = None
         self.parse_markdown = True
         self.is_code_mode = False
         self.code_block = ""
         self.queue_is_empty_condition = asyncio.Condition()
+        # The code blocks are rendered as a whole, so their fences have to be
+        # detected reliably
+        self.pipeline.stages.append(FenceNormalizer())
+        # The conversation is journaled so that it can be resumed later
+        self.session_id = uuid4().hex
 
     @property
     def style(self) -> REPLStyle:
@@ -71,7 +121,8 @@ class PromptToolkitClientHandler(BaseClientHandler):
             "info": self.info,
             "exit": self.exit,
             "quit": self.exit,
-            "llm": self.load_llm,
+            "llm": self.switch_llm,
+            "transcript": self.transcript,
         }
 
     @property
@@ -90,33 +141,145 @@ class PromptToolkitClientHandler(BaseClientHandler):
         """
         Print the information about the LLM currently loaded
         """
-        llm_info = self.llm.info  # type: ignore
-        self.print_misc_msg(llm_info)
+        if self.llm is None:
+            self.print_misc_msg(f"Loading {self.loading_llm_name}...")
+            return
+        self.print_misc_msg(self.llm.info)
+
+    async def transcript(self):
+        """
+        Print the whole transcript of the conversation
+        """
+        await asyncio.to_thread(self._print_turns, await self._transcript_turns())
+
+    def switch_llm(self, llm_name: str | None = None):
+        """
+        Load the LLM specified by the name in background, it replaces the
+        current one as soon as it is loaded. Without a name, print the
+        available LLMs.
+
+        :param str llm_name: The name of the LLM to load
+        """
+        if llm_name is None:
+            current = self.llm.name if self.llm is not None else "none"
+            self.print_misc_msg(
+                f"Current model: {current}\n\nAvailable LLMs: {', '.join(LLMS)}"
+            )
+            return
+        if llm_name not in LLMS:
+            self.print_error_msg(f"LLM '{llm_name}' not found.")
+            return
+        # The load can't be interrupted once started, loading another LLM
+        # at the same time would race with it on the journal
+        if self.llm_task is not None and not self.llm_task.done():
+            self.print_error_msg(
+                f"Already loading {self.loading_llm_name}, wait for it to load."
+            )
+            return
+        self.loading_llm_name = llm_name
+        self.llm_task = asyncio.create_task(
+            self.load_llm_async(
+                llm_name,
+                session_id=self.session_id,
+                # The first LLM opens the journal, the next ones take over
+                # its conversation
+                journal=self.llm is None,
+                **self.llm_kwargs,
+            )
+        )
+        self.llm_task.add_done_callback(self._on_llm_loaded)
+
+    def _on_llm_loaded(self, task: asyncio.Task):
+        """
+        Swap in the LLM just loaded in background, while the user is still
+        typing, start warming it up and close the previous one
+
+        :param asyncio.Task task: The task that loaded the LLM
+        """
+        # Refresh the toolbar
+        self.session.app.invalidate()
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            msg = (
+                error.msg if isinstance(error, exceptions.LLMException) else str(error)
+            )
+            run_in_terminal(lambda: self.print_error_msg(msg))
+            return
+        llm = task.result()
+        previous = self.llm
+        # The new LLM takes over the conversation
+        session = getattr(previous, "session", None)
+        if session is not None and hasattr(llm, "session"):
+            llm.session = session  # type: ignore
+        # and its long-term memory, so that a single memory writes the index
+        # of the session
+        vector_memory = getattr(previous, "vector_memory", None)
+        if vector_memory is not None and hasattr(llm, "vector_memory"):
+            llm.vector_memory = vector_memory  # type: ignore
+            previous.vector_memory = None  # type: ignore
+        self.llm = llm
+        self._register_llm_commands(llm)
+        run_in_terminal(lambda: self.print_misc_msg(f"Loaded model: {llm.name}"))
+        # Pre-connect to the upstream while the user types the message
+        self._warmup_task = asyncio.create_task(llm.warmup())
+        if previous is not None:
+            self._close_task = asyncio.create_task(previous.close())
+
+    def _close_journal(self):
+        """
+        Close the journal of the current LLM, if any
+        """
+        journal = getattr(getattr(self.llm, "session", None), "journal", None)
+        if journal is not None:
+            journal.close()
 
     def exit(self):
         """
         Exit the application
         """
+        if self.llm is not None:
+            self._close_journal()
+            self.print_misc_msg(
+                f"Resume this conversation with `llm-repl --resume {self.session_id}`"
+            )
         self.console.print()
         self.console.rule(style=self._style.misc_msg_color)
+        self.history.close()
         sys.exit(0)
 
-    def load_llm(self, llm_name: str, **_llm_kwargs) -> BaseLLM:
+    async def load_llm_async(self, llm_name: str, **llm_kwargs) -> BaseLLM:
         """
-        Load the LLM specified by the name and its custom commands if any
+        Load the LLM specified by the name in an executor thread, so that
+        the event loop is not blocked while the LLM is built. Its custom
+        commands are registered when it replaces the current LLM.
 
         :param str llm_name: The name of the LLM to load
 
         :raises exceptions.LLMNotFound: if the LLM is not found
         :raises exceptions.LLMException: if the LLM fails to load
         """
+        return await asyncio.to_thread(self._instantiate_llm, llm_name, **llm_kwargs)
+
+    def _instantiate_llm(self, llm_name: str, **llm_kwargs) -> BaseLLM:
+        """
+        Build the LLM specified by the name
+
+        :param str llm_name: The name of the LLM to load
+        """
         if llm_name not in LLMS:
             raise exceptions.LLMNotFound(llm_name)
 
         llm_class = LLMS[llm_name]
-        llm = llm_class.load(self)
+        return llm_class.load(self, **llm_kwargs)
+
+    def _register_llm_commands(self, llm: BaseLLM):
+        """
+        Add LLMs specific custom commands to the completer and to the function table
 
-        # Add LLMs specific custom commands to the completer and to the function table
+        :param BaseLLM llm: The LLM just loaded
+        """
         custom_commands_table = {}
         for custom_command in llm.custom_commands:  # type: ignore
             custom_commands_table[custom_command["name"]] = custom_command["function"]
@@ -124,11 +287,31 @@ class PromptToolkitClientHandler(BaseClientHandler):
         self.completer_function_table = (
             self._basic_completer_function_table | custom_commands_table
         )
-        self.session.completer = NestedCompleter.from_nested_dict(
-            {cmd: None for cmd in self.completer_function_table.keys()}
-        )
+        self.commands_completer = self._commands_completer()
         self.session.app.invalidate()
-        return llm
+
+    def _commands_completer(self) -> NestedCompleter:
+        """
+        Build the completer of the commands, completing the names of the LLMs
+        after the `llm` command
+        """
+        commands: Dict[str, Any] = {
+            cmd: None for cmd in self.completer_function_table.keys()
+        }
+        commands["llm"] = {llm_name: None for llm_name in LLMS}
+        return NestedCompleter.from_nested_dict(commands)
+
+    def _toolbar(self) -> str | None:
+        """
+        Return the content of the bottom toolbar: the model loading and the
+        history search status
+        """
+        status = []
+        if self.llm_task is not None and not self.llm_task.done():
+            status.append(f"Loading {self.loading_llm_name}...")
+        if self.history_search:
+            status.append("(history search)")
+        return " | ".join(status) if status else None
 
     # ----------------------------- END COMMANDS -----------------------------
 
@@ -141,6 +324,11 @@ class PromptToolkitClientHandler(BaseClientHandler):
 
         :param event: The event object.
         """
+        # Accept the prompt picked from the history without sending it
+        if self.history_search:
+            self.history_search = False
+            event.current_buffer.complete_state = None
+            return
         # Get the current buffer text
         text = event.app.current_buffer.text
         # Check if the last two characters are newlines
@@ -204,6 +392,17 @@ class PromptToolkitClientHandler(BaseClientHandler):
         justify = kwargs.pop("justify", "left")
         self._print_msg("", msg, self._style.misc_msg_color, justify=justify)
 
+    def _print_markdown(self, msg: str, **kwargs):
+        """
+        Render the markdown message and print it in the console.
+
+        Rendering is CPU bound, call it in an executor thread from the
+        event loop.
+
+        :param str msg: The markdown message to be printed.
+        """
+        self.console.print(Markdown(msg), **kwargs)
+
     def _setup_keybindings(self):
         """
         Setup keybindings for the prompt
@@ -213,6 +412,15 @@ class PromptToolkitClientHandler(BaseClientHandler):
         def _(event):
             self.handle_enter(event)
 
+        # Toggle the incremental search in the history with Ctrl+R
+        @self.kb.add("c-r")
+        def _(event):
+            self.history_search = not self.history_search
+            if self.history_search:
+                event.current_buffer.start_completion(select_first=False)
+            else:
+                event.current_buffer.cancel_completion()
+
         # Exit gracefully with Ctrl+D
         @self.kb.add("c-d")
         def _(_):
@@ -250,45 +458,106 @@ class PromptToolkitClientHandler(BaseClientHandler):
             # parse the markdown incrementally since we already have the
             # whole message
             if not self.llm.is_in_streaming_mode:  # type: ignore
-                self.console.print(Markdown(msg), end="")
+                await asyncio.to_thread(self._print_markdown, msg, end="")
                 self.tokens.task_done()
                 continue
-            # Otherwise, we need to parse the markdown incrementally
-            # FIXME: This is just an hack to make the code blocks work
-            #        This should be done properly in the future
-            if msg == "\n\n":
-                msg = ""
-            if msg == "``" or msg == "```":
-                if self.code_block:
-                    self.console.print(Markdown(self.code_block + "```\n"))
-                    self.code_block = ""
+            # Otherwise, we need to parse the markdown incrementally: the
+            # text is printed as it comes, the code blocks are buffered and
+            # rendered when their closing fence is received
+            for part in FENCE_LINE.split(msg):
+                if FENCE_LINE.fullmatch(part):
+                    if self.is_code_mode:
+                        await asyncio.to_thread(
+                            self._print_markdown, self.code_block + part
+                        )
+                        self.code_block = ""
+                    else:
+                        self.code_block = part
                     self.is_code_mode = not self.is_code_mode
-                    self.tokens.task_done()
-                    continue
-                self.is_code_mode = not self.is_code_mode
-                self.code_block = msg
-            elif self.is_code_mode:
-                self.code_block += msg
-            else:
-                if msg == "`\n" or msg == "`\n\n":
-                    msg = "\n"
-                self.console.print(msg, end="")
+                elif self.is_code_mode:
+                    self.code_block += part
+                elif part:
+                    self.console.print(part, end="")
             self.tokens.task_done()
 
+    async def _transcript_turns(self) -> List[Tuple[str, str]]:
+        """
+        Return the turns of the conversation, read from its journal since the
+        LLM may only remember the most recent ones
+        """
+        # The first LLM loads the journal and drops its incomplete record,
+        # don't read it meanwhile
+        if self.llm is None and self.llm_task is not None:
+            await asyncio.wait({self.llm_task})
+        return await asyncio.to_thread(self._read_transcript)
+
+    def _read_transcript(self) -> List[Tuple[str, str]]:
+        """
+        Read the turns of the conversation from its journal
+        """
+        if not SessionJournal.exists(self.session_id):
+            return []
+        return [
+            (ChatSession.ROLE_NAMES[role], content)
+            for role, content in SessionJournal(self.session_id).read()
+        ]
+
+    def _print_turns(self, turns: List[Tuple[str, str]]):
+        """
+        Print the turns of a conversation
+
+        :param list turns: The turns as (role name, content) tuples
+        """
+        for role, content in turns:
+            if role == "user":
+                self.print_client_msg(content)
+            else:
+                self.print_server_msg(content)
+
+    async def _print_last_screen(self):
+        """
+        Print the turns of the resumed conversation that fit in the screen,
+        the older ones are printed only with the `transcript` command
+        """
+        turns = await self._transcript_turns()
+        height, width = self.console.size.height, self.console.size.width
+        lines, first = 0, len(turns)
+        while first > 0:
+            content = turns[first - 1][1]
+            # Two rulers and the wrapped lines of the content
+            lines += 2 + sum(1 + len(line) // width for line in content.splitlines())
+            if lines > height:
+                break
+            first -= 1
+        if first > 0:
+            self.print_misc_msg(
+                f"{first} earlier turns, type `transcript` to print them all"
+            )
+        await asyncio.to_thread(self._print_turns, turns[first:])
+
     async def start(self, llm_name: str, **llm_kwargs):
         # Setup the keybindings for the Terminal prompt
         self._setup_keybindings()
-        # Load the specified LLM
-        try:
-            self.llm = self.load_llm(llm_name)
-        except exceptions.LLMException as e:
-            self.print_error_msg(e.msg)
-            return
+        self.setup_pipeline(
+            llm_kwargs.pop("stop", None), llm_kwargs.pop("redact", None)
+        )
+        resume = llm_kwargs.pop("resume", None)
+        if resume is not None:
+            if not SessionJournal.exists(resume):
+                self.print_error_msg(f"Conversation '{resume}' not found.")
+                return
+            self.session_id = resume
+        self.llm_kwargs = llm_kwargs
+        # Load the specified LLM in background, the user can start typing
+        # in the meantime
+        self.switch_llm(llm_name)
         # Start the print loop
         asyncio.create_task(self.print_loop())
         self.print_misc_msg(
-            f"{self.INTRO_BANNER}\n\nLoaded model: {self.llm.name}", justify="center"  # type: ignore
+            f"{self.INTRO_BANNER}\n\nLoading model: {llm_name}", justify="center"
         )
+        if resume is not None:
+            await self._print_last_screen()
 
         while True:
             # Wait if something is getting printed
@@ -298,11 +567,29 @@ class PromptToolkitClientHandler(BaseClientHandler):
             user_input = user_input.rstrip()
             # Check if the input is a custom command
             if user_input in self.completer_function_table:
-                self.completer_function_table[user_input]()
+                result = self.completer_function_table[user_input]()
+                # Commands doing I/O are coroutines, not to block the loop
+                if asyncio.iscoroutine(result):
+                    await result
+                continue
+            command, _, llm_name = user_input.partition(" ")
+            if command == "llm" and llm_name.strip():
+                self.switch_llm(llm_name.strip())
                 continue
             # Otherwise, process the input as a normal message that has
-            # to be sent to the LLM
-            self.print_client_msg(user_input)
+            # to be sent to the LLM, as soon as the LLM is loaded
+            await asyncio.to_thread(self.print_client_msg, user_input)
+            if self.llm is None and self.llm_task is not None:
+                if not self.llm_task.done():
+                    self.print_misc_msg(
+                        f"Waiting for {self.loading_llm_name} to load..."
+                    )
+                    # The done callback, registered first, swaps in the LLM
+                    # before this wait returns
+                    await asyncio.wait({self.llm_task})
+            if self.llm is None:
+                self.print_error_msg("No model loaded, load one with `llm <name>`.")
+                continue
             if not self.llm.is_in_streaming_mode:
                 self.print_misc_msg(self.LOADING_MSG)
             await self.llm.process(user_input)
@@ -311,7 +598,10 @@ class PromptToolkitClientHandler(BaseClientHandler):
 class PromptToolkitREPL(BaseREPL):
     def __init__(self, *_args, **kwargs):
         style = kwargs.pop("style", None)
-        self.client_handler = self.get_client_handler("prompt_toolkit", style=style)
+        history_path = kwargs.pop("history_path", None) or DEFAULT_HISTORY_PATH
+        self.client_handler = self.get_client_handler(
+            "prompt_toolkit", style=style, history_path=history_path
+        )
 
     @staticmethod
     def create_client_handler(**kwargs) -> BaseClientHandler:
@@ -1,40 +1,112 @@
 import asyncio
+import json
+import time
+import uuid
 
+from http import HTTPStatus
+from typing import Any, Callable, Coroutine, Dict, List
+
+from websockets.exceptions import ConnectionClosed
 from websockets.server import serve
 
 from llm_repl import exceptions
 from llm_repl.llms import BaseLLM, LLMS
 from llm_repl.repls import BaseREPL, BaseClientHandler, REPLS
+from llm_repl.supervisor import ClientSupervisor
+
+try:
+    import msgpack  # type: ignore
+except ImportError:
+    msgpack = None
+
+# Subprotocols of the framed protocol, by order of preference. Clients that
+# don't negotiate any of them get the legacy plain text protocol.
+SUBPROTOCOL_MSGPACK = "llm-repl.v1.msgpack"
+SUBPROTOCOL_JSON = "llm-repl.v1.json"
+SUBPROTOCOLS = ([SUBPROTOCOL_MSGPACK] if msgpack is not None else []) + [
+    SUBPROTOCOL_JSON
+]
+
+
+# Type codes of the framed messages, the first item of each message:
+# [START], [DELTA, text], [END, tokens, frames, ttft_ms, duration_ms] and
+# [ERROR, message]
+FRAME_START, FRAME_DELTA, FRAME_END, FRAME_ERROR = range(4)
+
+
+def _encode_json(message: List[Any]) -> str:
+    return json.dumps(message, separators=(",", ":"))
+
+
+MESSAGE_ENCODERS: Dict[str, Callable[[List[Any]], str | bytes]] = {
+    SUBPROTOCOL_JSON: _encode_json,
+}
+if msgpack is not None:
+    MESSAGE_ENCODERS[SUBPROTOCOL_MSGPACK] = msgpack.packb
 
 
 class WebsocketClientHandler(BaseClientHandler):
     """
-    Client that handles a single client SSE connection
+    Client that handles a single client SSE connection.
+
+    Clients that negotiate one of the SUBPROTOCOLS get typed messages (arrays
+    starting with one of the FRAME_* type codes) encoded as compact JSON text
+    frames or msgpack binary frames, with the tokens batched in delta
+    messages. The other clients get one text frame per token and the "EOF"
+    end marker.
     """
 
-    def __init__(self, websocket):
+    # Maximum number of tokens batched in a single delta message
+    MAX_BATCH_SIZE = 64
+    # Number of tokens after which a delta message is sent without waiting
+    # for more tokens
+    MIN_BATCH_SIZE = 16
+    # Maximum seconds to wait for more tokens while the queue is empty
+    BATCH_WINDOW = 0.01
+
+    def __init__(
+        self,
+        websocket,
+        spawn: Callable[[Coroutine], asyncio.Task] = asyncio.create_task,
+    ):
+        """
+        Constructor
+
+        :param Websocket websocket: The websocket of the client
+        :param callable spawn: Function starting the tasks of the client
+        """
         super().__init__()
         self.websocket = websocket
+        self.spawn = spawn
         self.llm: BaseLLM | None = None
+        self.subprotocol: str | None = getattr(websocket, "subprotocol", None)
+        self.encode = MESSAGE_ENCODERS.get(self.subprotocol)  # type: ignore
+        # In the framed protocol the markers never reach the client, so they
+        # only need to be distinct from anything the LLM can generate
+        marker = uuid.uuid4().hex
+        self._start_token = "" if self.encode is None else f"\0start-{marker}"
+        self._end_token = "EOF" if self.encode is None else f"\0end-{marker}"
+        # Prefix of the queued errors, followed by the message of the error
+        self._error_token = f"\0error-{marker}:"
 
     @property
     def start_token(self) -> str:
         """Return the marker that act as start token"""
-        return ""
+        return self._start_token
 
     @property
     def end_token(self) -> str:
         """Return the marker that act as end token"""
-        return "EOF"
+        return self._end_token
 
-    def _load_llm(self, llm_name: str, **_llm_kwargs) -> BaseLLM:
+    def _load_llm(self, llm_name: str, **llm_kwargs) -> BaseLLM:
         """
         Load the selected LLM
         """
         if llm_name not in LLMS:
             raise exceptions.LLMNotFound(llm_name)
         llm_class = LLMS[llm_name]
-        return llm_class.load(self)
+        return llm_class.load(self, **llm_kwargs)
 
     async def start(self, llm_name, **llm_kwargs):
         """
@@ -43,35 +115,167 @@ class WebsocketClientHandler(BaseClientHandler):
         :param str llm_name: The name of the LLM to load
         """
         # TODO: Handle errors
-        self.llm = self._load_llm(llm_name, **llm_kwargs)
-        asyncio.create_task(self.print_loop())
+        self.setup_pipeline(
+            llm_kwargs.pop("stop", None), llm_kwargs.pop("redact", None)
+        )
+        # Reading the configuration and building the LLM is blocking
+        self.llm = await asyncio.to_thread(self._load_llm, llm_name, **llm_kwargs)
+        self.spawn(self.print_loop())
 
     async def print_loop(self):
         """
         Process the tokens in the queue and send them to the client as websocket
         packets
         """
+        if self.encode is not None:
+            await self._framed_print_loop()
+            return
         while True:
             token = await self.tokens.get()
             await self.websocket.send(token)
             self.tokens.task_done()
 
+    def _is_marker(self, token: str) -> bool:
+        return token in (self.start_token, self.end_token) or token.startswith(
+            self._error_token
+        )
+
+    async def _next_batch(self, wait: bool = True) -> List[str]:
+        """
+        Return the next tokens of the queue, up to the next marker.
+
+        The tokens already queued are taken right away. While the batch has
+        fewer than MIN_BATCH_SIZE tokens and the queue is empty, it waits up
+        to BATCH_WINDOW seconds in total for more tokens.
+
+        :param bool wait: Whether to wait for more tokens, False to send the
+                          first tokens of an answer right away
+        """
+        tokens = [await self.tokens.get()]
+        if self._is_marker(tokens[0]):
+            return tokens
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.BATCH_WINDOW
+        while len(tokens) < self.MAX_BATCH_SIZE:
+            if not self.tokens.empty():
+                token = self.tokens.get_nowait()
+            elif not wait or len(tokens) >= self.MIN_BATCH_SIZE:
+                break
+            else:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    token = await asyncio.wait_for(self.tokens.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            tokens.append(token)
+            if self._is_marker(token):
+                break
+        return tokens
+
+    async def _framed_print_loop(self):
+        """
+        Send the tokens to the client as typed messages, batching the tokens
+        in delta messages
+        """
+        n_tokens = n_frames = 0
+        started_at = first_token_at = time.perf_counter()
+        while True:
+            tokens = await self._next_batch(wait=n_tokens > 0)
+            delta = ""
+            for token in tokens:
+                if token == self.start_token:
+                    n_tokens = n_frames = 0
+                    started_at = first_token_at = time.perf_counter()
+                    await self.websocket.send(self.encode([FRAME_START]))
+                elif token.startswith(self._error_token):
+                    if delta:
+                        await self.websocket.send(self.encode([FRAME_DELTA, delta]))
+                        n_frames += 1
+                        delta = ""
+                    await self.websocket.send(
+                        self.encode([FRAME_ERROR, token[len(self._error_token) :]])
+                    )
+                elif token == self.end_token:
+                    if delta:
+                        await self.websocket.send(self.encode([FRAME_DELTA, delta]))
+                        n_frames += 1
+                        delta = ""
+                    now = time.perf_counter()
+                    await self.websocket.send(
+                        self.encode(
+                            [
+                                FRAME_END,
+                                n_tokens,
+                                n_frames,
+                                round((first_token_at - started_at) * 1000, 2),
+                                round((now - started_at) * 1000, 2),
+                            ]
+                        )
+                    )
+                elif token:
+                    if n_tokens == 0:
+                        first_token_at = time.perf_counter()
+                    n_tokens += 1
+                    delta += token
+            if delta:
+                await self.websocket.send(self.encode([FRAME_DELTA, delta]))
+                n_frames += 1
+            for _ in tokens:
+                self.tokens.task_done()
+
     async def process(self, message: str):
         """
         Process the message received from the client
 
         :param str message: The message received from the client
         """
-        await self.llm.process(message)  # type: ignore
+        if self.encode is None:
+            await self.llm.process(message)  # type: ignore
+            return
+        try:
+            await self.llm.process(message)  # type: ignore
+        except Exception as e:  # pylint: disable=broad-except
+            # Queued after the tokens already generated, so that the error is
+            # sent in order, and followed by the end of the answer
+            await self.tokens.put(f"{self._error_token}{e}")
+            await self.tokens.put(self.end_token)
 
 
 class WebsocketREPL(BaseREPL):
-    def __init__(self, port: int = 8765, **kwargs):
+    # Seconds of inactivity after which a client is disconnected
+    IDLE_TTL = 600.0
+
+    def __init__(
+        self,
+        port: int = 8765,
+        compression: bool = True,
+        max_clients: int | None = None,
+        idle_ttl: float | None = None,
+        **kwargs,
+    ):
         """
         Constructor
+
+        :param int port: The port to listen on
+        :param bool compression: Whether to offer the permessage-deflate extension
+        :param int max_clients: The maximum number of clients served at once,
+                                0 to serve them all (DEFAULT: no limit)
+        :param float idle_ttl: Seconds of inactivity after which a client is
+                               disconnected, 0 to never disconnect them
+                               (DEFAULT: IDLE_TTL)
         """
+        self.compression = compression
         self.llm_name: None | str = None
+        self.llm_kwargs: Dict[str, Any] = {}
         self.port = port
+        if idle_ttl is None:
+            idle_ttl = self.IDLE_TTL
+        self.supervisor = ClientSupervisor(
+            max_clients=max_clients or None,
+            idle_ttl=idle_ttl or None,
+        )
 
     @staticmethod
     def create_client_handler(**kwargs) -> BaseClientHandler:
@@ -92,13 +296,53 @@ class WebsocketREPL(BaseREPL):
         # token = await websocket.recv() if websocket.open else None
         # if token is None:
         #     return
-        client_handler = WebsocketREPL.create_client_handler(websocket=websocket)
-        await client_handler.start(self.llm_name)
+        try:
+            client = self.supervisor.admit(websocket.close)
+        except exceptions.TooManyClients as e:
+            await websocket.close(ClientSupervisor.CLOSE_TRY_AGAIN_LATER, e.msg)
+            return
+        try:
+            client_handler = WebsocketREPL.create_client_handler(
+                websocket=websocket,
+                # The print loop sending the tokens can only fail when the
+                # client is gone
+                spawn=lambda coro: self.supervisor.spawn(client, coro, critical=True),
+            )
+            client.handler = client_handler
+            # Release the client as soon as the connection is closed, even
+            # in the middle of an answer
+            self.supervisor.spawn(client, websocket.wait_closed(), critical=True)
+            await self.supervisor.run(
+                client, client_handler.start(self.llm_name, **self.llm_kwargs)
+            )
+            async for msg in websocket:
+                if client.released:
+                    break
+                await self.supervisor.run(
+                    client, client_handler.process(msg)  # type: ignore
+                )
+        except ConnectionClosed:
+            # The client went away, nothing left to do but cleaning up
+            pass
+        finally:
+            llm = getattr(client.handler, "llm", None)
+            await self.supervisor.release(client)
+            if llm is not None:
+                await llm.close()
+
+    async def _process_request(self, path: str, _request_headers):
+        """
+        Answer the plain HTTP requests for the live statistics of the clients,
+        before the websocket handshake
 
-        async for msg in websocket:
-            await client_handler.process(msg)  # type: ignore
+        :param str path: The path of the request
+        """
+        if path.split("?")[0] != "/stats":
+            return None
+        body = json.dumps(self.supervisor.stats()).encode()
+        return HTTPStatus.OK, [("Content-Type", "application/json")], body
 
-    async def run(self, llm_name: str, **_llm_kwargs):
+    async def run(self, llm_name: str, **llm_kwargs):
         """
         Starts the REPL
 
@@ -106,10 +350,22 @@ class WebsocketREPL(BaseREPL):
         """
         print(f"Starting Websocket REPL with LLM {llm_name} on port {self.port}")
         self.llm_name = llm_name
+        self.llm_kwargs = llm_kwargs
         # TODO: Check if the chosen LLM can be used
         # TODO: Make the port configurable
-        async with serve(self._handle_msg, "localhost", self.port):
-            await asyncio.Future()
+        self.supervisor.start()
+        try:
+            async with serve(
+                self._handle_msg,
+                "localhost",
+                self.port,
+                subprotocols=SUBPROTOCOLS,  # type: ignore
+                compression="deflate" if self.compression else None,
+                process_request=self._process_request,
+            ):
+                await asyncio.Future()
+        finally:
+            await self.supervisor.stop()
 
 
 REPLS["websocket"] = WebsocketREPL
@@ -0,0 +1,95 @@
+"""
+The event loop running the REPLs.
+
+The loop implementation can be chosen (the stdlib one or uvloop, faster at
+the socket I/O of the server REPLs), the tasks are started eagerly where
+supported (Python 3.12+) and the size of the default executor, running the
+blocking work offloaded with asyncio.to_thread, can be tuned.
+"""
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Coroutine
+
+from llm_repl import exceptions
+
+LOOPS = ("asyncio", "uvloop")
+
+
+def loop_factory(loop: str) -> Callable[[], asyncio.AbstractEventLoop]:
+    """
+    Return the function creating an event loop of the given implementation
+
+    :param str loop: The name of the implementation, one of LOOPS
+
+    :raises exceptions.MissingDependency: if uvloop is requested but not
+                                          installed
+    """
+    if loop not in LOOPS:
+        raise ValueError(f"Unknown event loop '{loop}'.")
+    if loop == "uvloop":
+        try:
+            import uvloop  # pylint: disable=import-outside-toplevel
+        except ImportError as e:
+            raise exceptions.MissingDependency("uvloop", "UVLOOP") from e
+        return uvloop.new_event_loop
+    return asyncio.new_event_loop
+
+
+def supports_eager_tasks() -> bool:
+    """Return whether the tasks can be started eagerly (Python 3.12+)"""
+    return hasattr(asyncio, "eager_task_factory")
+
+
+def new_event_loop(
+    loop: str = "asyncio",
+    eager_tasks: bool = True,
+    executor_workers: int | None = None,
+) -> asyncio.AbstractEventLoop:
+    """
+    Create and configure an event loop
+
+    :param str loop: The name of the implementation, one of LOOPS
+    :param bool eager_tasks: Whether to start the tasks eagerly, running
+                             them synchronously until their first suspension
+                             (ignored before Python 3.12)
+    :param int executor_workers: The number of threads of the default
+                                 executor (DEFAULT: CPUs + 4, at most 32)
+    """
+    event_loop = loop_factory(loop)()
+    if eager_tasks and supports_eager_tasks():
+        event_loop.set_task_factory(asyncio.eager_task_factory)  # type: ignore
+    event_loop.set_default_executor(
+        ThreadPoolExecutor(
+            max_workers=executor_workers,
+            thread_name_prefix="llm-repl",
+        )
+    )
+    return event_loop
+
+
+def run(coro: Coroutine[Any, Any, Any], **loop_kwargs) -> Any:
+    """
+    Run the coroutine in a new event loop until it completes, then shut the
+    loop down
+
+    :param coroutine coro: The coroutine to run
+    :param dict loop_kwargs: The configuration of the loop, see new_event_loop
+    """
+    event_loop = new_event_loop(**loop_kwargs)
+    asyncio.set_event_loop(event_loop)
+    try:
+        return event_loop.run_until_complete(coro)
+    finally:
+        try:
+            tasks = asyncio.all_tasks(event_loop)
+            for task in tasks:
+                task.cancel()
+            event_loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True)
+            )
+            event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+            event_loop.run_until_complete(event_loop.shutdown_default_executor())
+        finally:
+            asyncio.set_event_loop(None)
+            event_loop.close()
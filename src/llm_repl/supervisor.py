@@ -0,0 +1,273 @@
+"""
+Supervision of the clients connected to a server REPL.
+
+The supervisor owns every task started for a client: when one of the
+critical tasks of a client ends (the connection closed, the print loop
+failed, ...) all its other tasks are cancelled and the client is released,
+so that its client handler, its LLM and their memory can be freed.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+
+from typing import Any, Awaitable, Callable, Coroutine, Dict, Set
+from uuid import uuid4
+
+from llm_repl import exceptions
+from llm_repl.repls import BaseClientHandler
+
+logger = logging.getLogger("llm_repl.supervisor")
+
+
+class SupervisedClient:
+    """
+    A client of the supervisor, with the tasks running on its behalf
+
+    :param str client_id: The ID of the client
+    :param callable close: Coroutine function closing the connection of the
+                           client with the given code and reason
+    """
+
+    __slots__ = (
+        "client_id",
+        "close",
+        "handler",
+        "tasks",
+        "busy",
+        "connected_at",
+        "last_active",
+        "released",
+    )
+
+    def __init__(self, client_id: str, close: Callable[[int, str], Awaitable[Any]]):
+        self.client_id = client_id
+        self.close = close
+        self.handler: BaseClientHandler | None = None
+        self.tasks: Set[asyncio.Task] = set()
+        # Number of messages being processed, a busy client is never idle
+        self.busy = 0
+        self.connected_at = self.last_active = time.monotonic()
+        self.released = False
+
+    def touch(self):
+        """
+        Record an activity of the client
+        """
+        self.last_active = time.monotonic()
+
+    def idle_for(self, now: float) -> float:
+        """
+        Return for how long (in seconds) the client has been idle
+
+        :param float now: The current time, from time.monotonic()
+        """
+        return 0.0 if self.busy else now - self.last_active
+
+    def as_dict(self, now: float) -> Dict[str, Any]:
+        llm = getattr(self.handler, "llm", None)
+        session = getattr(llm, "session", None)
+        tokens = getattr(self.handler, "tokens", None)
+        return {
+            "id": self.client_id,
+            "tasks": len(self.tasks),
+            "busy": self.busy > 0,
+            "age_s": round(now - self.connected_at, 2),
+            "idle_s": round(self.idle_for(now), 2),
+            "queued_tokens": tokens.qsize() if tokens is not None else 0,
+            "turns": len(session) if session is not None else 0,
+            "history_bytes": session.nbytes if session is not None else 0,
+        }
+
+
+class ClientSupervisor:
+    """
+    Admits the clients up to `max_clients`, owns their tasks and reaps the
+    connections idle for more than `idle_ttl` seconds.
+
+    :param int max_clients: The maximum number of clients served at once,
+                            None to serve them all
+    :param float idle_ttl: Seconds of inactivity after which a client is
+                           disconnected, None to never disconnect them
+    :param float reap_interval: Interval (in seconds) between two checks of
+                                the idle clients (DEFAULT: idle_ttl / 4)
+    """
+
+    # Close codes of the websocket protocol
+    CLOSE_GOING_AWAY = 1001
+    CLOSE_TRY_AGAIN_LATER = 1013
+
+    def __init__(
+        self,
+        max_clients: int | None = None,
+        idle_ttl: float | None = 600.0,
+        reap_interval: float | None = None,
+    ):
+        self.max_clients = max_clients
+        self.idle_ttl = idle_ttl
+        if reap_interval is None and idle_ttl is not None:
+            reap_interval = idle_ttl / 4
+        self.reap_interval = reap_interval
+        self.clients: Dict[str, SupervisedClient] = {}
+        self.rejected = 0
+        self.reaped = 0
+        self._reaper_task: asyncio.Task | None = None
+
+    @staticmethod
+    def _log(level: int, event: str, **fields):
+        logger.log(level, json.dumps({"event": event, **fields}))
+
+    def admit(self, close: Callable[[int, str], Awaitable[Any]]) -> SupervisedClient:
+        """
+        Admit a new client
+
+        :param callable close: Coroutine function closing the connection of
+                               the client with the given code and reason
+
+        :raises exceptions.TooManyClients: if the supervisor already serves
+                                           `max_clients` clients
+        """
+        if self.max_clients is not None and len(self.clients) >= self.max_clients:
+            self.rejected += 1
+            self._log(logging.WARNING, "client_rejected", clients=len(self.clients))
+            raise exceptions.TooManyClients(self.max_clients)
+        client = SupervisedClient(uuid4().hex, close)
+        self.clients[client.client_id] = client
+        return client
+
+    def spawn(
+        self, client: SupervisedClient, coro: Coroutine, critical: bool = False
+    ) -> asyncio.Task:
+        """
+        Run the coroutine in a task owned by the client
+
+        :param SupervisedClient client: The client
+        :param coroutine coro: The coroutine to run
+        :param bool critical: Whether the client is released when the task
+                              ends, cancelling all its other tasks
+        """
+        task = asyncio.create_task(coro)
+        if client.released:
+            task.cancel()
+            return task
+        client.tasks.add(task)
+        task.add_done_callback(client.tasks.discard)
+        if critical:
+            task.add_done_callback(lambda _: self._cancel(client))
+        return task
+
+    async def run(self, client: SupervisedClient, coro: Coroutine) -> Any:
+        """
+        Run the coroutine in a task owned by the client and wait for it.
+
+        Return None if the task was cancelled because the client was released.
+
+        :param SupervisedClient client: The client
+        :param coroutine coro: The coroutine to run
+        """
+        client.busy += 1
+        try:
+            task = self.spawn(client, coro)
+            await asyncio.wait({task})
+        finally:
+            client.busy -= 1
+            client.touch()
+        if task.cancelled():
+            return None
+        return task.result()
+
+    def _cancel(self, client: SupervisedClient):
+        """
+        Cancel all the tasks of the client and forget it
+        """
+        if client.released:
+            return
+        client.released = True
+        for task in client.tasks:
+            task.cancel()
+        self.clients.pop(client.client_id, None)
+        self._log(
+            logging.DEBUG,
+            "client_released",
+            client_id=client.client_id,
+            duration_s=round(time.monotonic() - client.connected_at, 2),
+        )
+
+    async def release(self, client: SupervisedClient):
+        """
+        Cancel all the tasks of the client, wait for them to end and forget
+        the client
+
+        :param SupervisedClient client: The client
+        """
+        tasks = list(client.tasks)
+        self._cancel(client)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        client.handler = None
+
+    async def _reap_idle_clients(self):
+        """
+        Disconnect the clients idle for more than `idle_ttl` seconds
+        """
+        while True:
+            await asyncio.sleep(self.reap_interval)  # type: ignore
+            now = time.monotonic()
+            idle = [
+                client
+                for client in self.clients.values()
+                if client.idle_for(now) > self.idle_ttl  # type: ignore
+            ]
+            for client in idle:
+                self.reaped += 1
+                self._log(
+                    logging.INFO,
+                    "client_reaped",
+                    client_id=client.client_id,
+                    idle_s=round(client.idle_for(now), 2),
+                )
+            # Closing the connections ends their critical tasks, which
+            # releases the clients
+            await asyncio.gather(
+                *(
+                    client.close(self.CLOSE_GOING_AWAY, "Idle timeout")
+                    for client in idle
+                ),
+                return_exceptions=True,
+            )
+
+    def start(self):
+        """
+        Start reaping the idle clients
+        """
+        if self.idle_ttl is not None and self._reaper_task is None:
+            self._reaper_task = asyncio.create_task(self._reap_idle_clients())
+
+    async def stop(self):
+        """
+        Stop reaping the idle clients and release all the clients
+        """
+        if self._reaper_task is not None:
+            self._reaper_task.cancel()
+            self._reaper_task = None
+        await asyncio.gather(
+            *(self.release(client) for client in list(self.clients.values()))
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return the live counts of the clients, their tasks and memory
+        """
+        now = time.monotonic()
+        sessions = [client.as_dict(now) for client in self.clients.values()]
+        return {
+            "sessions": len(sessions),
+            "max_clients": self.max_clients,
+            "tasks": sum(session["tasks"] for session in sessions),
+            "loop_tasks": len(asyncio.all_tasks()),
+            "history_bytes": sum(session["history_bytes"] for session in sessions),
+            "rejected": self.rejected,
+            "reaped": self.reaped,
+            "per_session": sessions,
+        }
@@ -0,0 +1,326 @@
+"""
+Long-term conversation memory backed by a local vector index.
+
+Every completed exchange is embedded and stored in a per-session index
+persisted on disk (a memory-mapped NumPy matrix plus a JSON lines file with
+the texts), so that only the exchanges relevant to the new message have to
+be sent to the LLM instead of the whole conversation.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import shutil
+
+from typing import Any, List, Tuple
+
+import numpy as np
+
+from llm_repl import STATE_DIR
+
+MEMORY_DIR = os.path.join(STATE_DIR, "memory")
+
+logger = logging.getLogger("llm_repl.vector_memory")
+
+
+class VectorIndex:
+    """
+    Append-only vector index stored in a memory-mapped file.
+
+    Rows are evicted in insertion order (oldest first), so the evicted rows
+    are always a prefix of the file. When the evicted prefix grows larger
+    than the live rows, the index is compacted by moving the live rows back
+    to the beginning of the file. The files are replaced in an order that
+    lets the index be reopened if the compaction is interrupted.
+
+    :param str path: Directory holding the files of the index
+    :param int dim: Dimension of the vectors
+    :param int max_entries: Maximum number of live rows before evicting
+    """
+
+    INITIAL_CAPACITY = 256
+
+    def __init__(self, path: str, dim: int, max_entries: int = 10000):
+        self.path = path
+        self.dim = dim
+        self.max_entries = max_entries
+        self.meta_path = os.path.join(path, "meta.json")
+        self.vectors_path = os.path.join(path, "vectors.f32")
+        self.entries_path = os.path.join(path, "entries.jsonl")
+        # Index of the first live row
+        self.start = 0
+        self.count = 0
+        self.capacity = 0
+        self.entries: List[Any] = []
+        self.vectors: np.memmap | None = None
+        os.makedirs(path, exist_ok=True)
+        if os.path.isfile(self.meta_path):
+            self._open()
+
+    def __len__(self) -> int:
+        return self.count - self.start
+
+    def _open(self):
+        with open(self.meta_path, "r") as f:
+            meta = json.load(f)
+        self.dim = meta["dim"]
+        self.start = meta["start"]
+        self.count = meta["count"]
+        self.capacity = meta["capacity"]
+        self.vectors = np.memmap(
+            self.vectors_path,
+            dtype=np.float32,
+            mode="r+",
+            shape=(self.capacity, self.dim),
+        )
+        with open(self.entries_path, "r") as f:
+            entries = [json.loads(line) for line in f]
+        if self.start > 0 and len(entries) == self.count - self.start:
+            # The compaction was interrupted after replacing the entries but
+            # before the meta, the live rows were already moved
+            self.start, self.count = 0, len(entries)
+        # Keep the rows aligned with the vectors, rows past the count belong
+        # to a write that was interrupted
+        self.entries = entries[: self.count]
+
+    def _meta(self) -> str:
+        return json.dumps(
+            {
+                "dim": self.dim,
+                "start": self.start,
+                "count": self.count,
+                "capacity": self.capacity,
+            }
+        )
+
+    def _save_meta(self):
+        # Replaced atomically, a crash never leaves half of it
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self._meta())
+        os.replace(tmp_path, self.meta_path)
+
+    def _resize(self, capacity: int):
+        """
+        Grow (or shrink) the file of the vectors to the given capacity
+        """
+        old = self.vectors
+        if old is not None:
+            old.flush()
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(capacity * self.dim * 4)
+        self.capacity = capacity
+        self.vectors = np.memmap(
+            self.vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim)
+        )
+
+    def add(self, vectors: np.ndarray, entries: List[Any]):
+        """
+        Add a batch of vectors and their entries to the index
+
+        :param np.ndarray vectors: The vectors, one per row
+        :param list entries: The JSON serializable entries of the vectors
+        """
+        needed = self.count + len(entries)
+        if needed > self.capacity:
+            self._resize(max(self.INITIAL_CAPACITY, self.capacity * 2, needed))
+        # Store normalized vectors so that the search is a dot product
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.vectors[self.count : needed] = vectors / np.maximum(norms, 1e-12)  # type: ignore
+        self.vectors.flush()  # type: ignore
+        with open(self.entries_path, "a") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        self.entries.extend(entries)
+        self.count = needed
+        # Evict the oldest rows
+        self.start = max(self.start, self.count - self.max_entries)
+        if self.start > len(self):
+            self.compact()
+        else:
+            self._save_meta()
+
+    def compact(self):
+        """
+        Drop the evicted rows from the files of the index
+        """
+        n_live = len(self)
+        # Compacted from add(), the live rows are moved over evicted rows
+        # only: the previous files stay valid until they are replaced
+        self.vectors[:n_live] = self.vectors[self.start : self.count]  # type: ignore
+        self.vectors.flush()  # type: ignore
+        self.entries = self.entries[self.start : self.count]
+        self.start, self.count = 0, n_live
+        tmp_entries_path = f"{self.entries_path}.tmp"
+        tmp_meta_path = f"{self.meta_path}.tmp"
+        with open(tmp_entries_path, "w") as f:
+            for entry in self.entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        with open(tmp_meta_path, "w") as f:
+            f.write(self._meta())
+            f.flush()
+            os.fsync(f.fileno())
+        # The entries first: _open() detects the entries replaced without
+        # the meta, while the other way round can't be told apart from an
+        # interrupted add()
+        os.replace(tmp_entries_path, self.entries_path)
+        os.replace(tmp_meta_path, self.meta_path)
+        # Shrink the vectors file once the meta no longer needs its rows,
+        # a file larger than the capacity is still valid
+        capacity = max(self.INITIAL_CAPACITY, n_live * 2)
+        if capacity < self.capacity:
+            self.capacity = capacity
+            self._save_meta()
+            self._resize(capacity)
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[float, Any]]:
+        """
+        Return the k most similar entries to the query, most similar first
+
+        :param np.ndarray query: The query vector
+        :param int k: The number of entries to return
+        """
+        if len(self) == 0 or k <= 0:
+            return []
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        scores = self.vectors[self.start : self.count] @ query  # type: ignore
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.entries[self.start + i]) for i in top]
+
+
+class VectorMemory:
+    """
+    Per-session long-term memory.
+
+    Completed exchanges are buffered and embedded in batches by a background
+    task, so that the embedding requests are never on the critical path of
+    the answer. Only the embedding of the new message is computed when the
+    prompt is built. The batches are indexed in a worker thread, the index
+    is locked meanwhile so that it is never searched half updated.
+
+    :param str session_id: The identifier of the session
+    :param embeddings: The LangChain embeddings used to embed the exchanges
+    :param int k: Number of relevant past exchanges to retrieve
+    :param int recent_exchanges: Number of most recent exchanges always sent
+                                 to the LLM, so they are not retrieved
+    :param int max_entries: Maximum number of exchanges kept in the index
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        embeddings: Any,
+        k: int = 4,
+        recent_exchanges: int = 2,
+        max_entries: int = 10000,
+    ):
+        self.session_id = session_id
+        self.embeddings = embeddings
+        self.k = k
+        self.recent_exchanges = recent_exchanges
+        self.max_entries = max_entries
+        self.path = os.path.join(MEMORY_DIR, session_id)
+        self.index: VectorIndex | None = None
+        if os.path.isfile(os.path.join(self.path, "meta.json")):
+            # The dimension is read from the index itself
+            self.index = VectorIndex(self.path, dim=0, max_entries=max_entries)
+        # Number of exchanges seen so far
+        self.n_exchanges = (
+            self.index.entries[-1]["n"] + 1
+            if self.index is not None and self.index.entries
+            else 0
+        )
+        self.pending: List[Any] = []
+        self.flush_task: asyncio.Task | None = None
+        self.lock = asyncio.Lock()
+        # The batch being indexed in a worker thread, if any
+        self.indexing: asyncio.Future | None = None
+
+    def add_exchange(self, user_msg: str, ai_msg: str):
+        """
+        Queue a completed exchange to be embedded and indexed
+
+        :param str user_msg: The message of the user
+        :param str ai_msg: The answer of the LLM
+        """
+        self.pending.append({"n": self.n_exchanges, "user": user_msg, "ai": ai_msg})
+        self.n_exchanges += 1
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        """
+        Embed and index all the pending exchanges in a single batch
+        """
+        while self.pending:
+            batch, self.pending = self.pending, []
+            try:
+                vectors = await self.embeddings.aembed_documents(
+                    [f"{entry['user']}\n{entry['ai']}" for entry in batch]
+                )
+            except Exception as e:  # pylint: disable=broad-except
+                # Keep the batch for the next flush, after the next exchange
+                self.pending = batch + self.pending
+                logger.warning(
+                    json.dumps(
+                        {
+                            "event": "embedding_failed",
+                            "session_id": self.session_id,
+                            "pending": len(self.pending),
+                            "error": str(e),
+                        }
+                    )
+                )
+                return
+            vectors = np.asarray(vectors, dtype=np.float32)
+            async with self.lock:
+                if self.index is None:
+                    self.index = VectorIndex(
+                        self.path, dim=vectors.shape[1], max_entries=self.max_entries
+                    )
+                self.indexing = asyncio.ensure_future(
+                    asyncio.to_thread(self.index.add, vectors, batch)
+                )
+                # The thread can't be interrupted, let it finish even if the
+                # flush is cancelled
+                await asyncio.shield(self.indexing)
+
+    async def retrieve(self, msg: str) -> List[Tuple[str, str]]:
+        """
+        Return the past exchanges relevant to the message, oldest first
+
+        :param str msg: The new message of the user
+        """
+        if self.index is None or len(self.index) == 0:
+            return []
+        query = np.asarray(await self.embeddings.aembed_query(msg), dtype=np.float32)
+        # The most recent exchanges are sent anyway, skip them
+        first_recent = self.n_exchanges - self.recent_exchanges
+        async with self.lock:
+            results = self.index.search(query, self.k + self.recent_exchanges)
+        entries = [entry for _, entry in results if entry["n"] < first_recent]
+        entries = sorted(entries[: self.k], key=lambda entry: entry["n"])
+        return [(entry["user"], entry["ai"]) for entry in entries]
+
+    async def close(self, remove: bool = False):
+        """
+        Stop indexing the pending exchanges and, if requested, delete the
+        index of the session
+
+        :param bool remove: Whether to delete the files of the index
+        """
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        # Wait for the batch being indexed in the worker thread, if any
+        if self.indexing is not None:
+            await asyncio.gather(self.indexing, return_exceptions=True)
+        async with self.lock:
+            if remove:
+                shutil.rmtree(self.path, ignore_errors=True)
+                self.index = None
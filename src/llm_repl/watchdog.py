@@ -0,0 +1,143 @@
+import asyncio
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from bisect import bisect_left
+from typing import Any, Dict, List
+
+logger = logging.getLogger("llm_repl.watchdog")
+
+
+class LagHistogram:
+    """
+    Histogram of the event loop lag
+    """
+
+    BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self):
+        # One extra bucket for the lags above the last bound
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.total = 0
+        self.max_ms = 0.0
+
+    def record(self, lag_ms: float):
+        """
+        Record a lag sample
+
+        :param float lag_ms: The lag in milliseconds
+        """
+        self.counts[bisect_left(self.BUCKETS_MS, lag_ms)] += 1
+        self.total += 1
+        self.max_ms = max(self.max_ms, lag_ms)
+
+    def as_dict(self) -> Dict[str, Any]:
+        buckets = {f"le_{bound}ms": n for bound, n in zip(self.BUCKETS_MS, self.counts)}
+        buckets[f"gt_{self.BUCKETS_MS[-1]}ms"] = self.counts[-1]
+        return {"samples": self.total, "max_ms": round(self.max_ms, 2), **buckets}
+
+
+class LoopWatchdog:
+    """
+    Measures the lag of the event loop and reports the code blocking it.
+
+    A heartbeat coroutine wakes up every `interval` seconds and records how
+    late it was woken up. A monitor thread checks the time of the last
+    heartbeat and, when the loop has been blocked for more than `threshold`
+    seconds, samples the stack of the loop thread so that the blocking code
+    is logged while it is still running.
+
+    :param float threshold: Lag (in seconds) above which the loop is stalled
+    :param float interval: Interval (in seconds) between two heartbeats
+    :param float report_interval: Interval (in seconds) between two histogram reports
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.1,
+        interval: float = 0.05,
+        report_interval: float = 60.0,
+    ):
+        self.threshold = threshold
+        self.interval = interval
+        self.report_interval = report_interval
+        self.histogram = LagHistogram()
+        self.last_beat = time.perf_counter()
+        self._beats = 0
+        self._loop_thread_id: int | None = None
+        self._heartbeat_task: asyncio.Task | None = None
+        self._stop = threading.Event()
+        self._monitor_thread: threading.Thread | None = None
+
+    @staticmethod
+    def _log(level: int, event: str, **fields):
+        logger.log(level, json.dumps({"event": event, **fields}))
+
+    def start(self):
+        """
+        Start the watchdog on the running event loop
+        """
+        self._loop_thread_id = threading.get_ident()
+        self.last_beat = time.perf_counter()
+        self._heartbeat_task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._monitor_thread = threading.Thread(
+            target=self._monitor, name="llm-repl-watchdog", daemon=True
+        )
+        self._monitor_thread.start()
+
+    def stop(self):
+        """
+        Stop the watchdog and report the lag histogram
+        """
+        self._stop.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        self._log(logging.INFO, "loop_lag_histogram", **self.histogram.as_dict())
+
+    async def _heartbeat(self):
+        last_report = time.perf_counter()
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            lag_ms = max(0.0, now - expected) * 1000
+            self.histogram.record(lag_ms)
+            self.last_beat = now
+            self._beats += 1
+            if lag_ms > self.threshold * 1000:
+                self._log(logging.WARNING, "loop_lag", lag_ms=round(lag_ms, 2))
+            if now - last_report > self.report_interval:
+                self._log(
+                    logging.INFO, "loop_lag_histogram", **self.histogram.as_dict()
+                )
+                last_report = now
+
+    def _sample_loop_stack(self) -> List[str]:
+        """
+        Return the stack of the event loop thread
+        """
+        frame = sys._current_frames().get(self._loop_thread_id)  # type: ignore
+        if frame is None:
+            return []
+        return [line.rstrip() for line in traceback.format_stack(frame)]
+
+    def _monitor(self):
+        # Heartbeat for which the stall has already been reported
+        reported_beat = -1
+        while not self._stop.wait(self.interval):
+            blocked = time.perf_counter() - self.last_beat
+            if (
+                blocked > self.threshold + self.interval
+                and reported_beat != self._beats
+            ):
+                reported_beat = self._beats
+                self._log(
+                    logging.WARNING,
+                    "loop_stall",
+                    blocked_ms=round(blocked * 1000, 2),
+                    stack=self._sample_loop_stack(),
+                )
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from llm_repl import exceptions
+from llm_repl.cassettes import Cassette, CassetteLibrary, CassetteRecorder, request_hash
+from llm_repl.llms.replay import ReplayChatGPT
+from llm_repl.repls import BaseClientHandler
+
+MESSAGES = [
+    {"role": "system", "content": "You are helpful"},
+    {"role": "user", "content": "Hello!"},
+]
+
+
+def test_request_hash_is_stable():
+    reordered = [{"content": m["content"], "role": m["role"]} for m in MESSAGES]
+
+    assert request_hash("gpt-4", MESSAGES) == request_hash("gpt-4", reordered)
+    assert len(request_hash("gpt-4", MESSAGES)) == 64
+
+
+def test_request_hash_depends_on_the_model_and_the_messages():
+    other = MESSAGES[:-1] + [{"role": "user", "content": "Hello"}]
+
+    assert request_hash("gpt-4", MESSAGES) != request_hash("gpt-3.5-turbo", MESSAGES)
+    assert request_hash("gpt-4", MESSAGES) != request_hash("gpt-4", other)
+    assert request_hash("gpt-4", MESSAGES) != request_hash("gpt-4", MESSAGES[1:])
+
+
+def test_recorded_cassette_is_found_by_its_request(tmp_path):
+    recorder = CassetteRecorder(str(tmp_path), "gpt-4", MESSAGES)
+    for token in ["Hi", " there"]:
+        recorder.record(token)
+    recorder.finish()
+
+    library = CassetteLibrary(str(tmp_path), strict=True)
+    cassette = library.find("gpt-4", MESSAGES)
+
+    assert cassette is not None
+    assert cassette.request_hash == request_hash("gpt-4", MESSAGES)
+    assert cassette.tokens == ["Hi", " there"]
+    assert len(cassette.delays) == 2
+    assert library.model == "gpt-4"
+    assert library.find("gpt-3.5-turbo", MESSAGES) is None
+
+
+def test_unknown_requests_are_served_in_turn(tmp_path):
+    for i in range(2):
+        Cassette(f"{i:064x}", "gpt-4", [f"answer {i}"], [0.0]).save(str(tmp_path))
+
+    library = CassetteLibrary(str(tmp_path))
+    answers = [library.find("gpt-4", MESSAGES).tokens[0] for _ in range(3)]
+
+    assert answers == ["answer 0", "answer 1", "answer 0"]
+
+
+class ListClientHandler(BaseClientHandler):
+    """Client handler collecting the tokens in a list"""
+
+    def __init__(self):
+        super().__init__()
+        self.received = []
+
+    async def add_token(self, token: str):
+        self.received.append(token)
+
+    async def start(self, llm_name, **llm_kwargs):
+        pass
+
+    async def print_loop(self):
+        pass
+
+
+def test_replay_streams_the_cassette(tmp_path):
+    Cassette("0" * 64, "gpt-4", ["Hi", " there"], [0.0, 0.0]).save(str(tmp_path))
+    handler = ListClientHandler()
+    llm = ReplayChatGPT.load(handler, cassettes=str(tmp_path), replay_speed=0)
+
+    asyncio.run(llm.process("Hello!"))
+
+    assert handler.received == ["", "Hi", " there", ""]
+    assert llm.session.turns() == [("user", "Hello!"), ("assistant", "Hi there")]
+
+
+def test_replay_fails_without_cassette(tmp_path):
+    Cassette("0" * 64, "gpt-4", ["Hi"], [0.0]).save(str(tmp_path))
+    handler = ListClientHandler()
+    llm = ReplayChatGPT.load(handler, cassettes=str(tmp_path), replay_speed=0)
+    llm.library.strict = True
+
+    with pytest.raises(exceptions.LLMException, match="No cassette"):
+        asyncio.run(llm.process("Hello!"))
+    assert llm.session.turns() == []
@@ -0,0 +1,75 @@
+import os
+
+from prompt_toolkit.document import Document
+
+from llm_repl.history import HistorySearchCompleter, SQLiteHistory
+
+
+def make_history(path, prompts):
+    history = SQLiteHistory(str(path))
+    for prompt in prompts:
+        history.store_string(prompt)
+    history.close()
+    return SQLiteHistory(str(path))
+
+
+def test_writer_thread_stores_the_prompts(tmp_path):
+    history = make_history(tmp_path / "history.db", ["first", "second"])
+
+    assert list(history.load_history_strings()) == ["second", "first"]
+    history.close()
+
+
+def test_recent_entries_only_are_loaded(tmp_path, monkeypatch):
+    monkeypatch.setattr(SQLiteHistory, "RECENT_ENTRIES", 2)
+    history = make_history(tmp_path / "history.db", ["a", "b", "c"])
+
+    assert list(history.load_history_strings()) == ["c", "b"]
+    assert history.search("a") == ["a"]
+    history.close()
+
+
+def test_bare_file_name(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    history = make_history("history.db", ["hello"])
+
+    assert os.path.isfile(tmp_path / "history.db")
+    assert list(history.load_history_strings()) == ["hello"]
+    history.close()
+
+
+def test_search_matches_word_prefixes(tmp_path):
+    history = make_history(
+        tmp_path / "history.db",
+        ["explain python decorators", "write a haiku", "python generators"],
+    )
+
+    assert history.search("pyth") == ["python generators", "explain python decorators"]
+    assert history.search("pyth deco") == ["explain python decorators"]
+    assert history.search("rust") == []
+    # Punctuation is not part of the full text query
+    assert history.search('"haiku"*') == ["write a haiku"]
+    history.close()
+
+
+def test_search_dedupes_and_orders_by_recency(tmp_path):
+    history = make_history(
+        tmp_path / "history.db", ["hello", "hello world", "hello", "other"]
+    )
+
+    assert history.search("hello") == ["hello", "hello world"]
+    assert history.search("") == ["other", "hello", "hello world"]
+    assert history.search("", limit=1) == ["other"]
+    history.close()
+
+
+def test_completer_replaces_the_whole_prompt(tmp_path):
+    history = make_history(tmp_path / "history.db", ["multi\nline prompt"])
+    document = Document("mul")
+
+    (completion,) = HistorySearchCompleter(history).get_completions(document, None)
+
+    assert completion.text == "multi\nline prompt"
+    assert completion.start_position == -3
+    assert completion.display_text == "multi line prompt"
+    history.close()
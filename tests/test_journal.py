@@ -0,0 +1,78 @@
+import os
+
+from llm_repl.journal import RECORD_HEADER, SessionJournal
+from llm_repl.llms import ChatSession
+
+
+def record_exchanges(journal: SessionJournal, n: int) -> ChatSession:
+    session = journal.load()
+    for i in range(n):
+        session.add_exchange(f"question {i}", f"answer {i} é")
+    journal.close()
+    return session
+
+
+def test_load_replays_the_journal(tmp_path):
+    session = record_exchanges(SessionJournal("s1", str(tmp_path)), 3)
+
+    resumed = SessionJournal("s1", str(tmp_path)).load()
+
+    assert resumed.turns() == session.turns()
+    assert len(resumed) == 6
+
+
+def test_load_drops_an_incomplete_record(tmp_path):
+    journal = SessionJournal("s1", str(tmp_path))
+    session = record_exchanges(journal, 2)
+    with open(journal.journal_path, "ab") as f:
+        f.write(RECORD_HEADER.pack(ChatSession.HUMAN, 100) + b"trunc")
+
+    resumed_journal = SessionJournal("s1", str(tmp_path))
+    resumed = resumed_journal.load()
+    resumed.add_exchange("after", "the crash")
+    resumed_journal.close()
+
+    turns = SessionJournal("s1", str(tmp_path)).read()
+    assert [content for _, content in turns] == [
+        content for _, content in session.turns()
+    ] + ["after", "the crash"]
+
+
+def test_snapshot_truncates_the_journal(tmp_path):
+    journal = SessionJournal("s1", str(tmp_path))
+    session = record_exchanges(journal, 5)
+
+    journal.snapshot()
+
+    assert os.path.getsize(journal.journal_path) == 0
+    resumed_journal = SessionJournal("s1", str(tmp_path))
+    resumed = resumed_journal.load()
+    assert resumed.turns() == session.turns()
+    resumed.add_exchange("new", "turn")
+    resumed_journal.close()
+    assert len(SessionJournal("s1", str(tmp_path)).read()) == 12
+
+
+def test_periodic_snapshots(tmp_path):
+    journal = SessionJournal("s1", str(tmp_path))
+    journal.SNAPSHOT_EVERY = 4
+    session = record_exchanges(journal, 10)
+
+    assert os.path.isfile(journal.snapshot_path)
+    assert SessionJournal("s1", str(tmp_path)).load().turns() == session.turns()
+
+
+def test_load_after_an_interrupted_truncation(tmp_path):
+    journal = SessionJournal("s1", str(tmp_path))
+    session = record_exchanges(journal, 3)
+    journal.snapshot()
+    # The journal was truncated but the snapshot still points to its old end
+    journal._set_snapshot_offset(1000)
+
+    resumed_journal = SessionJournal("s1", str(tmp_path))
+    resumed = resumed_journal.load()
+    resumed.add_exchange("new", "turn")
+    resumed_journal.close()
+
+    assert resumed.turns()[:6] == session.turns()
+    assert len(SessionJournal("s1", str(tmp_path)).read()) == 8
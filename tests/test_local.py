@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+tokenizers = pytest.importorskip("tokenizers")
+
+# pylint: disable=wrong-import-position
+from llm_repl import exceptions
+from llm_repl.llms.local import ContinuousBatcher, LocalLLM, LocalSequence
+from llm_repl.repls import BaseClientHandler
+
+PROMPTS = [
+    "User: hello there\nAssistant:",
+    "def f(x):",
+    "é ü 你好",
+    "User: how are you? " * 6 + "\nAssistant:",
+    "a",
+]
+
+
+class ListClientHandler(BaseClientHandler):
+    """Client handler collecting the tokens in a list"""
+
+    def __init__(self):
+        super().__init__()
+        self.received = []
+
+    async def add_token(self, token: str):
+        self.received.append(token)
+
+    async def start(self, llm_name, **llm_kwargs):
+        pass
+
+    async def print_loop(self):
+        pass
+
+
+@pytest.fixture(scope="module")
+def batcher(tmp_path_factory):
+    """A batcher running a tiny random GPT-2"""
+    path = str(tmp_path_factory.mktemp("tinygpt"))
+    tokenizer = tokenizers.ByteLevelBPETokenizer()
+    tokenizer.train_from_iterator(
+        PROMPTS * 10, vocab_size=320, special_tokens=["<|endoftext|>"]
+    )
+    transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, eos_token="<|endoftext|>"
+    ).save_pretrained(path)
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(
+        vocab_size=320, n_positions=128, n_embd=32, n_layer=2, n_head=2
+    )
+    transformers.GPT2LMHeadModel(config).save_pretrained(path)
+    return ContinuousBatcher(path)
+
+
+async def generate(batcher, prompt, max_new_tokens, delay=0.0):
+    await asyncio.sleep(delay)
+    sequence = LocalSequence(
+        batcher.tokenizer.encode(prompt), max_new_tokens, [], asyncio.get_running_loop()
+    )
+    batcher.submit(sequence)
+    deltas = []
+    while True:
+        delta = await sequence.deltas.get()
+        if delta is None:
+            return "".join(deltas)
+        deltas.append(delta)
+
+
+def reference(batcher, prompt, max_new_tokens):
+    """The greedy generation of transformers, one prompt at a time"""
+    input_ids = torch.tensor([batcher.tokenizer.encode(prompt)])
+    with torch.no_grad():
+        output = batcher.model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=batcher.pad_token_id,
+        )
+    return batcher.tokenizer.decode(
+        output[0, input_ids.shape[1] :], skip_special_tokens=True
+    )
+
+
+@pytest.mark.parametrize("max_new_tokens", [1, 20, 60])
+def test_batched_generation_matches_generate(batcher, max_new_tokens):
+    async def main():
+        # Staggered, so that the sequences join the batch at different steps
+        return await asyncio.gather(
+            *(
+                generate(batcher, prompt, max_new_tokens, delay=0.002 * i)
+                for i, prompt in enumerate(PROMPTS)
+            )
+        )
+
+    outputs = asyncio.run(main())
+
+    assert outputs == [reference(batcher, prompt, max_new_tokens) for prompt in PROMPTS]
+
+
+def test_model_errors_fail_the_request(batcher, monkeypatch):
+    def broken_forward(*args):
+        raise RuntimeError("out of memory")
+
+    monkeypatch.setattr(batcher, "_forward", broken_forward)
+    handler = ListClientHandler()
+    llm = LocalLLM(handler, batcher)
+
+    with pytest.raises(exceptions.LLMException, match="out of memory"):
+        asyncio.run(llm.process("Hello!"))
+
+    assert not any("out of memory" in token for token in handler.received)
+    assert list(llm.session.turns()) == []
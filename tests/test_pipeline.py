@@ -0,0 +1,139 @@
+import pytest
+
+from llm_repl.pipeline import (
+    FenceNormalizer,
+    Redaction,
+    StopSequences,
+    TokenPipeline,
+    build_stages,
+)
+
+
+def run(pipeline: TokenPipeline, tokens):
+    """Feed the tokens until the pipeline stops, and return the text emitted"""
+    text = ""
+    for token in tokens:
+        text += pipeline.feed(token)
+        if pipeline.stopped:
+            return text
+    return text + pipeline.flush()
+
+
+@pytest.mark.parametrize(
+    "tokens",
+    [
+        ["Hello wor", "ld\nUs", "er: hi"],
+        ["Hello world\n", "U", "s", "e", "r", ":", " hi"],
+        ["Hello world\nUser: hi"],
+        list("Hello world\nUser: hi"),
+    ],
+)
+def test_stop_sequence_across_chunks(tokens):
+    pipeline = TokenPipeline(build_stages(stop=["\nUser:"]))
+
+    assert run(pipeline, tokens) == "Hello world"
+    assert pipeline.stopped
+    assert "".join(pipeline.output) == "Hello world"
+
+
+def test_prefix_of_a_stop_sequence_is_held_back_then_released():
+    pipeline = TokenPipeline([StopSequences(["\nUser:"])])
+
+    assert pipeline.feed("Hi\nUs") == "Hi"
+    assert pipeline.feed("ually") == "\nUsually"
+    assert pipeline.flush() == ""
+    assert not pipeline.stopped
+
+
+def test_held_back_prefix_is_flushed_at_the_end():
+    pipeline = TokenPipeline([StopSequences(["STOP"])])
+
+    assert pipeline.feed("the end ST") == "the end "
+    assert pipeline.flush() == "ST"
+
+
+def test_earliest_of_several_stop_sequences():
+    pipeline = TokenPipeline(build_stages(stop=["bb", "a"]))
+
+    assert run(pipeline, ["xb", "ba"]) == "x"
+
+
+def test_reset_between_streams():
+    pipeline = TokenPipeline(build_stages(stop=["END"]))
+    run(pipeline, ["one E", "ND two"])
+
+    pipeline.reset()
+
+    assert not pipeline.stopped
+    assert run(pipeline, ["three"]) == "three"
+    assert pipeline.output == ["three"]
+
+
+@pytest.mark.parametrize(
+    "tokens",
+    [
+        ["my key is sk-", "abcdefghij", "0123456789 ok"],
+        list("my key is sk-abcdefghij0123456789 ok"),
+        ["my key is sk-abcdefghij0123456789 ok"],
+    ],
+)
+def test_redaction_across_chunks(tokens):
+    pipeline = TokenPipeline(build_stages(redact=[r"sk-\w{20}"]))
+
+    assert run(pipeline, tokens) == "my key is [REDACTED] ok"
+
+
+def test_redaction_holds_back_the_longest_match_only():
+    stage = Redaction(["secret", "pw"])
+
+    assert stage.window == 5
+    assert stage.feed("Hello world, this is ") == "Hello world, thi"
+    assert stage.feed("my secr") == "s is my"
+    assert stage.feed("et!") == " "
+    assert stage.flush() == "[REDACTED]!"
+
+
+def test_redaction_of_unbounded_matches():
+    stage = Redaction([r"\d+"], replacement="#")
+
+    assert stage.window == Redaction.MAX_WINDOW
+    assert stage.feed("call 555") == ""
+    assert stage.feed("1234 now") == ""
+    assert stage.flush() == "call # now"
+
+
+def test_redaction_flushes_a_match_at_the_end():
+    pipeline = TokenPipeline(build_stages(redact=["password"]))
+
+    assert pipeline.feed("the password") == "the "
+    assert pipeline.flush() == "[REDACTED]"
+
+
+def test_fence_in_the_middle_of_a_line_gets_its_own_line():
+    pipeline = TokenPipeline([FenceNormalizer()])
+
+    text = run(pipeline, ["Here:", " ```py", "thon\nprint(1)\n``", "`\nDone"])
+
+    assert text == "Here: \n```python\nprint(1)\n```\nDone"
+
+
+def test_fence_split_across_chunks_is_held_back():
+    stage = FenceNormalizer()
+
+    assert stage.feed("text\n`") == "text\n"
+    assert stage.feed("`") == ""
+    assert stage.feed("`js  ") == ""
+    assert stage.feed("\ncode") == "```js\ncode"
+    assert stage.in_code
+
+
+def test_open_code_block_is_closed_at_the_end():
+    pipeline = TokenPipeline([FenceNormalizer()])
+
+    assert run(pipeline, ["```\n", "x = 1"]) == "```\nx = 1\n```\n"
+
+
+def test_backticks_that_are_not_fences_are_released():
+    pipeline = TokenPipeline([FenceNormalizer()])
+
+    assert run(pipeline, ["use `x`", " and ``y``"]) == "use `x` and ``y``"
@@ -0,0 +1,213 @@
+import asyncio
+
+import pytest
+
+from llm_repl.llms import LLMS, BaseLLM
+from llm_repl.llms.router import (
+    STATS,
+    BackendStats,
+    RouterConfig,
+    RouterLLM,
+    extract_features,
+)
+from llm_repl.repls import BaseClientHandler
+
+CONFIG = RouterConfig(
+    default="fake_fast",
+    retry_after=30.0,
+    rules=[
+        {"name": "code", "has_code": True, "backends": ["fake_smart", "fake_fast"]},
+        {"name": "short", "max_tokens": 400, "backends": ["fake_fast", "fake_smart"]},
+    ],
+)
+
+
+class ListClientHandler(BaseClientHandler):
+    """Client handler collecting the tokens in a list"""
+
+    def __init__(self):
+        super().__init__()
+        self.received = []
+
+    @property
+    def start_token(self) -> str:
+        return "<start>"
+
+    @property
+    def end_token(self) -> str:
+        return "<end>"
+
+    async def add_token(self, token: str):
+        self.received.append(token)
+
+    async def start(self, llm_name, **llm_kwargs):
+        pass
+
+    async def print_loop(self):
+        pass
+
+
+class FakeLLM(BaseLLM):
+    """Backend streaming a fixed answer, or failing after the start token"""
+
+    fail = False
+    loaded_with = []
+
+    def __init__(self, client_handler, session_id=None):
+        self.client_handler = client_handler
+        self.session_id = session_id
+
+    @property
+    def name(self) -> str:
+        return type(self).__name__
+
+    @property
+    def info(self) -> str:
+        return ""
+
+    @property
+    def is_in_streaming_mode(self) -> bool:
+        return True
+
+    @classmethod
+    def load(cls, client_handler, **llm_kwargs):
+        cls.loaded_with.append(llm_kwargs)
+        return cls(client_handler, llm_kwargs.get("session_id"))
+
+    async def process(self, msg: str):
+        await self.client_handler.add_token(self.client_handler.start_token)
+        if self.fail:
+            raise ConnectionError(f"{self.name} is down")
+        # LangChain streams an empty token first
+        for token in ["", self.name, "!"]:
+            await self.client_handler.add_token(token)
+        await self.client_handler.add_token(self.client_handler.end_token)
+
+
+class FakeFast(FakeLLM):
+    pass
+
+
+class FakeSmart(FakeLLM):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def backends():
+    LLMS["fake_fast"], LLMS["fake_smart"] = FakeFast, FakeSmart
+    FakeFast.fail = FakeSmart.fail = False
+    STATS.clear()
+    yield
+    STATS.clear()
+    del LLMS["fake_fast"], LLMS["fake_smart"]
+
+
+def degraded(last_request: float) -> BackendStats:
+    stats = BackendStats()
+    stats.record(None, None, True)
+    stats.last_request = last_request
+    return stats
+
+
+def test_route_follows_the_rules():
+    assert CONFIG.route(extract_features("Hi!"), {}) == (
+        "short",
+        ["fake_fast", "fake_smart"],
+    )
+    assert CONFIG.route(extract_features("def f(x):\n    pass"), {}) == (
+        "code",
+        ["fake_smart", "fake_fast"],
+    )
+    assert CONFIG.route(extract_features("@fake_smart Hi!"), {}) == (
+        "hint",
+        ["fake_smart"],
+    )
+
+
+def test_route_tries_the_degraded_backends_last():
+    stats = {"fake_fast": degraded(last_request=100.0)}
+
+    _, candidates = CONFIG.route(extract_features("Hi!"), stats, now=110.0)
+
+    assert candidates == ["fake_smart", "fake_fast"]
+
+
+def test_route_probes_a_degraded_backend_after_retry_after():
+    stats = {"fake_fast": degraded(last_request=100.0)}
+
+    _, candidates = CONFIG.route(extract_features("Hi!"), stats, now=130.0)
+
+    assert candidates == ["fake_fast", "fake_smart"]
+
+
+def test_stats_are_moving_averages():
+    stats = BackendStats()
+    stats.record(1.0, 100.0, False)
+    stats.record(2.0, 50.0, True)
+
+    assert stats.ttft == pytest.approx(1.2)
+    assert stats.tokens_per_s == pytest.approx(90.0)
+    assert stats.error_rate == pytest.approx(0.2)
+    assert stats.requests == 2
+    assert stats.is_healthy(CONFIG)
+
+
+def test_degraded_backend_recovers_through_the_probes():
+    stats = {"fake_fast": degraded(last_request=0.0)}
+    now = 0.0
+    for _ in range(10):
+        now += CONFIG.retry_after
+        _, candidates = CONFIG.route(extract_features("Hi!"), stats, now=now)
+        assert candidates[0] == "fake_fast"
+        stats["fake_fast"].record(0.1, 100.0, False)
+        stats["fake_fast"].last_request = now
+
+    assert stats["fake_fast"].is_healthy(CONFIG)
+
+
+def run_router(msg: str):
+    handler = ListClientHandler()
+    router = RouterLLM(handler, CONFIG, session_id="shared", decisions_log=None)
+    asyncio.run(router.process(msg))
+    return router, handler.received
+
+
+def test_fallback_to_the_next_backend():
+    FakeFast.fail = True
+
+    router, received = run_router("Hi!")
+
+    # A single start token, even if the failed backend sent one
+    assert received == ["<start>", "", "FakeSmart", "!", "<end>"]
+    assert STATS["fake_fast"].error_rate == 1.0
+    assert STATS["fake_smart"].error_rate == 0.0
+    assert router.current.name == "FakeSmart"
+
+
+def test_error_when_all_the_backends_fail():
+    FakeFast.fail = FakeSmart.fail = True
+
+    with pytest.raises(Exception, match="No backend available"):
+        run_router("Hi!")
+
+
+def test_ttft_and_tokens_count_the_text_only():
+    run_router("Hi!")
+
+    assert STATS["fake_fast"].requests == 1
+    assert 0 < STATS["fake_fast"].ttft < 1
+    assert STATS["fake_fast"].tokens_per_s > 0
+
+
+def test_backends_share_the_session():
+    FakeFast.loaded_with = []
+    FakeFast.fail = True
+    FakeSmart.loaded_with = []
+
+    router, _ = run_router("Hi!")
+
+    assert FakeFast.loaded_with[0]["session_id"] == "shared"
+    assert FakeSmart.loaded_with[0]["session_id"] == "shared"
+    assert all(
+        backend.session is router.session for backend in router.backends.values()
+    )
@@ -0,0 +1,76 @@
+import asyncio
+
+from llm_repl.repls.http import STREAMS, SSEStream, find_resumable_stream
+
+
+async def collect(stream: SSEStream, last_seq: int = -1):
+    return [event async for event in stream.follow(last_seq)]
+
+
+async def fill(stream: SSEStream, n: int):
+    for i in range(n):
+        await stream.append(f"token {i}")
+    await stream.append("[DONE]", done=True)
+
+
+def test_follow_resumes_after_the_last_event_received():
+    async def main():
+        stream = SSEStream("s")
+        await fill(stream, 5)
+        return await collect(stream, last_seq=2)
+
+    events = asyncio.run(main())
+
+    assert events == [
+        (3, "new_message", "token 3"),
+        (4, "new_message", "token 4"),
+        (5, "new_message", "[DONE]"),
+    ]
+
+
+def test_follow_waits_for_the_new_events():
+    async def main():
+        stream = SSEStream("s")
+        await stream.append("token 0")
+        follower = asyncio.create_task(collect(stream))
+        await asyncio.sleep(0)
+        await stream.append("token 1")
+        await stream.append("[DONE]", done=True)
+        return await asyncio.wait_for(follower, 1)
+
+    events = asyncio.run(main())
+
+    assert [seq for seq, _, _ in events] == [0, 1, 2]
+
+
+def test_follow_signals_the_evicted_events():
+    async def main():
+        stream = SSEStream("s", maxlen=3)
+        await fill(stream, 6)
+        return await collect(stream, last_seq=0)
+
+    events = asyncio.run(main())
+
+    # Events 1 to 3 were evicted from the buffer
+    assert events[0] == (3, "gap", '{"missed": 3}')
+    assert [seq for seq, _, _ in events[1:]] == [4, 5, 6]
+
+
+def test_find_resumable_stream():
+    async def main():
+        stream = SSEStream("resumable", maxlen=3)
+        await fill(stream, 6)
+        return stream
+
+    stream = asyncio.run(main())
+    STREAMS[stream.stream_id] = stream
+    try:
+        assert find_resumable_stream(f"{stream.stream_id}:4") == (stream, 4)
+        assert find_resumable_stream(f"{stream.stream_id}:3") == (stream, 3)
+        # The events after it were evicted
+        assert find_resumable_stream(f"{stream.stream_id}:1") == (None, -1)
+        assert find_resumable_stream(f"{stream.stream_id}:x") == (None, -1)
+        assert find_resumable_stream("unknown:1") == (None, -1)
+        assert find_resumable_stream(None) == (None, -1)
+    finally:
+        del STREAMS[stream.stream_id]
@@ -0,0 +1,109 @@
+import asyncio
+import socket
+
+import pytest
+import websockets
+
+from llm_repl import exceptions
+from llm_repl.llms import LLMS, BaseLLM
+from llm_repl.repls.websocket import WebsocketREPL
+from llm_repl.supervisor import ClientSupervisor
+
+
+class EchoLLM(BaseLLM):
+    """LLM answering with the message"""
+
+    def __init__(self, client_handler):
+        self.client_handler = client_handler
+
+    @property
+    def name(self) -> str:
+        return "Echo"
+
+    @property
+    def info(self) -> str:
+        return ""
+
+    @property
+    def is_in_streaming_mode(self) -> bool:
+        return True
+
+    @classmethod
+    def load(cls, client_handler, **llm_kwargs):
+        return cls(client_handler)
+
+    async def process(self, msg: str):
+        await self.client_handler.add_token(self.client_handler.start_token)
+        await self.client_handler.add_token(msg)
+        await self.client_handler.add_token(self.client_handler.end_token)
+
+
+@pytest.fixture(autouse=True)
+def echo_llm():
+    LLMS["echo"] = EchoLLM
+    yield
+    del LLMS["echo"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for(condition, timeout=5.0):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+
+def test_clients_are_not_limited_by_default():
+    supervisor = WebsocketREPL().supervisor
+    for _ in range(10001):
+        supervisor.admit(lambda code, reason: None)
+
+    assert len(supervisor.clients) == 10001
+
+
+def test_admit_rejects_the_clients_over_the_cap():
+    supervisor = ClientSupervisor(max_clients=1)
+    supervisor.admit(lambda code, reason: None)
+
+    with pytest.raises(exceptions.TooManyClients):
+        supervisor.admit(lambda code, reason: None)
+    assert supervisor.rejected == 1
+
+
+def test_client_over_the_cap_is_rejected_and_tasks_are_freed():
+    port = free_port()
+    repl = WebsocketREPL(port=port, max_clients=2)
+
+    async def main():
+        server = asyncio.create_task(repl.run("echo"))
+        uri = f"ws://localhost:{port}"
+        await asyncio.sleep(0.2)
+        clients = [await websockets.connect(uri) for _ in range(2)]
+        for i, client in enumerate(clients):
+            await client.send(f"Hello {i}")
+            assert await client.recv() == ""
+            assert await client.recv() == f"Hello {i}"
+            assert await client.recv() == "EOF"
+
+        rejected = await websockets.connect(uri)
+        with pytest.raises(websockets.ConnectionClosed):
+            await rejected.recv()
+        assert rejected.close_code == ClientSupervisor.CLOSE_TRY_AGAIN_LATER
+        assert repl.supervisor.stats()["rejected"] == 1
+
+        for client in clients:
+            await client.close()
+        await wait_for(lambda: repl.supervisor.stats()["sessions"] == 0)
+        stats = repl.supervisor.stats()
+        server.cancel()
+        await asyncio.gather(server, return_exceptions=True)
+        return stats
+
+    stats = asyncio.run(main())
+
+    assert stats["tasks"] == 0
+    assert stats["max_clients"] == 2
@@ -0,0 +1,98 @@
+import os
+
+import numpy as np
+import pytest
+
+from llm_repl.vector_memory import VectorIndex
+
+
+def vector(i: int, dim: int = 8) -> np.ndarray:
+    """A vector pointing mostly in the direction of the i-th axis"""
+    v = np.full(dim, 0.01, dtype=np.float32)
+    v[i % dim] = 1.0
+    return v
+
+
+def add(index: VectorIndex, first: int, n: int):
+    index.add(
+        np.stack([vector(i) for i in range(first, first + n)]),
+        [{"n": i} for i in range(first, first + n)],
+    )
+
+
+def test_add_and_search(tmp_path):
+    index = VectorIndex(str(tmp_path), dim=8)
+    add(index, 0, 4)
+
+    results = index.search(vector(2), k=2)
+
+    assert len(index) == 4
+    assert results[0][1] == {"n": 2}
+    assert results[0][0] == pytest.approx(1.0)
+    assert len(results) == 2
+    assert index.search(vector(2), k=0) == []
+
+
+def test_oldest_entries_are_evicted(tmp_path):
+    index = VectorIndex(str(tmp_path), dim=8, max_entries=3)
+    add(index, 0, 4)
+
+    assert len(index) == 3
+    assert sorted(entry["n"] for _, entry in index.search(vector(0), k=10)) == [
+        1,
+        2,
+        3,
+    ]
+
+
+def test_compaction_keeps_the_live_entries(tmp_path):
+    index = VectorIndex(str(tmp_path), dim=8, max_entries=3)
+    for i in range(10):
+        add(index, i, 1)
+
+    # Compacted as soon as the evicted rows outnumber the live ones
+    assert index.start <= len(index)
+    assert sorted(entry["n"] for _, entry in index.search(vector(0), k=10)) == [
+        7,
+        8,
+        9,
+    ]
+    assert index.search(vector(9), k=1)[0][1] == {"n": 9}
+    with open(index.entries_path) as f:
+        assert len(f.readlines()) == index.count
+
+
+def test_reopen(tmp_path):
+    index = VectorIndex(str(tmp_path), dim=8, max_entries=3)
+    for i in range(10):
+        add(index, i, 1)
+    expected = index.search(vector(8), k=3)
+
+    reopened = VectorIndex(str(tmp_path), dim=0)
+
+    assert reopened.dim == 8
+    assert len(reopened) == 3
+    assert reopened.search(vector(8), k=3) == expected
+
+
+def test_reopen_after_an_interrupted_compaction(tmp_path, monkeypatch):
+    index = VectorIndex(str(tmp_path), dim=8, max_entries=3)
+    add(index, 0, 4)
+    replace = os.replace
+
+    def crash_before_meta(src, dst):
+        if dst == index.meta_path and src.endswith(".tmp"):
+            raise OSError("crash")
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", crash_before_meta)
+    with pytest.raises(OSError):
+        # Evicts 3 more rows and compacts
+        add(index, 4, 3)
+    monkeypatch.undo()
+
+    reopened = VectorIndex(str(tmp_path), dim=0)
+
+    assert (reopened.start, reopened.count) == (0, 3)
+    for i in (4, 5, 6):
+        assert reopened.search(vector(i), k=1)[0][1] == {"n": i}
@@ -0,0 +1,89 @@
+import asyncio
+import json
+
+from llm_repl.repls.websocket import (
+    FRAME_DELTA,
+    FRAME_END,
+    FRAME_ERROR,
+    FRAME_START,
+    SUBPROTOCOL_JSON,
+    WebsocketClientHandler,
+)
+
+
+class ListWebsocket:
+    """Websocket collecting the frames sent"""
+
+    subprotocol = SUBPROTOCOL_JSON
+
+    def __init__(self):
+        self.frames = []
+
+    async def send(self, frame):
+        self.frames.append(json.loads(frame))
+
+
+async def stream(handler, tokens, delay=0.0):
+    printer = asyncio.create_task(handler.print_loop())
+    await handler.add_token(handler.start_token)
+    for token in tokens:
+        await handler.add_token(token)
+        await asyncio.sleep(delay)
+    await handler.add_token(handler.end_token)
+    await handler.tokens.join()
+    printer.cancel()
+
+
+def test_framed_messages():
+    websocket = ListWebsocket()
+    handler = WebsocketClientHandler(websocket)
+
+    asyncio.run(stream(handler, ["Hello", " world", "!"]))
+
+    frames = websocket.frames
+    assert frames[0] == [FRAME_START]
+    assert "".join(frame[1] for frame in frames if frame[0] == FRAME_DELTA) == (
+        "Hello world!"
+    )
+    assert frames[-1][:3] == [FRAME_END, 3, len(frames) - 2]
+
+
+def test_first_token_is_sent_right_away():
+    websocket = ListWebsocket()
+    handler = WebsocketClientHandler(websocket)
+    tokens = [f"t{i} " for i in range(40)]
+
+    asyncio.run(stream(handler, tokens, delay=0.001))
+
+    deltas = [frame[1] for frame in websocket.frames if frame[0] == FRAME_DELTA]
+    assert deltas[0] == "t0 "
+    # The other tokens are batched while they keep coming
+    assert len(deltas) < len(tokens) / 4
+    assert "".join(deltas) == "".join(tokens)
+
+
+def test_error_is_followed_by_the_end():
+    websocket = ListWebsocket()
+    handler = WebsocketClientHandler(websocket)
+
+    class FailingLLM:
+        async def process(self, message):
+            await handler.add_token(handler.start_token)
+            await handler.add_token("Hel")
+            raise ConnectionError("backend down")
+
+    async def main():
+        handler.llm = FailingLLM()
+        printer = asyncio.create_task(handler.print_loop())
+        await handler.process("Hi!")
+        await handler.tokens.join()
+        printer.cancel()
+
+    asyncio.run(main())
+
+    assert websocket.frames[:3] == [
+        [FRAME_START],
+        [FRAME_DELTA, "Hel"],
+        [FRAME_ERROR, "backend down"],
+    ]
+    assert websocket.frames[3][0] == FRAME_END